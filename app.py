@@ -1,37 +1,157 @@
-import os
+"""Warbler web app.
+
+Build it with `create_app()`; views are registered from the `views`
+blueprint. Modules only some requests need (forms, bcrypt, Pillow,
+migrations, the debug toolbar) are imported on first use so workers
+boot fast. `preload()` imports them and compiles every template up
+front for a master process that forks workers (see gunicorn.conf.py).
+"""
 
-from flask import (Flask, flash, g, redirect, render_template, request,
-                   session, url_for, jsonify)
-from flask_debugtoolbar import DebugToolbarExtension
+import hmac
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import (Blueprint, Flask, Response, abort, current_app, flash, g,
+                   redirect, render_template, request, send_file, session,
+                   url_for, jsonify)
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
-from forms import LoginForm, MessageForm, UserAddForm, UserEditForm
-from models import Message, User, connect_db, db, Follows, Likes
+import export
+import influence
+import ingest
+import jobs
+import partitions
+import ranking
+import streaming
+import tags
+import templating
+from availability import availability
+from duplicates import duplicates
+from models import (Message, User, connect_db, db, Follows, Likes, Mention,
+                    MessageTag, Tag)
+from likebuffer import like_buffer
+from notifications import FOLLOW, LIKE, notifications
+from objcache import object_cache
+from profiler import HEADER as PROFILER_HEADER, profiler
+from ratelimit import limiter, rate_limit
+from sharding import ShardMoving, attach_authors, shards
+from slowlog import slow_query_log
+from thumbnails import SIZES, ThumbnailError, thumbnails
 from util import login_required
 
 CURR_USER_KEY = "curr_user"
+TIMELINE_PAGE_SIZE = 50
+
+# users fetched per round trip while a listing page streams
+LISTING_BATCH_SIZE = 500
+
+# endpoints that only buffer likes; everything else flushes them first
+LIKE_ENDPOINTS = {'warbler.create_like', 'warbler.delete_likes'}
+
+# thumbnails never change for a given URL, so browsers may keep them a year
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
 
-app = Flask(__name__)
+# user ids one /api/relationships call may ask about
+RELATIONSHIPS_MAX_IDS = 500
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+# most influential users not yet followed, shown on the home page
+SUGGESTIONS = 5
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+views = Blueprint('warbler', __name__)
 
-connect_db(app)
+
+def create_app(config=None):
+    """Create and configure a Warbler app.
+
+    `config` is a mapping of settings that override the defaults below.
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    # bearer tokens of partners allowed to bulk load messages
+    app.config['INGEST_TOKENS'] = [
+        token for token in os.environ.get('INGEST_TOKENS', '').split(',')
+        if token
+    ]
+    # alembic is slow to import and only needed by `flask db` and seeding
+    app.config['LOAD_MIGRATIONS'] = (
+        os.environ.get('FLASK_RUN_FROM_CLI') == 'true')
+    app.config.from_mapping(config or {})
+
+    # before anything creates app.jinja_env
+    templating.init_app(app)
+    ranking.init_app(app)
+    streaming.init_app(app)
+
+    if app.config['ENV'] == 'development':
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    if app.config['LOAD_MIGRATIONS']:
+        from flask_migrate import Migrate
+        Migrate(app, db, include_object=partitions.include_object)
+
+    connect_db(app)
+    # first, so the other request hooks are profiled too
+    profiler.init_app(app)
+    slow_query_log.init_app(app)
+    limiter.init_app(app)
+    thumbnails.init_app(app)
+    shards.init_app(app)
+    notifications.init_app(app)
+    like_buffer.init_app(app)
+    availability.init_app(app)
+    duplicates.init_app(app)
+    object_cache.init_app(app)
+
+    app.register_blueprint(views)
+    for command in (worker, backfill_tags, export_user, ingest_messages,
+                    shards_cli, partitions_cli, influence_cli, profiler_cli,
+                    slow_queries_cli):
+        app.cli.add_command(command)
+
+    return app
+
+
+def preload(app):
+    """Import everything lazily loaded so forked workers start warm.
+
+    Call once in a master process before it forks (gunicorn --preload);
+    workers then share these modules and compiled templates
+    copy-on-write instead of each loading them on its first request.
+    """
+
+    import forms  # noqa: F401
+    import PIL.Image  # noqa: F401
+    from models import get_bcrypt
+
+    get_bcrypt()
+    templating.warm_up(app)
+
+    # connections must not be shared across fork; workers open their own
+    with app.app_context():
+        db.engine.dispose()
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
     """
     If we're logged in, add curr user to Flask global before making
@@ -48,6 +168,10 @@ def add_user_to_g():
     else:
         g.user = None
 
+    # read your writes: pages show this user's buffered likes
+    if g.user and request.endpoint not in LIKE_ENDPOINTS:
+        like_buffer.flush(user_id=g.user.id)
+
 
 def do_login(user):
     """Log in user."""
@@ -63,7 +187,8 @@ def do_logout():
         flash("Logged out!", "success")
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
+@rate_limit(5, per=60, scope="ip", methods=("POST",))
 def signup():
     """Handle user signup.
 
@@ -75,9 +200,20 @@ def signup():
     and re-present form.
     """
 
+    from forms import UserAddForm
+
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # before signup hashes the password
+        taken = availability.taken(username=form.username.data,
+                                   email=form.email.data)
+        for field in taken:
+            getattr(form, field).errors.append(
+                f"{getattr(form, field).label.text} already taken")
+        if taken:
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -99,10 +235,13 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
+@rate_limit(10, per=60, scope="ip", methods=("POST",))
 def login():
     """Handle user login."""
 
+    from forms import LoginForm
+
     form = LoginForm()
 
     if form.validate_on_submit():
@@ -119,102 +258,189 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
 
     do_logout()
-    return redirect(url_for('login'))
+    return redirect(url_for('warbler.login'))
 
 
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+def keyset_page(build, key_column, user_id=None):
+    """Return one page of rows newest first, plus the next page's cursor.
+
+    `build(session)` returns the query to page through. It runs on the
+    shard holding `user_id`'s rows, or on every shard if no user is given.
+    Pages are keyed on the integer `key_column` (e.g. a message or like
+    id) via the `before` query string param, so deep pages cost the same
+    as the first one.
+    """
+
+    before = request.args.get('before', type=int)
+
+    def page(session, shard):
+        query = build(session)
+        if before:
+            query = query.filter(key_column < before)
+        return (query
+                .add_columns(key_column.label('page_key'))
+                .order_by(key_column.desc())
+                .limit(TIMELINE_PAGE_SIZE + 1))
+
+    rows = shards.gather(
+        page,
+        shards=None if user_id is None else [shards.shard_for(user_id)],
+        key=lambda row: row.page_key,
+        limit=TIMELINE_PAGE_SIZE + 1)
+    next_before = None
+    if len(rows) > TIMELINE_PAGE_SIZE:
+        rows = rows[:TIMELINE_PAGE_SIZE]
+        next_before = rows[-1][-1]
+
+    return [row[0] for row in rows], next_before
+
+
+def suggested_users(user):
+    """The most influential users `user` doesn't follow yet."""
+
+    followed = (db.session.query(Follows)
+                .filter(Follows.user_following_id == user.id,
+                        Follows.user_being_followed_id == User.id))
+    return (User.query
+            .filter(User.id != user.id, ~followed.exists())
+            .order_by(User.influence.desc())
+            .limit(SUGGESTIONS)
+            .all())
+
+
+def profile_counts(user):
+    """Message and like counts shown on profile pages."""
+
+    session = shards.session_for(user.id)
+    return dict(
+        num_messages=(session.query(Message)
+                      .filter(Message.user_id == user.id).count()),
+        num_likes=session.query(Likes).filter(Likes.user_id == user.id).count(),
+        # counted, not loaded: a popular user has too many to load
+        num_following=(Follows.query
+                       .filter(Follows.user_following_id == user.id).count()),
+        num_followers=(Follows.query
+                       .filter(Follows.user_being_followed_id == user.id)
+                       .count()),
+    )
+
+
+@views.route('/users')
 def list_users():
     """Page with listing of users.
 
     Can take a 'q' param in querystring to search by that username.
+    Streamed as the users are read.
     """
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    query = User.query.order_by(User.influence.desc(), User.id)
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
 
-    return render_template('users/index.html', users=users)
+    return streaming.stream_template(
+        'users/index.html', users=query.yield_per(LISTING_BATCH_SIZE))
 
 
-@app.route('/users/<int:user_id>')
+@views.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = object_cache.get_user_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    num_likes = len(user.likes)
+    messages = shards.gather(
+        lambda session, shard: (session.query(Message)
+                                .filter(Message.user_id == user_id)
+                                .order_by(Message.timestamp.desc())
+                                .limit(100)),
+        shards=[shards.shard_for(user_id)])
+    attach_authors(messages)
     return render_template(
-        'users/show.html', user=user, messages=messages, num_likes=num_likes
+        'users/show.html', user=user, messages=messages, **profile_counts(user)
     )
 
 
-@app.route('/users/<int:user_id>/likes')
+@views.route('/users/<int:user_id>/likes')
 @login_required()
 def show_likes(user_id):
     """Show list of messages this user has liked."""
 
-    user = User.query.get_or_404(user_id)
+    user = object_cache.get_user_or_404(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = user.likes
-    num_likes = len(user.likes)
-    return render_template(
-        'users/likes.html', user=user, messages=messages, num_likes=num_likes
+    # most recent likes first, from the liker's shard; the messages
+    # themselves live with their authors
+    likes, next_before = keyset_page(
+        lambda session: session.query(Likes).filter(Likes.user_id == user_id),
+        Likes.id, user_id=user_id)
+    by_id = shards.get_messages([like.message_id for like in likes])
+    messages = [by_id[like.message_id] for like in likes
+                if like.message_id in by_id]
+
+    return streaming.stream_template(
+        'users/likes.html', user=user, messages=messages,
+        next_before=next_before, **profile_counts(user)
     )
 
-@app.route('/users/<int:user_id>/following')
+@views.route('/users/<int:user_id>/following')
 @login_required()
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following; streamed as they
+    are read."""
 
-    user = User.query.get_or_404(user_id)
-    num_likes = len(user.likes)
-    return render_template('users/following.html', user=user, num_likes=num_likes)
+    user = object_cache.get_user_or_404(user_id)
+    following = (User.query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id)
+                 .order_by(User.id)
+                 .yield_per(LISTING_BATCH_SIZE))
+    return streaming.stream_template('users/following.html', user=user,
+                                     following=following,
+                                     **profile_counts(user))
 
 
-@app.route('/users/<int:user_id>/followers')
+@views.route('/users/<int:user_id>/followers')
 @login_required()
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user; streamed as they are
+    read."""
 
-    user = User.query.get_or_404(user_id)
-    num_likes = len(user.likes)
-    return render_template('users/followers.html', user=user, num_likes=num_likes)
+    user = object_cache.get_user_or_404(user_id)
+    followers = (User.query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .order_by(User.id)
+                 .yield_per(LISTING_BATCH_SIZE))
+    return streaming.stream_template('users/followers.html', user=user,
+                                     followers=followers,
+                                     **profile_counts(user))
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@views.route('/users/follow/<int:follow_id>', methods=['POST'])
 @login_required()
+@rate_limit(30, per=60, scope="user")
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
     db.session.commit()
+    notifications.notify(FOLLOW, follow_id, g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@views.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 @login_required()
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
@@ -226,11 +452,13 @@ def stop_following(follow_id):
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@views.route('/users/profile', methods=["GET", "POST"])
 @login_required()
 def profile():
     """Update profile for current user."""
 
+    from forms import UserEditForm
+
     status_code = 200
     form = (
         # populate form with user object initially
@@ -248,9 +476,9 @@ def profile():
             db.session.commit()
         except IntegrityError:
             flash(f"Failed to update {g.user.username}", "danger")
-            return redirect(url_for('homepage'))
+            return redirect(url_for('warbler.homepage'))
         
-        return redirect(url_for('users_show', user_id=g.user.id))
+        return redirect(url_for('warbler.users_show', user_id=g.user.id))
 
     elif (form.password.data
           and not User.authenticate(g.user.username, form.data.get('password'))):
@@ -264,13 +492,37 @@ def profile():
     return (render_template('users/edit.html', form=form), status_code)
 
 
-@app.route('/users/delete', methods=["POST"])
+@views.route('/users/export')
+@login_required()
+@rate_limit(5, per=60 * 60, scope="user")
+def export_account():
+    """Download the current user's account as NDJSON, gzipped with
+    ?gzip=1; streamed as it is read."""
+
+    body = export.ndjson(export.records(g.user.id))
+    filename = f"warbler-{g.user.id}.ndjson"
+    mimetype = 'application/x-ndjson'
+    if request.args.get('gzip'):
+        body = export.gzipped(body)
+        filename += ".gz"
+        mimetype = 'application/gzip'
+
+    return Response(body, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+    })
+
+
+@views.route('/users/delete', methods=["POST"])
 @login_required()
 def delete_user():
     """Delete user."""
 
     do_logout()
 
+    shards.purge_user(g.user.id)
+    if not shards.enabled:
+        # and the likes, tags and mentions of archived messages
+        shards.purge_messages(partitions.delete_user_archives(g.user.id))
     db.session.delete(g.user)
     db.session.commit()
 
@@ -280,116 +532,255 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages')
+def board_context(messages):
+    """Template variables messages/board.html needs to show `messages`
+    to the current user."""
+
+    message_ids = [msg.id for msg in messages]
+    if not message_ids:
+        return dict(liked_message_ids=set(), user_message_ids=set(),
+                    likes_msg_map={}, like_counts={})
+
+    likes_msg_map = dict(
+        shards.session_for(g.user.id)
+        .query(Likes.message_id, Likes.id)
+        .filter(Likes.user_id == g.user.id,
+                Likes.message_id.in_(message_ids))
+    )
+
+    # one grouped count per shard, however many messages are shown;
+    # likes live with the liker, so any shard may hold some
+    like_counts = defaultdict(int)
+    for message_id, count in shards.gather(
+            lambda session, shard:
+                session.query(Likes.message_id, func.count(Likes.id))
+                .filter(Likes.message_id.in_(message_ids))
+                .group_by(Likes.message_id)):
+        like_counts[message_id] += count
+
+    return dict(
+        liked_message_ids=set(likes_msg_map),
+        user_message_ids={msg.id for msg in messages
+                          if msg.user_id == g.user.id},
+        likes_msg_map=likes_msg_map,
+        like_counts=like_counts,
+    )
+
+
+@views.route('/messages')
 @login_required()
 def list_messages():
     """
     List 50 most recent messages.
     """
 
-    messages = Message.query.order_by(Message.timestamp.desc()).limit(50).all()
+    messages = shards.gather(
+        lambda session, shard: (session.query(Message)
+                                .order_by(Message.timestamp.desc())
+                                .limit(50)),
+        key=lambda msg: msg.timestamp, limit=50)
+    attach_authors(messages)
 
-    liked_message_ids = {
-        msg.id for msg in g.user.likes
-    }
-    user_message_ids = {
-        msg.id for msg in g.user.messages
-    }
+    return render_template('trending.html', messages=messages,
+                           **board_context(messages))
 
-    likes_msg_map = {
-        like.message_id: like.id
-        for like in Likes.query.filter(Likes.user_id == g.user.id)
-    }
 
-    return render_template(
-        'trending.html', messages=messages,
-        liked_message_ids=liked_message_ids,
-        user_message_ids=user_message_ids,
-        likes_msg_map=likes_msg_map,
-    )
-
-
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 @login_required()
+@rate_limit(10, per=60, scope="user", methods=("POST",))
 def messages_add():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
     """
 
+    from forms import MessageForm
+
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        matches = duplicates.check(form.text.data)
+        if duplicates.throttled(matches):
+            current_app.logger.warning(
+                "Refused a post by user %s like %d recent messages",
+                g.user.id, len(matches))
+            form.text.errors.append("This looks like a message posted many "
+                                    "times already. Try again later.")
+            return render_template('messages/new.html', form=form), 429
+        if matches:
+            current_app.logger.info(
+                "Post by user %s is like message %s (%.2f)",
+                g.user.id, matches[0][0], matches[0][2])
+
+        msg = Message(id=shards.next_id('messages'), text=form.text.data,
+                      user_id=g.user.id)
+        session = shards.session_for(g.user.id, write=True)
+        session.add(msg)
+        tags.index_message(msg, session)
+        message_id = msg.id
+        # new tags are created in the main database
         db.session.commit()
+        session.commit()
+        duplicates.add(message_id, g.user.id, form.text.data)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@views.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = object_cache.get_message(message_id)
+    if msg is None and not shards.enabled:
+        msg = partitions.find_archived(message_id)
+    if msg is None:
+        abort(404)
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
 @login_required()
 def messages_destroy(message_id):
     """Delete a message."""
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
-    db.session.commit()
+    session = shards.session_for(g.user.id, write=True)
+    deleted = (session.query(Message)
+               .filter(Message.id == message_id, Message.user_id == g.user.id)
+               .delete(synchronize_session=False))
+    session.commit()
+    if not deleted and not shards.enabled:
+        deleted = partitions.delete_archived(message_id, g.user.id)
+    if not deleted:
+        abort(404)
+    shards.purge_messages([message_id])
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Tag and mention timelines:
+
+
+
+@views.route('/tags/<tag>')
+@login_required()
+def tag_timeline(tag):
+    """Show messages using a hashtag, newest first."""
+
+    tag = Tag.query.filter_by(name=tag.lower().lstrip('#')).first_or_404()
+    messages, next_before = keyset_page(
+        lambda session: (session.query(Message)
+                         .join(MessageTag, MessageTag.message_id == Message.id)
+                         .filter(MessageTag.tag_id == tag.id)),
+        MessageTag.message_id)
+    attach_authors(messages)
+
+    return render_template(
+        'messages/timeline.html', title=f"#{tag.name}", messages=messages,
+        next_before=next_before, **board_context(messages)
+    )
+
+
+@views.route('/users/<int:user_id>/mentions')
+@login_required()
+def user_mentions(user_id):
+    """Show messages mentioning this user, newest first."""
+
+    user = object_cache.get_user_or_404(user_id)
+    messages, next_before = keyset_page(
+        lambda session: (session.query(Message)
+                         .join(Mention, Mention.message_id == Message.id)
+                         .filter(Mention.user_id == user.id)),
+        Mention.message_id)
+    attach_authors(messages)
+
+    return render_template(
+        'messages/timeline.html', title=f"Mentions of @{user.username}",
+        messages=messages, next_before=next_before, **board_context(messages)
+    )
+
+
+##############################################################################
+# Notifications:
+
+@views.route('/notifications')
+@login_required()
+def show_notifications():
+    """Show the current user's notifications and mark them read."""
+
+    return render_template('notifications.html',
+                           notifications=notifications.inbox(g.user))
+
+
 ##############################################################################
 # Likes REST API routes:
 
-@app.route('/api/likes', methods=['POST'])
+@views.route('/api/likes', methods=['POST'])
 @login_required()
+@rate_limit(60, per=60, scope="user")
 def create_like():
     """
     Create a like association to message based on JSON data;
     return created like in JSON.
     """
     data = request.json
+    if like_buffer.enabled:
+        message_id = data.get('message_id')
+        if not isinstance(message_id, int):
+            return (jsonify({"message": "message_id must be an integer"}),
+                    400)
+        likes = Likes(id=like_buffer.like(g.user.id, message_id),
+                      user_id=g.user.id, message_id=message_id)
+        return (jsonify({"likes": likes.serialize()}), 201)
+
     likes_data = {
         field: data.get(field)
         for field in Likes.__table__.columns.keys()
         if data.get(field)
     }
+    # likes are always made by, and stored with, the logged in user
+    likes_data.update(id=shards.next_id('likes'), user_id=g.user.id)
+    session = shards.session_for(g.user.id, write=True)
     try:
         likes = Likes(**likes_data)
-        db.session.add(likes)
-        db.session.commit()
+        session.add(likes)
+        session.commit()
     except IntegrityError as e:
+        session.rollback()
         resp = jsonify({"message": e.orig.pgerror})
         return (resp, 400)
     except:
+        session.rollback()
         resp = jsonify({"message": "Failed to create a like association"})
         return (resp, 400)
 
+    notifications.notify(LIKE, likes.message_id, g.user.id)
     resp = jsonify({"likes": likes.serialize()})
     return (resp, 201)
 
 
-@app.route('/api/likes/<int:likes_id>', methods=['DELETE'])
+@views.route('/api/likes/<int:likes_id>', methods=['DELETE'])
 @login_required()
 def delete_likes(likes_id):
     """
     Remove likes association of specified id; return delete message if successful.
     """
-    likes = Likes.query.get_or_404(likes_id)
+    if like_buffer.enabled:
+        if not like_buffer.unlike(g.user.id, likes_id):
+            abort(404)
+        return jsonify({"message": "Deleted"})
+
+    session = shards.session_for(g.user.id, write=True)
+    likes = (session.query(Likes)
+             .filter(Likes.id == likes_id, Likes.user_id == g.user.id)
+             .first())
+    if likes is None:
+        abort(404)
     try:
-        db.session.delete(likes)
-        db.session.commit()
+        session.delete(likes)
+        session.commit()
     except SQLAlchemyError:
         resp = jsonify({"message": f"Failed to delete likes({likes_id})"})
         return (resp, 400)
@@ -397,61 +788,165 @@ def delete_likes(likes_id):
     return jsonify({"message": "Deleted"})
 
 
+##############################################################################
+# Bulk ingest API
+
+def ingest_authorized():
+    """Whether the request carries one of the INGEST_TOKENS."""
+
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme == 'Bearer' and any(
+        hmac.compare_digest(token, allowed)
+        for allowed in current_app.config['INGEST_TOKENS'])
+
+
+@views.route('/api/messages/bulk', methods=['POST'])
+def bulk_ingest():
+    """
+    Load messages from a CSV (Content-Type text/csv) or NDJSON body;
+    return how many were inserted and why the others were rejected.
+    """
+    if not ingest_authorized():
+        return (jsonify({"message": "Unauthorized"}), 401)
+
+    format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    try:
+        report = ingest.ingest(request.stream, format)
+    except ingest.IngestError as e:
+        return (jsonify({"message": str(e)}), 400)
+
+    return jsonify(report.serialize())
+
+
+##############################################################################
+# Availability API
+
+@views.route('/api/availability')
+@rate_limit(60, per=60, scope="ip")
+def check_availability():
+    """
+    Report whether the `username` and/or `email` query parameters are
+    free, e.g. {"username": true}.
+    """
+    values = {field: request.args[field]
+              for field in ('username', 'email') if request.args.get(field)}
+    if not values:
+        return (jsonify({"message": "Pass a username or email"}), 400)
+
+    return jsonify({field: availability.is_available(field, value)
+                    for field, value in values.items()})
+
+
+##############################################################################
+# Relationships API
+
+@views.route('/api/relationships')
+@login_required()
+@rate_limit(60, per=60, scope="user")
+def relationships():
+    """
+    Report whether the logged in user follows and is followed by each of
+    the users in `ids` (comma separated, at most RELATIONSHIPS_MAX_IDS),
+    e.g. {"relationships": [{"id": 1, "following": true,
+    "followed_by": false}]}.
+    """
+    try:
+        ids = [int(user_id) for value in request.args.getlist('ids')
+               for user_id in value.split(',') if user_id.strip()]
+    except ValueError:
+        return (jsonify({"message": "ids must be integers"}), 400)
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return (jsonify({"message": "Pass ids"}), 400)
+    if len(ids) > RELATIONSHIPS_MAX_IDS:
+        return (jsonify({"message": f"At most {RELATIONSHIPS_MAX_IDS} ids"}),
+                400)
+
+    found = User.relationships(g.user.id, ids)
+    return jsonify({"relationships": [
+        {"id": user_id, "following": following, "followed_by": followed_by}
+        for user_id, (following, followed_by) in found.items()]})
+
+
+##############################################################################
+# Cache metrics
+
+@views.route('/api/cache/stats')
+def cache_stats():
+    """
+    Report this worker's object cache hits, misses and invalidations,
+    e.g. {"users.local_hits": 10, "users.misses": 2, "pid": 123}.
+    """
+    return jsonify(object_cache.stats())
+
+
+##############################################################################
+# Image proxy
+
+@views.route('/images/<size>/<token>')
+def thumbnail(size, token):
+    """Serve a resized, locally cached copy of a user's image."""
+
+    source = thumbnails.source_for(token)
+    if size not in SIZES or source is None:
+        abort(404)
+
+    try:
+        path = thumbnails.get(source, size)
+    except ThumbnailError:
+        # show the original rather than a broken image
+        return redirect(source)
+
+    resp = send_file(path, mimetype='image/jpeg', add_etags=False,
+                     cache_timeout=THUMBNAIL_MAX_AGE)
+    # cache files are named by content digest and size
+    resp.set_etag(os.path.basename(path))
+    return resp.make_conditional(request)
+
+
 ##############################################################################
 # Homepage and error pages
 
-@app.route('/')
+@views.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, or with
+      ?feed=top, pages of them ranked (see ranking.py)
     """
 
     if g.user:
-        # SELECT messages.* FROM messages
-        # JOIN follows ON user_being_followed_id = messages.user_id
-        # JOIN users ON users.id = user_following_id
-        # WHERE users.id = 302
-        following_messages = (
-            Message.query
-                .join(Follows, Follows.user_being_followed_id == Message.user_id)
-                .join(User, User.id == Follows.user_following_id)
-                .filter(User.id == g.user.id)
-                # .order_by(Message.timestamp.desc())
-                # .limit(100)
-                # .all()
-        )
-        # SELECT messages.* FROM messages JOIN users WHERE user.id = messages.user_id
-        user_messages = Message.query.join(User).filter(Message.user_id == g.user.id)
-        # SELECT * FROM (following_messages UNION user_messages)
-        # ORDER BY messages.timestamp desc
-        # LIMIT 100;
-        messages = (
-            following_messages
-                .union(user_messages)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all()
-        )
-
-        liked_message_ids = {
-            msg.id for msg in g.user.likes
-        }
-        user_message_ids = {
-            msg.id for msg in g.user.messages
-        }
-        likes_msg_map = {
-            like.message_id: like.id
-            for like in Likes.query.filter(Likes.user_id == g.user.id)
-        }
-        
-        return render_template(
-            'home.html', messages=messages,
-            liked_message_ids=liked_message_ids,
-            user_message_ids=user_message_ids,
-            likes_msg_map=likes_msg_map,
-        )
+        # the user's own messages plus those of everyone they follow
+        author_ids = [g.user.id] + [
+            user_id for (user_id,) in
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == g.user.id)
+        ]
+        ranked = request.args.get('feed') == 'top'
+        next_cursor = None
+        if ranked:
+            messages, next_cursor = ranking.ranked_feed(
+                g.user.id, author_ids, request.args.get('cursor'),
+                page_size=TIMELINE_PAGE_SIZE)
+        else:
+            # newest 100 from each author's shard, merged
+            authors_by_shard = shards.group_by_shard(author_ids)
+            messages = shards.gather(
+                lambda session, shard: (
+                    session.query(Message)
+                    .filter(Message.user_id.in_(authors_by_shard[shard]))
+                    .order_by(Message.timestamp.desc())
+                    .limit(100)),
+                shards=list(authors_by_shard),
+                key=lambda msg: msg.timestamp, limit=100)
+            attach_authors(messages)
+
+        return render_template('home.html', messages=messages,
+                               ranked=ranked, next_cursor=next_cursor,
+                               suggestions=suggested_users(g.user),
+                               **profile_counts(g.user),
+                               **board_context(messages))
 
     else:
         return render_template('home-anon.html')
@@ -464,10 +959,13 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@views.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    if request.endpoint == 'warbler.thumbnail':
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -476,7 +974,231 @@ def add_header(req):
 
 
 # error handler
-@app.errorhandler(404)
+@views.app_errorhandler(404)
 def page_not_found(e):
     # note that we set the 404 status explicitly
     return (render_template('404.html'), 404)
+
+
+@views.app_errorhandler(ShardMoving)
+def shard_moving(e):
+    """A write while the user's rows are moving to another shard."""
+
+    retry_after = str(max(1, current_app.config['SHARD_DIRECTORY_TTL']))
+    message = "Your account is being moved, please try again shortly."
+    if request.is_json or request.path.startswith("/api/"):
+        resp = jsonify({"message": message})
+    else:
+        resp = message
+    return (resp, 503, {"Retry-After": retry_after})
+
+
+##############################################################################
+# Command line tools (run with `flask <command>`)
+
+@click.command()
+@click.option('--kind', 'kinds', multiple=True,
+              help="Only run jobs of this kind (repeatable).")
+@click.option('--burst', is_flag=True,
+              help="Exit once no jobs are runnable instead of polling.")
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help="Seconds to sleep when the queue is empty.")
+@with_appcontext
+def worker(kinds, burst, poll_interval):
+    """Run a background job worker against the app database."""
+
+    processed = jobs.work(kinds=kinds or None, burst=burst,
+                          poll_interval=poll_interval)
+    click.echo(f"Processed {processed} job(s).")
+
+
+@click.command('backfill-tags')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def backfill_tags(batch_size):
+    """Index hashtags and mentions of existing messages."""
+
+    count = sum(tags.backfill(batch_size=batch_size,
+                              session=shards.session(shard))
+                for shard in range(shards.count))
+    click.echo(f"Indexed {count} message(s).")
+
+
+@click.command('export')
+@click.argument('username')
+@click.option('--output', '-o', type=click.File('wb'), default='-',
+              help="File to write to (default stdout).")
+@click.option('--gzip', 'compress', is_flag=True, help="Gzip the output.")
+@with_appcontext
+def export_user(username, output, compress):
+    """Write USERNAME's account as NDJSON."""
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user {username}.")
+
+    body = export.ndjson(export.records(user.id))
+    for chunk in export.gzipped(body) if compress else body:
+        output.write(chunk)
+
+
+@click.command('ingest')
+@click.argument('path', type=click.File('rb'))
+@click.option('--format', type=click.Choice(ingest.FORMATS),
+              help="Input format (default: from the file extension).")
+@click.option('--chunk-size', default=ingest.CHUNK_SIZE, show_default=True)
+@with_appcontext
+def ingest_messages(path, format, chunk_size):
+    """Bulk load messages from a CSV or NDJSON file (- for stdin)."""
+
+    format = format or ('csv' if path.name.endswith('.csv') else 'ndjson')
+    try:
+        report = ingest.ingest(path, format, chunk_size=chunk_size)
+    except ingest.IngestError as e:
+        raise click.ClickException(str(e))
+
+    for error in report.errors:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Inserted {report.inserted}, rejected {report.rejected}.")
+
+
+shards_cli = AppGroup('shards', help="Manage message and like shards.")
+
+
+@shards_cli.command('init')
+@click.option('--import-main', is_flag=True,
+              help="Copy messages and likes from the main database.")
+def shards_init(import_main):
+    """Create the sharded tables on every shard in SHARD_URLS."""
+
+    if not shards.enabled:
+        raise click.ClickException("SHARD_URLS is not set.")
+    shards.create_schemas()
+    if import_main:
+        click.echo(f"Copied {shards.import_main()} message(s).")
+
+
+@shards_cli.command('move')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+def shards_move(user_id, shard):
+    """Move a user's messages and likes to another shard."""
+
+    if not 0 <= shard < shards.count:
+        raise click.BadParameter(f"there are {shards.count} shard(s)")
+    click.echo(f"Copied {shards.move_user(user_id, shard)} message(s); "
+               f"run `flask shards prune` once caches have expired.")
+
+
+@shards_cli.command('rebalance')
+def shards_rebalance():
+    """Move users to their default shard after adding shards."""
+
+    click.echo(f"Moved {shards.rebalance()} user(s); "
+               f"run `flask shards prune` once caches have expired.")
+
+
+@shards_cli.command('prune')
+def shards_prune():
+    """Delete rows left on shards users have moved away from."""
+
+    click.echo(f"Pruned {shards.prune()} user(s).")
+
+
+partitions_cli = AppGroup('partitions',
+                          help="Manage monthly partitions of messages.")
+
+
+@partitions_cli.command('maintain')
+@click.option('--months-ahead', default=partitions.MONTHS_AHEAD,
+              show_default=True)
+@click.option('--archive-after', default=partitions.ARCHIVE_AFTER,
+              show_default=True, help="Archive months older than this.")
+def partitions_maintain(months_ahead, archive_after):
+    """Create upcoming partitions and archive old ones now."""
+
+    created, archived = partitions.maintain(months_ahead, archive_after)
+    click.echo(f"Created {len(created)} partition(s), "
+               f"archived {len(archived)}.")
+
+
+@partitions_cli.command('schedule')
+def partitions_schedule():
+    """Queue the daily maintenance job for `flask worker`."""
+
+    if partitions.schedule() is None:
+        click.echo("Already scheduled.")
+    else:
+        click.echo("Scheduled.")
+
+
+influence_cli = AppGroup('influence',
+                         help="Manage users' influence scores.")
+
+
+@influence_cli.command('compute')
+def influence_compute():
+    """Recompute every user's influence now."""
+
+    users, iterations = influence.compute()
+    click.echo(f"Scored {users} user(s) in {iterations} iteration(s).")
+
+
+@influence_cli.command('schedule')
+def influence_schedule():
+    """Queue the daily recompute job for `flask worker`."""
+
+    if influence.schedule() is None:
+        click.echo("Already scheduled.")
+    else:
+        click.echo("Scheduled.")
+
+
+profiler_cli = AppGroup('profiler', help="Profile requests in production.")
+
+
+@profiler_cli.command('token')
+def profiler_token():
+    """Print a header that has requests profiled."""
+
+    click.echo(f"{PROFILER_HEADER}: {profiler.token()}")
+
+
+slow_queries_cli = AppGroup('slow-queries',
+                            help="Report statements from the slow-query log.")
+
+
+@slow_queries_cli.command('report')
+@click.option('--top', default=20, show_default=True,
+              help="Statements to list.")
+@click.option('--hours', type=float,
+              help="Only queries logged in the last HOURS.")
+@click.option('--plans', is_flag=True,
+              help="Show the plan of each statement's slowest run.")
+@click.option('--json', 'as_json', is_flag=True, help="Print JSON.")
+def slow_queries_report(top, hours, plans, as_json):
+    """List the statements that took the most time, slowest first."""
+
+    since = (datetime.utcnow() - timedelta(hours=hours)) if hours else None
+    ranked = slow_query_log.report(top=top, since=since)
+    if as_json:
+        click.echo(json.dumps(ranked, indent=2))
+        return
+    if not ranked:
+        click.echo("No slow queries logged.")
+        return
+
+    for position, group in enumerate(ranked, 1):
+        endpoints = ", ".join(f"{endpoint or '-'} ({count})"
+                              for endpoint, count
+                              in group["endpoints"].items())
+        click.echo(f"{position}. {group['count']} run(s), "
+                   f"{group['total_ms']:.0f}ms total, "
+                   f"{group['mean_ms']:.0f}ms mean, "
+                   f"{group['max_ms']:.0f}ms max  [{group['fingerprint']}]")
+        click.echo(f"   endpoints: {endpoints}")
+        click.echo(f"   {group['statement']}")
+        if plans and group["plan"]:
+            for line in group["plan"].splitlines():
+                click.echo(f"      {line}")
+        click.echo()
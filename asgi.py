@@ -0,0 +1,9 @@
+"""ASGI entry point: `uvicorn asgi:app`.
+
+Serves the async read endpoints in `asyncapi.py` and everything else
+through the Flask app.
+"""
+
+from asyncapi import create_asgi_app
+
+app = create_asgi_app()
@@ -0,0 +1,243 @@
+"""Async, read-only JSON endpoints served next to the Flask app.
+
+The Flask views hold a worker thread for as long as each query runs.
+The endpoints here run on an event loop instead, querying Postgres with
+asyncpg through a connection pool (via `databases`), so one worker can
+keep many feed and profile reads in flight at once.
+
+Queries are SQLAlchemy Core built from the tables in `models.py`, so the
+schema lives in one place. Everything not routed here falls through to
+the regular Flask app, mounted underneath; serve both with
+
+    uvicorn asgi:app
+
+The HTML pages stay on Flask: the templates depend on its request
+context (g.user, flashed messages, url_for).
+"""
+
+import os
+
+from databases import Database
+from itsdangerous import BadSignature
+from sqlalchemy import func, select, union
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+from app import CURR_USER_KEY, TIMELINE_PAGE_SIZE, create_app
+from models import Follows, Likes, Message, User
+
+messages = Message.__table__
+users = User.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+
+FEED_SIZE = 100
+
+# columns of a message plus the author fields the clients show with it
+MESSAGE_COLUMNS = [
+    messages.c.id,
+    messages.c.text,
+    messages.c.timestamp,
+    messages.c.user_id,
+    users.c.username,
+    users.c.image_url,
+]
+
+
+def serialize_message(row):
+    return {
+        "id": row["id"],
+        "text": row["text"],
+        "timestamp": row["timestamp"].isoformat(),
+        "user": {
+            "id": row["user_id"],
+            "username": row["username"],
+            "image_url": row["image_url"],
+        },
+    }
+
+
+def message_query():
+    """SELECT of MESSAGE_COLUMNS, each message joined to its author."""
+
+    return (select(MESSAGE_COLUMNS)
+            .select_from(messages.join(users,
+                                       users.c.id == messages.c.user_id)))
+
+
+def not_found():
+    return JSONResponse({"message": "Not found"}, status_code=404)
+
+
+def unauthorized():
+    return JSONResponse({"message": "Access unauthorized."}, status_code=401)
+
+
+class AsyncAPI:
+    """The async endpoints, bound to one Flask app and database pool."""
+
+    def __init__(self, flask_app, database):
+        self.flask_app = flask_app
+        self.database = database
+        self._sessions = (flask_app.session_interface
+                          .get_signing_serializer(flask_app))
+
+    def current_user_id(self, request):
+        """Id of the user logged in to the Flask session, or None."""
+
+        cookie = request.cookies.get(self.flask_app.session_cookie_name)
+        if not cookie:
+            return None
+        max_age = self.flask_app.permanent_session_lifetime.total_seconds()
+        try:
+            return self._sessions.loads(cookie, max_age=max_age).get(
+                CURR_USER_KEY)
+        except BadSignature:
+            # tampered or expired; same as Flask, treat as logged out
+            return None
+
+    async def feed(self, request):
+        """Newest messages by the current user and the users they follow."""
+
+        user_id = self.current_user_id(request)
+        if user_id is None:
+            return unauthorized()
+
+        authors = union(
+            select([follows.c.user_being_followed_id])
+            .where(follows.c.user_following_id == user_id),
+            select([users.c.id]).where(users.c.id == user_id),
+        )
+        query = (message_query()
+                 .where(messages.c.user_id.in_(authors))
+                 .order_by(messages.c.timestamp.desc())
+                 .limit(FEED_SIZE))
+
+        rows = await self.database.fetch_all(query)
+        return JSONResponse(
+            {"messages": [serialize_message(row) for row in rows]})
+
+    async def user_show(self, request):
+        """A user's profile, counts and newest messages."""
+
+        user_id = request.path_params['user_id']
+
+        def count(table, column):
+            return (select([func.count()])
+                    .select_from(table)
+                    .where(column == users.c.id)
+                    .as_scalar())
+
+        query = (select([
+            users.c.id,
+            users.c.username,
+            users.c.image_url,
+            users.c.header_image_url,
+            users.c.bio,
+            users.c.location,
+            count(messages, messages.c.user_id).label('messages'),
+            count(follows, follows.c.user_following_id).label('following'),
+            count(follows, follows.c.user_being_followed_id).label('followers'),
+            count(likes, likes.c.user_id).label('likes'),
+        ]).where(users.c.id == user_id))
+
+        user = await self.database.fetch_one(query)
+        if user is None:
+            return not_found()
+
+        rows = await self.database.fetch_all(
+            message_query()
+            .where(messages.c.user_id == user_id)
+            .order_by(messages.c.timestamp.desc())
+            .limit(FEED_SIZE))
+
+        return JSONResponse({
+            "user": dict(user.items()),
+            "messages": [serialize_message(row) for row in rows],
+        })
+
+    async def user_likes(self, request):
+        """Messages a user liked, newest like first, keyset paged.
+
+        Logged in users only, like the Flask page listing them.
+        """
+
+        if self.current_user_id(request) is None:
+            return unauthorized()
+
+        user_id = request.path_params['user_id']
+        if await self.database.fetch_val(
+                select([users.c.id]).where(users.c.id == user_id)) is None:
+            return not_found()
+
+        query = (select(MESSAGE_COLUMNS + [likes.c.id.label('like_id')])
+                 .select_from(likes
+                              .join(messages,
+                                    messages.c.id == likes.c.message_id)
+                              .join(users, users.c.id == messages.c.user_id))
+                 .where(likes.c.user_id == user_id)
+                 .order_by(likes.c.id.desc())
+                 .limit(TIMELINE_PAGE_SIZE + 1))
+        before = request.query_params.get('before')
+        if before and before.isdigit():
+            query = query.where(likes.c.id < int(before))
+
+        rows = await self.database.fetch_all(query)
+        next_before = None
+        if len(rows) > TIMELINE_PAGE_SIZE:
+            rows = rows[:TIMELINE_PAGE_SIZE]
+            next_before = rows[-1]["like_id"]
+
+        return JSONResponse({
+            "messages": [serialize_message(row) for row in rows],
+            "next_before": next_before,
+        })
+
+    async def message_show(self, request):
+        """A single message with its author."""
+
+        row = await self.database.fetch_one(
+            message_query()
+            .where(messages.c.id == request.path_params['message_id']))
+        if row is None:
+            return not_found()
+        return JSONResponse({"message": serialize_message(row)})
+
+
+def create_asgi_app(config=None):
+    """Build the async endpoints with the Flask app mounted underneath.
+
+    `config` is passed on to `create_app`. ASYNC_POOL_MIN_SIZE and
+    ASYNC_POOL_MAX_SIZE size the asyncpg pool (one per worker process).
+    """
+
+    flask_app = create_app(config)
+    if flask_app.config['SHARD_URLS']:
+        # the queries here read messages and likes from the main database
+        raise RuntimeError("The async API does not support SHARD_URLS yet.")
+
+    flask_app.config.setdefault(
+        'ASYNC_POOL_MIN_SIZE', int(os.environ.get('ASYNC_POOL_MIN_SIZE', 2)))
+    flask_app.config.setdefault(
+        'ASYNC_POOL_MAX_SIZE', int(os.environ.get('ASYNC_POOL_MAX_SIZE', 20)))
+
+    database = Database(flask_app.config['SQLALCHEMY_DATABASE_URI'],
+                        min_size=flask_app.config['ASYNC_POOL_MIN_SIZE'],
+                        max_size=flask_app.config['ASYNC_POOL_MAX_SIZE'])
+    api = AsyncAPI(flask_app, database)
+
+    routes = [
+        Route('/api/feed', api.feed),
+        Route('/api/users/{user_id:int}', api.user_show),
+        Route('/api/users/{user_id:int}/likes', api.user_likes),
+        Route('/api/messages/{message_id:int}', api.message_show),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ]
+
+    asgi_app = Starlette(routes=routes,
+                         on_startup=[database.connect],
+                         on_shutdown=[database.disconnect])
+    asgi_app.state.flask_app = flask_app
+    return asgi_app
@@ -0,0 +1,173 @@
+"""Username and email availability, answered mostly from memory.
+
+Each worker keeps a Bloom filter of every username and email in
+`users`. A name the filter has never seen is free without asking the
+database; one it may have seen is looked up, since the filter answers
+"maybe" for about AVAILABILITY_FALSE_POSITIVE_RATE of free names too.
+`signup` checks before hashing the password, so a taken name costs no
+bcrypt round.
+
+The filter is built on first use. Users this worker inserts or renames
+are added as they are flushed; users created by other workers are
+picked up by an indexed scan of the newest ids at most every
+AVAILABILITY_REFRESH_INTERVAL seconds, so until then those names may
+still be reported free (signup is still guarded by the unique indexes).
+Names freed by deletes or renames stay "maybe" until the next full
+rebuild, every AVAILABILITY_REBUILD_INTERVAL seconds or once the filter
+holds more names than it was sized for.
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func
+
+from models import User, db
+
+FIELDS = ("username", "email")
+
+# ids are handed out before commit, so a refresh rescans this many below
+# the highest seen for users committed out of order
+REFRESH_OVERLAP = 1000
+
+
+class BloomFilter:
+    """Bloom filter over strings, sized for `capacity` items."""
+
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-self.capacity
+                                     * math.log(false_positive_rate)
+                                     / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # k positions from two halves of one digest (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """Add `item`; return whether it was (definitely) new."""
+
+        new = False
+        for position in self._positions(item):
+            bit = 1 << (position & 7)
+            if not self.bits[position >> 3] & bit:
+                self.bits[position >> 3] |= bit
+                new = True
+        self.count += new
+        return new
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class _Names:
+    """Per-app filter and when it was last built and refreshed."""
+
+    def __init__(self, app):
+        self.false_positive_rate = (
+            app.config['AVAILABILITY_FALSE_POSITIVE_RATE'])
+        self.refresh_interval = app.config['AVAILABILITY_REFRESH_INTERVAL']
+        self.rebuild_interval = app.config['AVAILABILITY_REBUILD_INTERVAL']
+        self.bloom = None
+        self.max_id = 0
+        self.built_at = self.refreshed_at = 0
+        # reentrant: queries made holding it may autoflush new users,
+        # whose insert events add them
+        self.lock = threading.RLock()
+
+
+class Availability:
+    """Answers whether usernames and emails are free; bind with
+    `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault('AVAILABILITY_FALSE_POSITIVE_RATE', 0.01)
+        app.config.setdefault('AVAILABILITY_REFRESH_INTERVAL', float(
+            os.environ.get('AVAILABILITY_REFRESH_INTERVAL', 5)))
+        app.config.setdefault('AVAILABILITY_REBUILD_INTERVAL', 3600)
+
+        app.extensions['availability'] = _Names(app)
+
+    def _names(self):
+        return current_app.extensions['availability']
+
+    def _filter(self):
+        """The filter, built or refreshed first if it is due."""
+
+        names = self._names()
+        now = time.monotonic()
+        with names.lock:
+            if (names.bloom is None
+                    or now - names.built_at >= names.rebuild_interval
+                    or names.bloom.count > names.bloom.capacity):
+                self._build(names)
+                names.built_at = names.refreshed_at = now
+            elif now - names.refreshed_at >= names.refresh_interval:
+                self._add_rows(names,
+                               User.id > names.max_id - REFRESH_OVERLAP)
+                names.refreshed_at = now
+            return names.bloom
+
+    def _build(self, names):
+        count = db.session.query(func.count(User.id)).scalar()
+        # room to grow before the next rebuild
+        names.bloom = BloomFilter(2 * len(FIELDS) * max(count, 1000),
+                                  names.false_positive_rate)
+        names.max_id = 0
+        self._add_rows(names)
+
+    def _add_rows(self, names, *criteria):
+        rows = (db.session.query(User.id, User.username, User.email)
+                .filter(*criteria)
+                .yield_per(10_000))
+        for user_id, username, email in rows:
+            names.bloom.add(f"username:{username}")
+            names.bloom.add(f"email:{email}")
+            names.max_id = max(names.max_id, user_id)
+
+    def add(self, field, value):
+        """Note that `field` (username or email) `value` is in use."""
+
+        names = self._names()
+        with names.lock:
+            if names.bloom is not None:
+                names.bloom.add(f"{field}:{value}")
+
+    def is_available(self, field, value):
+        """Whether no user has `field` (username or email) `value`."""
+
+        if field not in FIELDS:
+            raise ValueError(f"Unknown field {field!r}")
+        if f"{field}:{value}" not in self._filter():
+            return True
+        return not (db.session.query(User.id)
+                    .filter(getattr(User, field) == value)
+                    .first())
+
+    def taken(self, **values):
+        """Fields among `values` (username=..., email=...) already in use."""
+
+        return [field for field, value in values.items()
+                if not self.is_available(field, value)]
+
+
+availability = Availability()
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+def _note_names(mapper, connection, user):
+    if has_app_context() and 'availability' in current_app.extensions:
+        for field in FIELDS:
+            availability.add(field, getattr(user, field))
@@ -0,0 +1,135 @@
+"""Compare the home feed served by one sync worker and one async worker.
+
+Starts each server on a free port with a single worker process, then
+keeps N requests in flight for a few seconds at several concurrency
+levels and reports throughput and latency percentiles:
+
+    flask  gunicorn, 1 sync worker        GET /          (HTML feed)
+    async  uvicorn, 1 worker              GET /api/feed  (JSON feed)
+
+Both run the same feed query against the development database; the
+Flask page also renders its template. Needs a seeded database
+(`python seed.py`). Run from the project root:
+
+    python benchmarks/bench_async.py
+"""
+
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import CURR_USER_KEY, create_app  # noqa: E402
+from models import Follows, User, db  # noqa: E402
+
+CONCURRENCY = [1, 16, 64]
+DURATION = 5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def script(name):
+    """Path of a console script installed next to this interpreter."""
+
+    return os.path.join(os.path.dirname(sys.executable), name)
+
+
+def session_cookie():
+    """A Flask session cookie for the seeded user following the most."""
+
+    app = create_app()
+    with app.app_context():
+        user_id = (db.session.query(User.id)
+                   .join(Follows, Follows.user_following_id == User.id)
+                   .group_by(User.id)
+                   .order_by(db.func.count().desc())
+                   .limit(1)
+                   .scalar())
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"{app.session_cookie_name}={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+async def fetch(port, path, cookie):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n"
+                 f"Cookie: {cookie}\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    status = await reader.readline()
+    await reader.read()
+    writer.close()
+    if b" 200 " not in status:
+        raise RuntimeError(f"{path}: {status!r}")
+
+
+async def load(port, path, cookie, concurrency):
+    """Keep `concurrency` requests in flight; return per-request latencies."""
+
+    latencies = []
+    deadline = time.perf_counter() + DURATION
+
+    async def client():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await fetch(port, path, cookie)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies
+
+
+def wait_for(port, proc):
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError("server exited")
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def main():
+    cookie = session_cookie()
+    servers = [
+        ("flask", "/", lambda port: [
+            script("gunicorn"), "--workers", "1",
+            "--bind", f"127.0.0.1:{port}", "wsgi:app"]),
+        ("async", "/api/feed", lambda port: [
+            script("uvicorn"), "--workers", "1",
+            "--port", str(port), "--log-level", "warning", "asgi:app"]),
+    ]
+
+    for name, path, command in servers:
+        port = free_port()
+        proc = subprocess.Popen(command(port), cwd=ROOT,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        try:
+            wait_for(port, proc)
+            asyncio.run(load(port, path, cookie, 1))  # warm up
+            for concurrency in CONCURRENCY:
+                latencies = sorted(asyncio.run(
+                    load(port, path, cookie, concurrency)))
+                p99 = latencies[int(len(latencies) * 0.99) - 1]
+                print(f"{name:6} c={concurrency:<3} "
+                      f"{len(latencies) / DURATION:7.0f} req/s  "
+                      f"p50 {statistics.median(latencies) * 1000:6.1f}ms  "
+                      f"p99 {p99 * 1000:6.1f}ms")
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
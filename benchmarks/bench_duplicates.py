@@ -0,0 +1,73 @@
+"""Measure near-duplicate lookups against a full index.
+
+Fills an index with DUPLICATES_MAX_ENTRIES (default 50,000) generated
+messages, a share of them copies of a few spam texts, then reports
+p50/p99 latency of a lookup next to one exact pairwise Jaccard scan of
+the same messages. Run from the project root:
+
+    python benchmarks/bench_duplicates.py
+"""
+
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from duplicates import Index, shingles  # noqa: E402
+
+WORDS = ("the a to and of in is it you that he was for on are with as his "
+         "they be at one have this from or had by hot word but what some we "
+         "can out other were all there when up use your how said an each "
+         "she which do their time if will way about many then them write "
+         "would like so these her long make thing see him two has look "
+         "more day could go come did number sound no most people my over "
+         "know water than call first who may down side been now find").split()
+
+ENTRIES = 50_000
+LOOKUPS = 2_000
+
+
+def sentence(words):
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+
+def main():
+    random.seed(0)
+    spam = [sentence(12) for _ in range(20)]
+    texts = [random.choice(spam) + f" {i}" if i % 10 == 0
+             else sentence(random.randint(4, 20))
+             for i in range(ENTRIES)]
+
+    now = datetime.utcnow()
+    index = Index(timedelta(minutes=10), ENTRIES)
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        index.add(i, i % 1000, now, text)
+    print(f"indexed {ENTRIES} messages in "
+          f"{time.perf_counter() - start:.1f}s")
+
+    queries = [random.choice(spam) + " again" if i % 2
+               else sentence(10) for i in range(LOOKUPS)]
+    latencies = []
+    for text in queries:
+        start = time.perf_counter()
+        index.matches(text, 0.8)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"lsh lookup       p50 {statistics.median(latencies) * 1e6:7.0f}us"
+          f"  p99 {p99 * 1e6:7.0f}us")
+
+    sets = [shingles(text) for text in texts]
+    start = time.perf_counter()
+    query = shingles(queries[1])
+    [len(query & other) / len(query | other) for other in sets]
+    print(f"pairwise scan    {(time.perf_counter() - start) * 1e6:7.0f}us")
+
+
+if __name__ == "__main__":
+    main()
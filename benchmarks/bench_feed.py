@@ -0,0 +1,99 @@
+"""Measure the ranked home feed.
+
+First the scoring alone: a NumPy pass over pools of candidates against
+the same formula in a Python loop. Then whole pages of
+`ranking.ranked_feed` for the seeded user following the most, with the
+window stretched to cover the seed data, reporting p50/p99 latency with
+and without the like queries. Needs a seeded database
+(`python seed.py`). Run from the project root:
+
+    python benchmarks/bench_feed.py
+"""
+
+import math
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ranking  # noqa: E402
+from app import create_app  # noqa: E402
+from models import Follows, Message, User, db  # noqa: E402
+
+POOLS = [2_000, 20_000, 200_000]
+RUNS = 200
+
+
+def score_loop(timestamps, at, half_life, affinity, engagement):
+    now = (at - ranking.EPOCH).total_seconds()
+    return [2 ** (-max((now - ts) / 3600, 0) / half_life)
+            * (1 + math.log1p(aff) + 0.5 * math.log1p(eng))
+            for ts, aff, eng in zip(timestamps, affinity, engagement)]
+
+
+def bench_scoring():
+    rng = np.random.default_rng(0)
+    at = datetime.utcnow()
+    now = (at - ranking.EPOCH).total_seconds()
+    for size in POOLS:
+        ids = np.arange(size, dtype=np.int64)
+        timestamps = now - rng.uniform(0, 7 * 86400, size)
+        affinity = rng.poisson(2, size).astype(float)
+        engagement = rng.poisson(5, size).astype(float)
+
+        start = time.perf_counter()
+        ranking.rank(ids, ranking.score(timestamps, at, 24, affinity,
+                                        engagement, 1.0, 0.5))
+        vectorized = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores = score_loop(timestamps.tolist(), at, 24, affinity.tolist(),
+                            engagement.tolist())
+        sorted(zip(scores, ids.tolist()), reverse=True)
+        loop = time.perf_counter() - start
+
+        print(f"score {size:>7} candidates  numpy {vectorized * 1000:7.2f}ms  "
+              f"python {loop * 1000:7.2f}ms")
+
+
+def bench_feed(app):
+    with app.app_context():
+        user_id = (db.session.query(User.id)
+                   .join(Follows, Follows.user_following_id == User.id)
+                   .group_by(User.id)
+                   .order_by(db.func.count().desc())
+                   .limit(1)
+                   .scalar())
+        following = [followed for (followed,) in (
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id))]
+        oldest = db.session.query(db.func.min(Message.timestamp)).scalar()
+        app.config['FEED_WINDOW'] = (datetime.utcnow() - oldest).days + 1
+
+        for label, budget in (("with likes", 10_000), ("budget 0", 0)):
+            app.config['FEED_BUDGET_MS'] = budget
+            ranking.ranked_feed(user_id, following + [user_id])  # warm up
+            latencies = []
+            for _ in range(RUNS):
+                start = time.perf_counter()
+                ranking.ranked_feed(user_id, following + [user_id])
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            p99 = latencies[int(len(latencies) * 0.99) - 1]
+            print(f"feed following {len(following)} ({label:10})  "
+                  f"p50 {statistics.median(latencies) * 1000:6.1f}ms  "
+                  f"p99 {p99 * 1000:6.1f}ms")
+
+
+def main():
+    bench_scoring()
+    bench_feed(create_app())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Time the influence computation on a large synthetic follow graph.
+
+Generates USERS users and EDGES follows, with who gets followed skewed
+towards a few popular accounts as on a real network, then times
+building the sparse matrix and running the power iteration and reports
+peak memory. The database isn't involved; `flask influence compute`
+times a real run, COPY in and out included. Run from the project root:
+
+    python benchmarks/bench_influence.py [USERS] [EDGES]
+"""
+
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from influence import pagerank  # noqa: E402
+
+USERS = 2_000_000
+EDGES = 20_000_000
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    edges = int(sys.argv[2]) if len(sys.argv) > 2 else EDGES
+
+    rng = np.random.default_rng(0)
+    followers = rng.integers(0, users, edges)
+    # Zipf-ish: low positions are followed far more often
+    followed = np.minimum(rng.pareto(1.2, edges) * users / 100,
+                          users - 1).astype(np.int64)
+
+    start = time.perf_counter()
+    rank, iterations = pagerank(users, followers, followed)
+    seconds = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{users} users, {edges} follows: {seconds:.1f}s, "
+          f"{iterations} iterations, peak RSS {peak:.0f}MB")
+    print(f"top score {rank.max() * users:.1f}, sum {rank.sum():.6f}")
+
+
+if __name__ == "__main__":
+    main()
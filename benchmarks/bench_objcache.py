@@ -0,0 +1,75 @@
+"""Measure profile pages with the object cache on and off.
+
+Requests /users/<id> for the seeded users in turn, logged in as the
+first, with CACHE_ENABLED off and then on (after one warm-up pass), and
+reports p50/p99 latency, statements per page and the cache's hit rate.
+Needs a seeded database (`python seed.py`). Run from the project root:
+
+    python benchmarks/bench_objcache.py
+"""
+
+import os
+import statistics
+import sys
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import CURR_USER_KEY, create_app  # noqa: E402
+from models import User, db  # noqa: E402
+from objcache import object_cache  # noqa: E402
+
+PASSES = 5
+
+
+def run(enabled):
+    app = create_app({'CACHE_ENABLED': enabled, 'RATELIMIT_ENABLED': False})
+    with app.app_context():
+        user_ids = [user_id for (user_id,) in
+                    db.session.query(User.id).order_by(User.id)]
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_ids[0]
+
+    statements = []
+
+    def record(*args):
+        statements.append(args)
+
+    for user_id in user_ids:  # warm up
+        client.get(f"/users/{user_id}")
+
+    latencies = []
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        for _ in range(PASSES):
+            for user_id in user_ids:
+                start = time.perf_counter()
+                client.get(f"/users/{user_id}")
+                latencies.append(time.perf_counter() - start)
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"cache {'on ' if enabled else 'off'}  "
+          f"p50 {statistics.median(latencies) * 1000:6.2f}ms  "
+          f"p99 {p99 * 1000:6.2f}ms  "
+          f"{len(statements) / len(latencies):.1f} statements/page")
+    if enabled:
+        with app.app_context():
+            stats = object_cache.stats()
+        hits = stats.get("users.local_hits", 0)
+        print(f"users: {hits} hits, {stats.get('users.misses', 0)} misses")
+
+
+def main():
+    run(False)
+    run(True)
+
+
+if __name__ == "__main__":
+    main()
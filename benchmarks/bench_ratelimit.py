@@ -0,0 +1,35 @@
+"""Measure the per-request cost of the in-memory token bucket.
+
+Run from the project root:
+
+    python benchmarks/bench_ratelimit.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import MemoryBackend  # noqa: E402
+
+N = 200_000
+
+
+def main():
+    backend = MemoryBackend()
+
+    # one hot key: the common case of a client under its limit
+    hot = timeit.timeit(lambda: backend.consume("login:ip:1", 1e9, 1e9), number=N)
+
+    # many distinct keys: a spread of clients filling the table
+    keys = [f"login:ip:{i}" for i in range(10_000)]
+    spread = timeit.timeit(
+        lambda: [backend.consume(key, 1.0, 10) for key in keys], number=N // len(keys))
+
+    print(f"hot key:       {hot / N * 1e6:.2f} us/consume")
+    print(f"10k keys:      {spread / N * 1e6:.2f} us/consume")
+
+
+if __name__ == "__main__":
+    main()
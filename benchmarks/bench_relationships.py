@@ -0,0 +1,81 @@
+"""Compare batch relationship lookups with the per-pair model methods.
+
+For the seeded user following the most, asks whether they follow and
+are followed by each of up to 300 users, first through
+`User.is_following` / `User.is_followed_by` (loading both relationships
+once, as a page rendering the flags does) and then through one
+`User.relationships` query, reporting time and statements run. Needs a
+seeded database (`python seed.py`). Run from the project root:
+
+    python benchmarks/bench_relationships.py
+"""
+
+import os
+import statistics
+import sys
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from models import Follows, User, db  # noqa: E402
+
+IDS = 300
+RUNS = 50
+
+
+def per_pair(user_id, other_ids):
+    user = User.query.get(user_id)
+    others = User.query.filter(User.id.in_(other_ids)).all()
+    return {other.id: (user.is_following(other), user.is_followed_by(other))
+            for other in others}
+
+
+def batch(user_id, other_ids):
+    return User.relationships(user_id, other_ids)
+
+
+def main():
+    app = create_app()
+    statements = []
+
+    def record(*args):
+        statements.append(args)
+
+    with app.app_context():
+        user_id = (db.session.query(User.id)
+                   .join(Follows, Follows.user_following_id == User.id)
+                   .group_by(User.id)
+                   .order_by(db.func.count().desc())
+                   .limit(1)
+                   .scalar())
+        other_ids = [other_id for (other_id,)
+                     in db.session.query(User.id).limit(IDS)]
+
+        results = []
+        for name, lookup in (("per pair", per_pair), ("batch", batch)):
+            timings = []
+            for _ in range(RUNS):
+                # each run starts with an empty session
+                db.session.expunge_all()
+                del statements[:]
+                event.listen(Engine, "before_cursor_execute", record)
+                start = time.perf_counter()
+                try:
+                    result = lookup(user_id, other_ids)
+                finally:
+                    timings.append(time.perf_counter() - start)
+                    event.remove(Engine, "before_cursor_execute", record)
+            results.append(result)
+            print(f"{name:8}  {len(other_ids)} users  "
+                  f"{statistics.median(timings) * 1000:6.2f}ms  "
+                  f"{len(statements)} statements")
+
+        assert results[0] == results[1]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Measure how long a fresh process takes to build the app and serve.
+
+Each sample runs in a new interpreter so nothing is already imported.
+Compares production and development settings, with and without
+`preload()` (what a forked gunicorn worker inherits from the master).
+
+Run from the project root:
+
+    python benchmarks/bench_startup.py
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 5
+
+SCRIPT = """
+import json, time
+start = time.perf_counter()
+from app import create_app, preload
+app = create_app()
+built = time.perf_counter()
+if {preload}:
+    preload(app)
+ready = time.perf_counter()
+app.test_client().get('/login')
+served = time.perf_counter()
+print(json.dumps({{"create_app": built - start, "preload": ready - built,
+                  "first_request": served - ready}}))
+"""
+
+
+def sample(env, preload):
+    out = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(preload=preload)],
+        cwd=ROOT, env={**os.environ, **env}, check=True,
+        capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    cases = [
+        ("production", {"FLASK_ENV": "production"}, False),
+        ("production+preload", {"FLASK_ENV": "production"}, True),
+        ("development", {"FLASK_ENV": "development"}, False),
+    ]
+    for name, env, preload in cases:
+        runs = [sample(env, preload) for _ in range(RUNS)]
+        timings = " ".join(
+            f"{key}={statistics.median(run[key] for run in runs) * 1000:.0f}ms"
+            for key in runs[0])
+        print(f"{name:20} {timings}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Measure time to first byte and peak memory of the user listing.
+
+Adds USERS throwaway users (removed again afterwards), then requests
+/users over HTTP from a local server twice, each in a fresh process:
+once rendered whole with render_template from `query.all()`, as the
+view used to, and once streamed. For each it reports time to first
+byte, total time and how much the process's peak RSS grew while
+serving the page. Run from the project root:
+
+    python benchmarks/bench_streaming.py [USERS]
+"""
+
+import http.client
+import io
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from flask import render_template
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from models import User, db  # noqa: E402
+
+USERS = 20_000
+PREFIX = "bench-stream-"
+
+
+def add_users(count):
+    data = io.StringIO()
+    for i in range(count):
+        data.write(f"{PREFIX}{i}\t{PREFIX}{i}@example.com\tunused\n")
+    data.seek(0)
+    with db.engine.begin() as conn:
+        conn.connection.cursor().copy_expert(
+            "COPY users (username, email, password) FROM STDIN", data)
+
+
+def remove_users():
+    with db.engine.begin() as conn:
+        conn.execute(User.__table__.delete()
+                     .where(User.username.like(f"{PREFIX}%")))
+
+
+def buffered_users():
+    """The listing as it was: every user loaded, then rendered whole."""
+
+    users = User.query.order_by(User.influence.desc(), User.id).all()
+    return render_template('users/index.html', users=users)
+
+
+def measure(mode):
+    """Serve one page in this process and print its numbers."""
+
+    app = create_app({'RATELIMIT_ENABLED': False, 'STREAM_GZIP': False})
+    app.add_url_rule('/bench/buffered', 'buffered', buffered_users)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    path = "/users" if mode == "streamed" else "/bench/buffered"
+    # warm up the templates and the connection pool
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+    conn.request("GET", "/users?q=nobody")
+    conn.getresponse().read()
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    size = len(resp.read1(1))
+    first_byte = time.perf_counter() - start
+    # read and drop, so only the server side shows in the peak RSS
+    while True:
+        chunk = resp.read1(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+    total = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f"{mode:8}  TTFB {first_byte * 1000:7.1f}ms  "
+          f"total {total * 1000:7.1f}ms  {size / 1e6:5.1f}MB sent  "
+          f"peak RSS +{(peak - baseline) / 1024:.0f}MB")
+    server.shutdown()
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--measure":
+        measure(sys.argv[2])
+        return
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    app = create_app()
+    with app.app_context():
+        remove_users()
+        add_users(count)
+        try:
+            print(f"/users with {User.query.count()} users")
+            # separate processes, as peak RSS never goes back down
+            for mode in ("buffered", "streamed"):
+                subprocess.run([sys.executable, __file__, "--measure", mode],
+                               check=True)
+        finally:
+            remove_users()
+
+
+if __name__ == "__main__":
+    main()
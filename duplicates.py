@@ -0,0 +1,270 @@
+"""Near-duplicate detection for new messages.
+
+Spam waves post slightly varied copies of one text. Each worker keeps a
+MinHash signature of every message posted in the last DUPLICATES_WINDOW
+seconds, indexed by locality-sensitive hashing: the signature is cut
+into BANDS bands and messages sharing any band land in the same bucket.
+A new message is compared only with (up to MAX_CANDIDATES of) the
+messages in its buckets, so a check costs one signature, a few dict
+lookups and one vectorized comparison however many messages are
+indexed.
+
+Texts are compared as sets of SHINGLE-character shingles of their
+lowercased words. A message is a near-duplicate of another when the
+signatures estimate their Jaccard similarity at DUPLICATES_THRESHOLD or
+more. `messages_add` logs a post with near-duplicates and refuses one
+with DUPLICATES_THROTTLE or more of them.
+
+Entries leave the index once they are older than the window, and the
+oldest go first when it holds DUPLICATES_MAX_ENTRIES, so memory is
+bounded either way. Messages this worker posts are added as they are
+committed; those posted through other workers are picked up by an
+indexed scan of the window at most every DUPLICATES_REFRESH_INTERVAL
+seconds.
+"""
+
+import itertools
+import os
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+
+from models import Message
+from sharding import shards
+
+SHINGLE = 5
+PERMUTATIONS = 64
+BANDS = 16
+ROWS = PERMUTATIONS // BANDS
+
+# bucket members compared per lookup: plenty to tell a spam wave, and it
+# keeps lookups cheap however big the wave grows
+MAX_CANDIDATES = 100
+
+# multiply-shift hash functions standing in for random permutations;
+# fixed so signatures are comparable across workers and restarts
+_random = np.random.RandomState(20200501)
+_A = _random.randint(1, 2 ** 63, PERMUTATIONS, dtype=np.uint64) | 1
+_B = _random.randint(0, 2 ** 63, PERMUTATIONS, dtype=np.uint64)
+
+_NON_WORD = re.compile(r"\W+")
+
+
+def shingles(text):
+    """The set of SHINGLE-character shingles of `text`, normalized."""
+
+    normalized = _NON_WORD.sub(" ", text.lower()).strip()
+    if len(normalized) <= SHINGLE:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + SHINGLE]
+            for i in range(len(normalized) - SHINGLE + 1)}
+
+
+def signature(text):
+    """MinHash signature of `text` (PERMUTATIONS values), or None if it
+    has no words."""
+
+    hashes = np.array([zlib.crc32(shingle.encode())
+                       for shingle in shingles(text)], dtype=np.uint64)
+    if not len(hashes):
+        return None
+    # uint64 arithmetic wraps, as multiply-shift hashing expects
+    return np.min((_A[:, None] * hashes[None, :] + _B[:, None]) >> 32,
+                  axis=1)
+
+
+def band_keys(sig):
+    return [(band, sig[band * ROWS:(band + 1) * ROWS].tobytes())
+            for band in range(BANDS)]
+
+
+def similarity(sig, other):
+    """Jaccard similarity estimated from two signatures."""
+
+    return float(np.count_nonzero(sig == other)) / PERMUTATIONS
+
+
+class _Entry:
+    __slots__ = ("message_id", "user_id", "timestamp", "signature", "keys")
+
+    def __init__(self, message_id, user_id, timestamp, sig):
+        self.message_id = message_id
+        self.user_id = user_id
+        self.timestamp = timestamp
+        self.signature = sig
+        self.keys = band_keys(sig)
+
+
+class Index:
+    """LSH index of the signatures of recent messages."""
+
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        # oldest first
+        self.entries = deque()
+        self.by_id = {}
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, message_id, user_id, timestamp, text):
+        """Index a message; return whether it was new."""
+
+        if message_id in self.by_id:
+            return False
+        sig = signature(text)
+        if sig is None:
+            return False
+        entry = _Entry(message_id, user_id, timestamp, sig)
+        if self.entries and timestamp < self.entries[-1].timestamp:
+            # picked up late from another worker; keep the deque in order
+            # so expiry can stop at the first entry inside the window
+            position = len(self.entries)
+            while (position
+                   and self.entries[position - 1].timestamp > timestamp):
+                position -= 1
+            self.entries.insert(position, entry)
+        else:
+            self.entries.append(entry)
+        self.by_id[message_id] = entry
+        for key in entry.keys:
+            self.buckets.setdefault(key, set()).add(message_id)
+        while len(self.by_id) > self.max_entries:
+            self._remove(self.entries.popleft())
+        return True
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self.entries and self.entries[0].timestamp < cutoff:
+            self._remove(self.entries.popleft())
+
+    def _remove(self, entry):
+        del self.by_id[entry.message_id]
+        for key in entry.keys:
+            bucket = self.buckets[key]
+            bucket.discard(entry.message_id)
+            if not bucket:
+                del self.buckets[key]
+
+    def matches(self, text, threshold):
+        """(message id, user id, similarity) of the indexed messages near
+        `text`, most similar first; at most MAX_CANDIDATES are
+        compared."""
+
+        sig = signature(text)
+        if sig is None:
+            return []
+        candidates = set()
+        for key in band_keys(sig):
+            bucket = self.buckets.get(key, ())
+            candidates.update(itertools.islice(
+                bucket, MAX_CANDIDATES - len(candidates)))
+            if len(candidates) >= MAX_CANDIDATES:
+                break
+        if not candidates:
+            return []
+        entries = [self.by_id[message_id] for message_id in candidates]
+        # a spam wave fills a bucket: score its members in one pass
+        scores = (np.count_nonzero(
+            np.stack([entry.signature for entry in entries]) == sig, axis=1)
+            / PERMUTATIONS)
+        found = [(entries[i].message_id, entries[i].user_id, scores[i])
+                 for i in np.flatnonzero(scores >= threshold).tolist()]
+        found.sort(key=lambda match: -match[2])
+        return [(message_id, user_id, float(score))
+                for message_id, user_id, score in found]
+
+
+class _Recent:
+    """Per-app index and when it was last refreshed."""
+
+    def __init__(self, app):
+        self.window = timedelta(seconds=app.config['DUPLICATES_WINDOW'])
+        self.max_entries = app.config['DUPLICATES_MAX_ENTRIES']
+        self.refresh_interval = app.config['DUPLICATES_REFRESH_INTERVAL']
+        self.index = None
+        self.refreshed_at = 0
+        # newest timestamp seen by a refresh
+        self.seen_until = None
+        self.lock = threading.RLock()
+
+
+class Duplicates:
+    """Finds near-duplicates of new messages; bind with `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault('DUPLICATES_WINDOW', 600)
+        app.config.setdefault('DUPLICATES_MAX_ENTRIES', 50_000)
+        app.config.setdefault('DUPLICATES_THRESHOLD', 0.8)
+        app.config.setdefault('DUPLICATES_THROTTLE', 3)
+        app.config.setdefault('DUPLICATES_REFRESH_INTERVAL', float(
+            os.environ.get('DUPLICATES_REFRESH_INTERVAL', 5)))
+        app.extensions['duplicates'] = _Recent(app)
+
+    def _recent(self):
+        return current_app.extensions['duplicates']
+
+    def _index(self):
+        """The app's index, expired and refreshed as due."""
+
+        recent = self._recent()
+        now = datetime.utcnow()
+        with recent.lock:
+            if recent.index is None:
+                recent.index = Index(recent.window, recent.max_entries)
+            if (time.monotonic() - recent.refreshed_at
+                    >= recent.refresh_interval):
+                self._refresh(recent, now)
+            recent.index.expire(now)
+            return recent.index
+
+    def _refresh(self, recent, now):
+        # timestamps are set before commit, so rescan a little overlap
+        since = now - recent.window
+        if recent.seen_until is not None:
+            since = max(since, recent.seen_until - timedelta(seconds=30))
+        rows = shards.gather(
+            lambda session, shard: (
+                session.query(Message.id, Message.user_id, Message.timestamp,
+                              Message.text)
+                .filter(Message.timestamp > since)
+                .order_by(Message.timestamp.desc())
+                .limit(recent.max_entries)),
+            key=lambda row: row.timestamp, limit=recent.max_entries)
+        for row in reversed(rows):
+            recent.index.add(row.id, row.user_id, row.timestamp, row.text)
+        if rows and (recent.seen_until is None
+                     or rows[0].timestamp > recent.seen_until):
+            recent.seen_until = rows[0].timestamp
+        recent.refreshed_at = time.monotonic()
+
+    def check(self, text):
+        """(message id, user id, similarity) of recent near-duplicates of
+        `text`, most similar first."""
+
+        threshold = current_app.config['DUPLICATES_THRESHOLD']
+        with self._recent().lock:
+            return self._index().matches(text, threshold)
+
+    def throttled(self, matches):
+        """Whether a post with `matches` should be refused."""
+
+        throttle = current_app.config['DUPLICATES_THROTTLE']
+        return bool(throttle) and len(matches) >= throttle
+
+    def add(self, message_id, user_id, text):
+        """Index a message just committed."""
+
+        with self._recent().lock:
+            self._index().add(message_id, user_id, datetime.utcnow(), text)
+
+
+duplicates = Duplicates()
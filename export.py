@@ -0,0 +1,128 @@
+"""Export of a user's account as newline-delimited JSON.
+
+One JSON object per line, each with a "type":
+
+    user        the profile (no password hash)
+    message     id, text, timestamp; archived months first
+    like        id, message_id
+    following   id, username of each user they follow
+    follower    id, username of each user following them
+
+Rows are read through server-side cursors BATCH_SIZE at a time and
+written out as they arrive, so memory stays flat however big the
+account is (archived messages are read a month at a time). `records`
+picks the databases up front and returns a generator that needs no app
+context, so it can back a streamed response directly; the connections
+it holds stay open until it has been read to the end or closed.
+"""
+
+import json
+import zlib
+
+from sqlalchemy import select
+
+from models import Follows, Likes, Message, User, db
+from partitions import iter_archived
+from sharding import shards
+
+BATCH_SIZE = 1000
+
+# bytes of output handed to the server at a time
+CHUNK_SIZE = 64 * 1024
+
+USERS = User.__table__
+MESSAGES = Message.__table__
+LIKES = Likes.__table__
+FOLLOWS = Follows.__table__
+
+PROFILE_COLUMNS = [USERS.c.id, USERS.c.username, USERS.c.email,
+                   USERS.c.image_url, USERS.c.header_image_url,
+                   USERS.c.bio, USERS.c.location]
+
+
+def _stream(engine, query, batch_size):
+    """Rows of `query`, fetched `batch_size` at a time from a
+    server-side cursor."""
+
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+
+def records(user_id, batch_size=BATCH_SIZE):
+    """Generator of the records of `user_id`'s account, as dicts."""
+
+    main = db.engine
+    shard = shards.engine_for(user_id)
+    return _records(user_id, main, shard, batch_size)
+
+
+def _records(user_id, main, shard, batch_size):
+    with main.connect() as conn:
+        profile = conn.execute(select(PROFILE_COLUMNS)
+                               .where(USERS.c.id == user_id)).first()
+    if profile is None:
+        return
+    yield {"type": "user", **profile}
+
+    with main.connect() as conn:
+        for row in iter_archived(conn, user_id):
+            yield {"type": "message", "id": row["id"], "text": row["text"],
+                   "timestamp": row["timestamp"]}
+
+    messages = (select([MESSAGES.c.id, MESSAGES.c.text,
+                        MESSAGES.c.timestamp])
+                .where(MESSAGES.c.user_id == user_id)
+                .order_by(MESSAGES.c.timestamp, MESSAGES.c.id))
+    for row in _stream(shard, messages, batch_size):
+        yield {"type": "message", "id": row["id"], "text": row["text"],
+               "timestamp": row["timestamp"].isoformat()}
+
+    likes = (select([LIKES.c.id, LIKES.c.message_id])
+             .where(LIKES.c.user_id == user_id)
+             .order_by(LIKES.c.id))
+    for row in _stream(shard, likes, batch_size):
+        yield {"type": "like", **row}
+
+    for kind, own, other in (
+            ("following", FOLLOWS.c.user_following_id,
+             FOLLOWS.c.user_being_followed_id),
+            ("follower", FOLLOWS.c.user_being_followed_id,
+             FOLLOWS.c.user_following_id)):
+        users = (select([USERS.c.id, USERS.c.username])
+                 .select_from(FOLLOWS.join(USERS, USERS.c.id == other))
+                 .where(own == user_id)
+                 .order_by(USERS.c.id))
+        for row in _stream(main, users, batch_size):
+            yield {"type": kind, **row}
+
+
+def ndjson(records, chunk_size=CHUNK_SIZE):
+    """Encode `records` as NDJSON, in chunks of about `chunk_size` bytes
+    rather than a write per line."""
+
+    lines, size = [], 0
+    for record in records:
+        line = json.dumps(record).encode() + b"\n"
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b"".join(lines)
+            lines, size = [], 0
+    if lines:
+        yield b"".join(lines)
+
+
+def gzipped(chunks, level=6):
+    """Compress `chunks` into a gzip stream as they come."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
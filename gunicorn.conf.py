@@ -0,0 +1,24 @@
+"""Gunicorn settings for production.
+
+The app is built and its lazily loaded modules imported once in the
+master (see `app.preload`); workers fork from it instead of importing
+everything themselves.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+
+def post_fork(server, worker):
+    # never reuse a connection the master opened; psycopg2 sockets
+    # can't be shared between processes
+    from models import db
+    from wsgi import app
+
+    with app.app_context():
+        db.engine.dispose()
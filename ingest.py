@@ -0,0 +1,253 @@
+"""Bulk loading of messages, for migrations and partners.
+
+Input is either NDJSON, one {"text", "timestamp", "user_id"} object per
+line, or CSV with a header row in the layout of generator/messages.csv
+(text,timestamp,user_id). It is read and checked one row at a time, so
+inputs of any size load in constant memory. Valid rows are gathered
+into chunks of CHUNK_SIZE and each chunk is loaded with COPY, one
+transaction per chunk and shard, together with the tag and mention rows
+of its messages.
+
+Rows are rejected, and reported by line number, when they are
+malformed, name a user who doesn't exist, or fall in an archived month
+(see partitions.py); partitions for other past months are created as
+needed. If the database refuses a chunk anyway, every row of it is
+reported and the load goes on with the next.
+"""
+
+import csv
+import io
+import json
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+import partitions
+import tags
+from models import Mention, Message, MessageArchive, MessageTag, User, db
+from sharding import shards
+
+FIELDS = ("text", "timestamp", "user_id")
+FORMATS = ("csv", "ndjson")
+
+# valid rows loaded per COPY
+CHUNK_SIZE = 5000
+
+MAX_TEXT = Message.__table__.c.text.type.length
+
+# rejected rows listed in a report; all of them are counted
+MAX_ERRORS = 1000
+
+
+class IngestError(Exception):
+    """Input that can't be loaded at all (e.g. a CSV without a header)."""
+
+
+class Report:
+    """Rows inserted and rejected by a load."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def serialize(self):
+        return {
+            "inserted": self.inserted,
+            "rejected": self.rejected,
+            "errors": sorted(self.errors, key=lambda error: error["line"]),
+        }
+
+
+def read_rows(stream, format):
+    """(line number, row) of binary `stream`, where row is a dict, or an
+    error message for lines that don't parse."""
+
+    if format not in FORMATS:
+        raise IngestError(f"Unknown format {format!r}")
+    lines = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        if not reader.fieldnames or set(FIELDS) - set(reader.fieldnames):
+            raise IngestError(f"CSV header must be {','.join(FIELDS)}")
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, "Not valid JSON"
+            continue
+        yield line_number, (row if isinstance(row, dict)
+                            else "Not a JSON object")
+
+
+def validate(row):
+    """The message columns of `row`; raise ValueError if it is invalid."""
+
+    missing = [field for field in FIELDS if row.get(field) in (None, "")]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+
+    message = row["text"]
+    if not isinstance(message, str) or not message.strip():
+        raise ValueError("text must be a non-empty string")
+    if len(message) > MAX_TEXT:
+        raise ValueError(f"text is longer than {MAX_TEXT} characters")
+
+    try:
+        timestamp = datetime.fromisoformat(row["timestamp"])
+    except (TypeError, ValueError):
+        raise ValueError("timestamp must be an ISO 8601 date and time")
+    if timestamp.tzinfo is not None:
+        timestamp = (timestamp.astimezone(timezone.utc)
+                     .replace(tzinfo=None))
+
+    user_id = row["user_id"]
+    if isinstance(user_id, str) and user_id.strip().isdigit():
+        user_id = int(user_id)
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise ValueError("user_id must be an integer")
+
+    return {"text": message, "timestamp": timestamp, "user_id": user_id}
+
+
+def _copy(cursor, table, columns, rows):
+    """COPY `rows` (dicts) into `table`."""
+
+    if not rows:
+        return
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    data.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) "
+                       f"FROM STDIN WITH (FORMAT csv)", data)
+
+
+class Loader:
+    """Loads validated rows chunk by chunk and keeps the report."""
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.report = Report()
+        self.archived = {month for (month,)
+                         in db.session.query(MessageArchive.month).distinct()}
+        # months known to have a partition
+        self.partitioned = set()
+
+    def load(self, rows):
+        """Load (line number, row) pairs from `read_rows`; return the
+        report."""
+
+        chunk = []
+        for line, row in rows:
+            if isinstance(row, str):
+                self.report.reject(line, row)
+                continue
+            try:
+                chunk.append((line, validate(row)))
+            except ValueError as e:
+                self.report.reject(line, str(e))
+                continue
+            if len(chunk) >= self.chunk_size:
+                self._load_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._load_chunk(chunk)
+        return self.report
+
+    def _load_chunk(self, chunk):
+        user_ids = {row["user_id"] for _, row in chunk}
+        existing = {user_id for (user_id,) in db.session.query(User.id)
+                    .filter(User.id.in_(user_ids))}
+
+        accepted = []
+        for line, row in chunk:
+            month = partitions.month_start(row["timestamp"])
+            if row["user_id"] not in existing:
+                self.report.reject(line, f"No user {row['user_id']}")
+            elif month in self.archived:
+                self.report.reject(line, f"{month:%Y-%m} is archived")
+            else:
+                accepted.append((line, row))
+        if not accepted:
+            return
+
+        if not shards.enabled:
+            self._create_partitions({partitions.month_start(row["timestamp"])
+                                     for _, row in accepted})
+
+        by_user = defaultdict(list)
+        for line, row in accepted:
+            by_user[row["user_id"]].append((line, row))
+        for user_id in shards.moving(by_user):
+            for line, _ in by_user.pop(user_id):
+                self.report.reject(
+                    line, f"User {user_id} is moving shards; retry later")
+        if not by_user:
+            return
+        for shard, members in shards.group_by_shard(by_user,
+                                                    write=True).items():
+            rows = [pair for user_id in members for pair in by_user[user_id]]
+            self._load_shard(shard, rows)
+
+    def _create_partitions(self, months):
+        months -= self.partitioned
+        if months:
+            with db.engine.begin() as conn:
+                for month in sorted(months):
+                    partitions.create_partitions(conn, month, month)
+            self.partitioned |= months
+
+    def _load_shard(self, shard, rows):
+        session = shards.session(shard)
+        try:
+            ids = shards.next_ids('messages', len(rows)) or [
+                message_id for (message_id,) in session.execute(
+                    text("SELECT nextval(pg_get_serial_sequence("
+                         "'messages', 'id')) FROM generate_series(1, :n)"),
+                    {"n": len(rows)})]
+            messages = [dict(row, id=message_id)
+                        for (_, row), message_id in zip(rows, ids)]
+            tag_rows, mention_rows = tags.index_rows(
+                [(msg["id"], msg["text"]) for msg in messages])
+            # new tags are created in the main database
+            db.session.commit()
+
+            cursor = session.connection().connection.cursor()
+            _copy(cursor, Message.__tablename__,
+                  ["id", "text", "timestamp", "user_id"], messages)
+            _copy(cursor, MessageTag.__tablename__,
+                  ["tag_id", "message_id"], tag_rows)
+            _copy(cursor, Mention.__tablename__,
+                  ["user_id", "message_id"], mention_rows)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            db.session.rollback()
+            error = str(getattr(e, "orig", e)).strip().splitlines()[0]
+            for line, _ in rows:
+                self.report.reject(line, error)
+            return
+
+        self.report.inserted += len(rows)
+
+
+def ingest(stream, format, chunk_size=CHUNK_SIZE):
+    """Load the messages in binary `stream` (`format` "csv" or
+    "ndjson"); return a Report."""
+
+    return Loader(chunk_size).load(read_rows(stream, format))
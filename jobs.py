@@ -0,0 +1,331 @@
+"""Durable background job queue stored in the application database.
+
+Handlers register themselves with the `job` decorator; request handlers
+call `enqueue` and commit along with the rest of their work, so a job only
+becomes visible to workers once the transaction that created it succeeds.
+
+Workers (`flask worker`) claim jobs with SELECT ... FOR UPDATE SKIP LOCKED
+on PostgreSQL. Other databases (SQLite in tests/dev) fall back to an
+optimistic conditional UPDATE, so two workers never run the same job.
+On PostgreSQL a claim also holds a transaction-level advisory lock per
+concurrency-limited kind while it counts the running jobs, so two
+workers can't both take the last free slot.
+
+While a job runs, a heartbeat refreshes its `locked_at` every
+HEARTBEAT_INTERVAL seconds; `requeue_stale` only requeues jobs whose
+heartbeat stopped, so long jobs aren't run twice.
+"""
+
+import json
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import Job, db
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# backoff before retry n is BACKOFF_BASE * 2 ** (n - 1) seconds, capped
+BACKOFF_BASE = 5
+BACKOFF_MAX = 60 * 60
+
+# claim attempts per poll when another worker wins the optimistic update
+CLAIM_CANDIDATES = 10
+
+# seconds between refreshes of a running job's locked_at
+HEARTBEAT_INTERVAL = 60
+
+# a running job whose heartbeat is this many seconds old is requeued
+STALE_TIMEOUT = 15 * 60
+
+# first key of the advisory locks serializing claims of limited kinds
+CLAIM_LOCK_NAMESPACE = 0x6a6f6273
+
+Handler = namedtuple("Handler", ["function", "max_concurrency", "max_attempts"])
+
+HANDLERS = {}
+
+
+def job(kind, max_concurrency=None, max_attempts=5):
+    """Register the decorated function as the handler for `kind` jobs.
+
+    The handler is called with the job payload as keyword arguments.
+    `max_concurrency` caps how many jobs of this kind may run at once
+    across all workers (None for no limit).
+    """
+
+    def _job(function):
+        HANDLERS[kind] = Handler(function, max_concurrency, max_attempts)
+        return function
+    return _job
+
+
+def enqueue(kind, payload=None, priority=0, delay=0, max_attempts=None):
+    """Add a job to the session; it is queued once the caller commits."""
+
+    if kind not in HANDLERS:
+        raise ValueError(f"No handler registered for job kind {kind!r}")
+
+    new_job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        priority=priority,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+        max_attempts=max_attempts or HANDLERS[kind].max_attempts,
+    )
+    db.session.add(new_job)
+    return new_job
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that failed `attempts` times."""
+
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    # jitter so a burst of failures doesn't retry in lockstep
+    return delay + random.uniform(0, delay / 4)
+
+
+def worker_name():
+    """Identify this worker process in `Job.locked_by`."""
+
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def saturated_kinds():
+    """Return job kinds that are already running at their concurrency limit."""
+
+    limited = {
+        kind: handler.max_concurrency
+        for kind, handler in HANDLERS.items()
+        if handler.max_concurrency is not None
+    }
+    if not limited:
+        return set()
+
+    running = (db.session
+               .query(Job.kind, func.count(Job.id))
+               .filter(Job.status == RUNNING, Job.kind.in_(limited))
+               .group_by(Job.kind))
+    return {kind for kind, count in running if count >= limited[kind]}
+
+
+def _lock_limited_kinds(kinds):
+    """Take the claim lock of each concurrency-limited kind in `kinds`,
+    until the transaction ends. Sorted, so workers never deadlock."""
+
+    limited = sorted(kind for kind in kinds
+                     if kind in HANDLERS
+                     and HANDLERS[kind].max_concurrency is not None)
+    for kind in limited:
+        db.session.execute(
+            text("SELECT pg_advisory_xact_lock(:namespace, hashtext(:kind))"),
+            {"namespace": CLAIM_LOCK_NAMESPACE, "kind": kind})
+
+
+def _claimable(kinds=None):
+    """Query for queued jobs that are due, highest priority first.
+
+    Return None when every requested kind is at its concurrency limit.
+    """
+
+    kinds = set(HANDLERS if kinds is None else kinds)
+    if db.engine.dialect.name == "postgresql":
+        # held until the claim commits: counting the running jobs and
+        # claiming one happen as one step per kind
+        _lock_limited_kinds(kinds)
+    kinds -= saturated_kinds()
+    if not kinds:
+        return None
+
+    return (Job.query
+            .filter(Job.status == QUEUED,
+                    Job.run_at <= datetime.utcnow(),
+                    Job.kind.in_(kinds))
+            .order_by(Job.priority.desc(), Job.run_at, Job.id))
+
+
+def claim(worker=None, kinds=None):
+    """Claim the next runnable job for `worker`; return it or None.
+
+    The claimed job is committed as running, so other workers skip it
+    even if this worker dies; `requeue_stale` recovers those.
+    """
+
+    query = _claimable(kinds)
+    if query is None:
+        db.session.rollback()
+        return None
+
+    worker = worker or worker_name()
+    claimed = {
+        "status": RUNNING,
+        "locked_by": worker,
+        "locked_at": datetime.utcnow(),
+        "attempts": Job.attempts + 1,
+    }
+
+    if db.engine.dialect.name == "postgresql":
+        next_job = (query
+                    .with_for_update(skip_locked=True)
+                    .first())
+        if next_job is None:
+            db.session.rollback()
+            return None
+
+        Job.query.filter(Job.id == next_job.id).update(
+            claimed, synchronize_session=False)
+        db.session.commit()
+        return Job.query.get(next_job.id)
+
+    # no row locks: take the first candidate nobody else flipped first
+    candidates = [job_id for (job_id,) in
+                  query.with_entities(Job.id)
+                  .limit(CLAIM_CANDIDATES)]
+    for job_id in candidates:
+        updated = (Job.query
+                   .filter(Job.id == job_id, Job.status == QUEUED)
+                   .update(claimed, synchronize_session=False))
+        db.session.commit()
+        if updated:
+            return Job.query.get(job_id)
+
+    return None
+
+
+@contextmanager
+def heartbeat(job_id, interval=None):
+    """Refresh running job `job_id`'s locked_at every `interval` seconds
+    (HEARTBEAT_INTERVAL by default) while the block runs.
+
+    Beats go through a connection of their own, outside the handler's
+    transaction; a failed beat is retried at the next one.
+    """
+
+    interval = HEARTBEAT_INTERVAL if interval is None else interval
+    engine = db.engine
+    jobs_table = Job.__table__
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(jobs_table.update()
+                                 .where(jobs_table.c.id == job_id)
+                                 .where(jobs_table.c.status == RUNNING)
+                                 .values(locked_at=datetime.utcnow()))
+            except SQLAlchemyError:
+                continue
+
+    thread = threading.Thread(target=beat, name="job-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run(claimed_job):
+    """Run a claimed job and record its outcome; return True on success.
+
+    A job whose kind has no handler fails at once: retrying won't help.
+    """
+
+    handler = HANDLERS.get(claimed_job.kind)
+
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for {claimed_job.kind!r}")
+        with heartbeat(claimed_job.id):
+            handler.function(**json.loads(claimed_job.payload))
+    except Exception:
+        db.session.rollback()
+        failed_job = Job.query.get(claimed_job.id)
+        failed_job.last_error = traceback.format_exc(limit=5)
+        failed_job.locked_by = None
+        failed_job.locked_at = None
+
+        if (handler is None
+                or failed_job.attempts >= failed_job.max_attempts):
+            failed_job.status = FAILED
+            failed_job.finished_at = datetime.utcnow()
+        else:
+            failed_job.status = QUEUED
+            failed_job.run_at = (datetime.utcnow()
+                                 + timedelta(seconds=backoff(failed_job.attempts)))
+        db.session.commit()
+        return False
+
+    finished_job = Job.query.get(claimed_job.id)
+    finished_job.status = DONE
+    finished_job.finished_at = datetime.utcnow()
+    finished_job.last_error = None
+    db.session.commit()
+    return True
+
+
+def requeue_stale(timeout=STALE_TIMEOUT):
+    """Put jobs back in the queue whose worker stopped reporting; return count.
+
+    A running job whose heartbeat is older than `timeout` seconds is
+    assumed to belong to a crashed worker.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    count = (Job.query
+             .filter(Job.status == RUNNING, Job.locked_at < cutoff)
+             .update({"status": QUEUED, "locked_by": None, "locked_at": None},
+                     synchronize_session=False))
+    db.session.commit()
+    return count
+
+
+def work(kinds=None, burst=False, poll_interval=1.0,
+         stale_timeout=STALE_TIMEOUT):
+    """Claim and run jobs until interrupted; return the number processed.
+
+    With `burst`, return as soon as the queue has nothing runnable.
+    """
+
+    worker = worker_name()
+    processed = 0
+    last_reap = float("-inf")
+
+    while True:
+        if time.monotonic() - last_reap > stale_timeout / 2:
+            requeue_stale(stale_timeout)
+            last_reap = time.monotonic()
+
+        next_job = claim(worker, kinds)
+        if next_job is None:
+            if burst:
+                return processed
+            time.sleep(poll_interval)
+            continue
+
+        run(next_job)
+        processed += 1
+
+
+@job("jobs.prune", max_concurrency=1)
+def prune(days=7):
+    """Delete finished jobs older than `days` days."""
+
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    (Job.query
+        .filter(Job.status.in_([DONE, FAILED]), Job.finished_at < cutoff)
+        .delete(synchronize_session=False))
+    db.session.commit()
@@ -0,0 +1,399 @@
+"""Write-behind buffer for likes and unlikes.
+
+Off by default; set LIKES_WRITE_BEHIND to turn it on. The like button
+sends a request per click, and a burst of toggles mostly cancels out.
+With the buffer on, `create_like` and `delete_likes` only record the
+change in process memory, keyed by (user, message), where a like and
+an unlike of the same pending row cancel. A background thread writes
+what is left every LIKES_FLUSH_INTERVAL seconds: one bulk INSERT and
+one bulk DELETE per shard.
+
+Ids are handed out when the like is buffered (from the likes sequence,
+or `shards.next_id` when sharded), so the client gets the id it will
+later unlike with straight away.
+
+Read your writes: a user's pending changes are written before any other
+request of theirs reaches this worker (see `add_user_to_g`), so pages
+they load next show them. Other workers, and other users, see them
+within LIKES_FLUSH_INTERVAL.
+
+Durability:
+
+    clean shutdown  the buffer is flushed at exit
+    process crash   with LIKES_JOURNAL_DIR set, every change is appended
+                    to a per-process journal there first; the next
+                    worker to start replays journals of dead processes.
+                    Without it, up to LIKES_FLUSH_INTERVAL of changes
+                    are lost.
+    host crash      the journal isn't fsynced: changes the OS hadn't
+                    written out yet are lost
+
+The journal directory has to be local to the host (dead processes are
+found by pid). Replayed writes are idempotent.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import Likes, User, db
+from notifications import LIKE, notifications
+from sharding import shards
+
+LIKES = Likes.__table__
+
+# the effective state of a pending (user, message) pair
+LIKED = "like"
+UNLIKED = "unlike"
+
+
+class _LikeState:
+    """Per-app buffered changes, journal and flush thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = app.config['LIKES_WRITE_BEHIND']
+        self.flush_interval = app.config['LIKES_FLUSH_INTERVAL']
+        self.journal_dir = app.config['LIKES_JOURNAL_DIR']
+        self.id_block_size = app.config['LIKES_ID_BLOCK_SIZE']
+        # (user_id, message_id) -> (LIKED or UNLIKED, like id)
+        self.pending = {}
+        # the changes the flush in progress is writing
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        # like ids reserved from the sequence, unsharded
+        self.ids = deque()
+        self.ids_lock = threading.Lock()
+        self.journal = None
+        self.pid = None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_journal(path):
+    """Last recorded state of each (user, message) pair in a journal."""
+
+    changes = {}
+    with open(path) as journal:
+        for line in journal:
+            try:
+                user_id, message_id, state, like_id = json.loads(line)
+            except ValueError:
+                # cut short by the crash
+                continue
+            changes[(user_id, message_id)] = (state, like_id)
+    return changes
+
+
+class LikeBuffer:
+    """Buffers likes and unlikes and writes them in bulk; bind with
+    `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault('LIKES_WRITE_BEHIND', os.environ.get(
+            'LIKES_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'))
+        app.config.setdefault('LIKES_FLUSH_INTERVAL', float(
+            os.environ.get('LIKES_FLUSH_INTERVAL', 1)))
+        app.config.setdefault('LIKES_JOURNAL_DIR',
+                              os.environ.get('LIKES_JOURNAL_DIR'))
+        app.config.setdefault('LIKES_ID_BLOCK_SIZE', 100)
+
+        state = app.extensions['like_buffer'] = _LikeState(app)
+        if state.enabled:
+            atexit.register(self._flush_at_exit, state)
+
+    def _state(self):
+        return current_app.extensions['like_buffer']
+
+    @property
+    def enabled(self):
+        return self._state().enabled
+
+    ##########################################################################
+    # Buffering
+
+    def like(self, user_id, message_id):
+        """Buffer a like; return its id."""
+
+        state = self._state()
+        self._start(state)
+        key = (user_id, message_id)
+
+        with state.lock:
+            current = state.pending.get(key) or state.inflight.get(key)
+            if current and current[0] == LIKED:
+                return current[1]
+            if current and key in state.pending:
+                # cancels an unlike not written yet
+                del state.pending[key]
+                self._record(state, key, (LIKED, current[1]))
+                return current[1]
+            if current:
+                # liked again while the unlike is being written
+                return self._set(state, key, LIKED, current[1])
+
+        like_id = self._next_id(state)
+        with state.lock:
+            current = state.pending.get(key) or state.inflight.get(key)
+            if current and current[0] == LIKED:
+                # a concurrent request liked it first
+                return current[1]
+            return self._set(state, key, LIKED, like_id)
+
+    def unlike(self, user_id, like_id):
+        """Buffer removing like `like_id` of `user_id`.
+
+        Return False if the user has no such like.
+        """
+
+        state = self._state()
+        self._start(state)
+
+        with state.lock:
+            key = self._find(state, user_id, like_id)
+            if key is not None:
+                return self._unlike(state, key, like_id)
+
+        message_id = (shards.session_for(user_id)
+                      .query(Likes.message_id)
+                      .filter(Likes.id == like_id, Likes.user_id == user_id)
+                      .scalar())
+        if message_id is None:
+            return False
+        with state.lock:
+            return self._unlike(state, (user_id, message_id), like_id)
+
+    def _find(self, state, user_id, like_id):
+        for changes in (state.pending, state.inflight):
+            for key, (_, change_id) in changes.items():
+                if key[0] == user_id and change_id == like_id:
+                    return key
+        return None
+
+    def _unlike(self, state, key, like_id):
+        current = state.pending.get(key) or state.inflight.get(key)
+        if current is None:
+            self._set(state, key, UNLIKED, like_id)
+            return True
+        if current != (LIKED, like_id):
+            return False
+        if key in state.pending:
+            # cancels a like not written yet (or re-liked mid-flush)
+            del state.pending[key]
+            self._record(state, key, (UNLIKED, like_id))
+        else:
+            self._set(state, key, UNLIKED, like_id)
+        return True
+
+    def _set(self, state, key, change, like_id):
+        state.pending[key] = (change, like_id)
+        self._record(state, key, (change, like_id))
+        return like_id
+
+    def _next_id(self, state):
+        like_id = shards.next_id('likes')
+        if like_id is not None:
+            return like_id
+
+        with state.ids_lock:
+            if not state.ids:
+                state.ids.extend(like_id for (like_id,) in db.engine.execute(
+                    text("SELECT nextval(pg_get_serial_sequence('likes', "
+                         "'id')) FROM generate_series(1, :count)"),
+                    count=state.id_block_size))
+            return state.ids.popleft()
+
+    ##########################################################################
+    # Journal
+
+    def _journal_path(self, state, pid=None):
+        return os.path.join(state.journal_dir,
+                            f"likes-{pid or os.getpid()}.journal")
+
+    def _record(self, state, key, change):
+        """Append the new state of `key`; call with `state.lock` held."""
+
+        if state.journal is not None:
+            state.journal.write(json.dumps([*key, *change]) + "\n")
+            state.journal.flush()
+
+    def _rewrite_journal(self, state):
+        """Replace the journal with what is still pending; call with
+        `state.lock` held."""
+
+        if state.journal is None:
+            return
+        path = self._journal_path(state)
+        with open(path + ".tmp", "w") as journal:
+            for key, change in state.pending.items():
+                journal.write(json.dumps([*key, *change]) + "\n")
+        state.journal.close()
+        os.replace(path + ".tmp", path)
+        state.journal = open(path, "a")
+
+    def _recover(self, state):
+        """Claim the journals of processes that died unflushed; return
+        their changes.
+
+        Call before opening this process's own journal: one left under
+        this pid is from a dead process the pid was reused from.
+        """
+
+        changes = {}
+        pattern = os.path.join(state.journal_dir, "likes-*.journal")
+        for path in glob.glob(pattern):
+            pid = int(os.path.basename(path)[len("likes-"):-len(".journal")])
+            if pid != os.getpid() and _alive(pid):
+                continue
+            claimed = f"{path}.{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # another worker got there first
+                continue
+            changes.update(_read_journal(claimed))
+            os.remove(claimed)
+        return changes
+
+    ##########################################################################
+    # Flushing
+
+    def _start(self, state):
+        """Open the journal and start the flush thread, in each worker."""
+
+        with state.lock:
+            if state.pid == os.getpid():
+                return
+            state.pid = os.getpid()
+            # forked: the parent's buffer and ids are the parent's
+            state.pending.clear()
+            state.inflight.clear()
+            state.ids.clear()
+            if state.journal_dir:
+                os.makedirs(state.journal_dir, exist_ok=True)
+                recovered = self._recover(state)
+                state.journal = open(self._journal_path(state), "a")
+                for key, change in recovered.items():
+                    self._set(state, key, *change)
+
+        if state.flush_interval:
+            threading.Thread(target=self._run, args=(state,),
+                             name="like-buffer", daemon=True).start()
+
+    def _run(self, state):
+        while True:
+            time.sleep(state.flush_interval)
+            with state.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    state.app.logger.exception("Writing likes failed")
+
+    def _flush_at_exit(self, state):
+        if state.pid == os.getpid() and state.pending:
+            with state.app.app_context():
+                self.flush()
+
+    def flush(self, user_id=None):
+        """Write buffered changes (only `user_id`'s, if given); return
+        the number of rows changed."""
+
+        state = self._state()
+        if not state.enabled:
+            return 0
+
+        with state.flush_lock:
+            with state.lock:
+                keys = [key for key in state.pending
+                        if user_id is None or key[0] == user_id]
+                if not keys:
+                    return 0
+                state.inflight = {key: state.pending.pop(key)
+                                  for key in keys}
+
+            try:
+                deferred = self._write(state.inflight)
+            except Exception:
+                with state.lock:
+                    # retry next time, unless changed since
+                    for key, change in state.inflight.items():
+                        state.pending.setdefault(key, change)
+                    state.inflight = {}
+                raise
+
+            written, state.inflight = state.inflight, {}
+            with state.lock:
+                for key in deferred:
+                    state.pending.setdefault(key, written.pop(key))
+                self._rewrite_journal(state)
+
+        for (user_id, message_id), (change, _) in written.items():
+            if change == LIKED:
+                notifications.notify(LIKE, message_id, user_id)
+        return len(written)
+
+    def _write(self, changes):
+        """Apply `changes` on each user's shard, one transaction each.
+
+        Returns the keys of changes left for later: those of users
+        moving shards.
+        """
+
+        user_ids = {user_id for user_id, _ in changes}
+        moving = shards.moving(user_ids)
+        groups = shards.group_by_shard(user_ids - moving, write=True)
+        for shard, members in groups.items():
+            session = shards.session(shard)
+            try:
+                self._write_shard(session, members, changes)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+        return [key for key in changes if key[0] in moving]
+
+    def _write_shard(self, session, user_ids, changes):
+        # skip users deleted since they liked
+        members = {user_id for (user_id,) in session.query(User.id)
+                   .filter(User.id.in_(user_ids))}
+        likes = [{"id": like_id, "user_id": user_id, "message_id": message_id}
+                 for (user_id, message_id), (change, like_id)
+                 in changes.items()
+                 if change == LIKED and user_id in members]
+        unlike_ids = [like_id
+                      for (user_id, _), (change, like_id) in changes.items()
+                      if change == UNLIKED and user_id in members]
+
+        if unlike_ids:
+            (session.query(Likes)
+                .filter(Likes.id.in_(unlike_ids))
+                .delete(synchronize_session=False))
+        if likes:
+            session.execute(self._insert_ignore(session), likes)
+
+    def _insert_ignore(self, session):
+        """INSERT into likes skipping rows that already exist."""
+
+        if session.get_bind().dialect.name == "postgresql":
+            return pg_insert(LIKES).on_conflict_do_nothing()
+        return LIKES.insert().prefix_with("OR IGNORE")
+
+
+like_buffer = LikeBuffer()
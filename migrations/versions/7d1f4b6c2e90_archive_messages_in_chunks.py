@@ -0,0 +1,114 @@
+"""archive messages in chunks
+
+Revision ID: 7d1f4b6c2e90
+Revises: 5b8e0f3a9d21
+Create Date: 2026-10-19 16:20:37.904112
+
+"""
+import gzip
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d1f4b6c2e90'
+down_revision = '5b8e0f3a9d21'
+branch_labels = None
+depends_on = None
+
+# as partitions.ARCHIVE_CHUNK_ROWS when this was written
+CHUNK_ROWS = 1000
+
+
+def upgrade():
+    op.rename_table('message_archives', 'message_archives_monthly')
+    op.execute('ALTER INDEX ix_message_archives_ids '
+               'RENAME TO ix_message_archives_monthly_ids')
+
+    op.create_table('message_archives',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('min_id', sa.Integer(), nullable=False),
+    sa.Column('max_id', sa.Integer(), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_message_archives_ids', 'message_archives', ['min_id', 'max_id'], unique=False)
+    op.create_index('ix_message_archives_month', 'message_archives', ['month'], unique=False)
+    op.create_table('message_archive_users',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('archive_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['archive_id'], ['message_archives.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'archive_id')
+    )
+
+    # split each month, leaving out users deleted since it was archived
+    bind = op.get_bind()
+    user_ids = {user_id for (user_id,) in bind.execute("SELECT id FROM users")}
+    months = [month for (month,) in bind.execute(
+        "SELECT month FROM message_archives_monthly ORDER BY month")]
+    for month in months:
+        data = bind.execute(
+            sa.text("SELECT data FROM message_archives_monthly "
+                    "WHERE month = :month"), month=month).scalar()
+        lines = [line for line in gzip.decompress(data).decode().splitlines()
+                 if json.loads(line)["user_id"] in user_ids]
+        for start in range(0, len(lines), CHUNK_ROWS):
+            chunk = lines[start:start + CHUNK_ROWS]
+            rows = [json.loads(line) for line in chunk]
+            archive_id = bind.execute(
+                sa.text("INSERT INTO message_archives "
+                        "(month, min_id, max_id, row_count, data) "
+                        "VALUES (:month, :min_id, :max_id, :row_count, :data) "
+                        "RETURNING id"),
+                month=month, min_id=rows[0]["id"], max_id=rows[-1]["id"],
+                row_count=len(rows),
+                data=gzip.compress("\n".join(chunk).encode())).scalar()
+            for user_id in sorted({row["user_id"] for row in rows}):
+                bind.execute(
+                    sa.text("INSERT INTO message_archive_users "
+                            "(user_id, archive_id) VALUES (:user_id, :archive_id)"),
+                    user_id=user_id, archive_id=archive_id)
+
+    op.drop_table('message_archives_monthly')
+
+
+def downgrade():
+    op.create_table('message_archives_monthly',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('min_id', sa.Integer(), nullable=False),
+    sa.Column('max_id', sa.Integer(), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('month')
+    )
+
+    # chunks of a month have disjoint id ranges; join them in id order
+    bind = op.get_bind()
+    months = [month for (month,) in bind.execute(
+        "SELECT DISTINCT month FROM message_archives ORDER BY month")]
+    for month in months:
+        chunks = bind.execute(
+            sa.text("SELECT min_id, max_id, row_count, data "
+                    "FROM message_archives WHERE month = :month "
+                    "ORDER BY min_id"), month=month).fetchall()
+        data = "\n".join(gzip.decompress(chunk.data).decode()
+                         for chunk in chunks)
+        bind.execute(
+            sa.text("INSERT INTO message_archives_monthly "
+                    "(month, min_id, max_id, row_count, data) "
+                    "VALUES (:month, :min_id, :max_id, :row_count, :data)"),
+            month=month, min_id=chunks[0].min_id, max_id=chunks[-1].max_id,
+            row_count=sum(chunk.row_count for chunk in chunks),
+            data=gzip.compress(data.encode()))
+
+    op.drop_table('message_archive_users')
+    op.drop_index('ix_message_archives_month', table_name='message_archives')
+    op.drop_index('ix_message_archives_ids', table_name='message_archives')
+    op.drop_table('message_archives')
+    op.rename_table('message_archives_monthly', 'message_archives')
+    op.create_index('ix_message_archives_ids', 'message_archives', ['min_id', 'max_id'], unique=False)
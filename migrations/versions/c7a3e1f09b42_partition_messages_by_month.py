@@ -0,0 +1,123 @@
+"""partition messages by month
+
+Revision ID: c7a3e1f09b42
+Revises: 42960fbcace8
+Create Date: 2026-10-19 14:02:11.381520
+
+"""
+from datetime import date, datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a3e1f09b42'
+down_revision = '42960fbcace8'
+branch_labels = None
+depends_on = None
+
+# same as partitions.MONTHS_AHEAD; copied so the migration doesn't change
+# when the module does
+MONTHS_AHEAD = 3
+
+MESSAGE_FKS = [
+    ('likes', 'likes_message_id_fkey'),
+    ('message_tags', 'message_tags_message_id_fkey'),
+    ('mentions', 'mentions_message_id_fkey'),
+]
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # a foreign key can't point at a partitioned table's id alone
+    for table, name in MESSAGE_FKS:
+        op.drop_constraint(name, table, type_='foreignkey')
+
+    op.create_table('message_archives',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('min_id', sa.Integer(), nullable=False),
+    sa.Column('max_id', sa.Integer(), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('month')
+    )
+    op.create_index('ix_message_archives_ids', 'message_archives', ['min_id', 'max_id'], unique=False)
+
+    # rows can't be moved into partitions in place: build a new table
+    op.rename_table('messages', 'messages_unpartitioned')
+    op.execute('ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey')
+    op.execute('ALTER INDEX ix_messages_timestamp RENAME TO ix_messages_unpartitioned_timestamp')
+    op.execute('ALTER INDEX ix_messages_user_id_timestamp RENAME TO ix_messages_unpartitioned_user_id_timestamp')
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY NONE')
+
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('messages_id_seq')"), nullable=False),
+    sa.Column('text', sa.String(length=140), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', 'timestamp'),
+    postgresql_partition_by='RANGE (timestamp)'
+    )
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages.id')
+    op.create_index('ix_messages_timestamp', 'messages', ['timestamp'], unique=False)
+    op.create_index('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp'], unique=False)
+
+    # every month with messages, then this month and the next few
+    months = {row[0].date() for row in bind.execute(
+        "SELECT DISTINCT date_trunc('month', timestamp) "
+        "FROM messages_unpartitioned")}
+    now = datetime.utcnow()
+    this_month = date(now.year, now.month, 1)
+    months.update(add_months(this_month, ahead)
+                  for ahead in range(MONTHS_AHEAD + 1))
+    for month in sorted(months):
+        op.execute(
+            f"CREATE TABLE messages_p{month.year:04d}_{month.month:02d} "
+            f"PARTITION OF messages "
+            f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')")
+
+    op.execute('INSERT INTO messages (id, text, timestamp, user_id) '
+               'SELECT id, text, timestamp, user_id FROM messages_unpartitioned')
+    op.drop_table('messages_unpartitioned')
+
+
+def downgrade():
+    # archived months are not restored; their likes, tags and mentions
+    # are deleted so the foreign keys can come back
+    op.rename_table('messages', 'messages_partitioned')
+    op.execute('ALTER INDEX messages_pkey RENAME TO messages_partitioned_pkey')
+    op.execute('ALTER INDEX ix_messages_timestamp RENAME TO ix_messages_partitioned_timestamp')
+    op.execute('ALTER INDEX ix_messages_user_id_timestamp RENAME TO ix_messages_partitioned_user_id_timestamp')
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY NONE')
+
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('messages_id_seq')"), nullable=False),
+    sa.Column('text', sa.String(length=140), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages.id')
+    op.create_index('ix_messages_timestamp', 'messages', ['timestamp'], unique=False)
+    op.create_index('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp'], unique=False)
+    op.execute('INSERT INTO messages (id, text, timestamp, user_id) '
+               'SELECT id, text, timestamp, user_id FROM messages_partitioned')
+    op.drop_table('messages_partitioned')
+
+    op.drop_index('ix_message_archives_ids', table_name='message_archives')
+    op.drop_table('message_archives')
+
+    for table, name in MESSAGE_FKS:
+        op.execute(f'DELETE FROM {table} WHERE message_id NOT IN '
+                   f'(SELECT id FROM messages)')
+        op.create_foreign_key(name, table, 'messages', ['message_id'], ['id'],
+                              ondelete='cascade')
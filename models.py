@@ -2,20 +2,39 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import any_, event
+from sqlalchemy.dialects.postgresql import ARRAY
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
+_bcrypt = None
 
 DEFAULT_IMG = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMG = "/static/images/warbler-hero.jpg"
 
+
+def get_bcrypt():
+    """Return the shared Bcrypt, importing it on first use."""
+
+    global _bcrypt
+    if _bcrypt is None:
+        from flask_bcrypt import Bcrypt
+        _bcrypt = Bcrypt()
+    return _bcrypt
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
 
+    # the primary key covers lookups by user_being_followed_id (followers);
+    # this covers the reverse direction (following, home feed)
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -32,7 +51,17 @@ class Follows(db.Model):
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+
+    __table_args__ = (
+        # a message is liked at most once by each user
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_id_message_id'),
+        # a user's likes in the order they were made (likes page)
+        db.Index('ix_likes_user_id_id', 'user_id', 'id'),
+        # like counts of a page of messages
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -44,10 +73,9 @@ class Likes(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # no foreign key: messages is partitioned (see partitions.py)
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
     def serialize(self):
@@ -103,6 +131,24 @@ class User(db.Model):
         nullable=False,
     )
 
+    # unread rows in notifications, kept up to date by notifications.py
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # PageRank in the follow graph, 1 for an average user; recomputed
+    # by influence.py
+    influence = db.Column(
+        db.Float,
+        nullable=False,
+        default=0,
+        server_default='0',
+        index=True,
+    )
+
     messages = db.relationship('Message', backref='user', passive_deletes=True)
 
     followers = db.relationship(
@@ -121,7 +167,9 @@ class User(db.Model):
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin="User.id == foreign(Likes.user_id)",
+        secondaryjoin="Message.id == foreign(Likes.message_id)",
     )
 
     def __repr__(self):
@@ -139,6 +187,33 @@ class User(db.Model):
         found_user_list = [user for user in self.following if user == other_user]
         return len(found_user_list) == 1
 
+    @staticmethod
+    def relationships(user_id, other_ids):
+        """Whether `user_id` follows and is followed by each of `other_ids`.
+
+        Returns {other id: (following, followed_by)}. One query, served
+        by the two indexes on follows.
+        """
+
+        found = {other_id: [False, False] for other_id in other_ids}
+        if not found:
+            return {}
+        # one array parameter rather than an IN list of hundreds
+        ids = db.bindparam('ids', list(found), type_=ARRAY(db.Integer))
+        rows = (db.session.query(Follows.user_following_id,
+                                 Follows.user_being_followed_id)
+                .filter(db.or_(
+                    db.and_(Follows.user_following_id == user_id,
+                            Follows.user_being_followed_id == any_(ids)),
+                    db.and_(Follows.user_being_followed_id == user_id,
+                            Follows.user_following_id == any_(ids)))))
+        for follower_id, followed_id in rows:
+            if follower_id == user_id:
+                found[followed_id][0] = True
+            if followed_id == user_id:
+                found[follower_id][1] = True
+        return {other_id: tuple(flags) for other_id, flags in found.items()}
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -146,7 +221,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = (get_bcrypt().generate_password_hash(password)
+                      .decode('UTF-8'))
 
         user = User(
             username=username,
@@ -172,7 +248,7 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = get_bcrypt().check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -184,9 +260,20 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # one partition per month (see partitions.py); Postgres needs the
+    # partition key in the primary key, but ids alone stay unique
+    __table_args__ = (
+        db.PrimaryKeyConstraint('id', 'timestamp'),
+        # a user's messages newest first (profile, home feed)
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        # everyone's messages newest first (trending)
+        db.Index('ix_messages_timestamp', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
     id = db.Column(
         db.Integer,
-        primary_key=True,
+        autoincrement=True,
     )
 
     text = db.Column(
@@ -197,7 +284,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -206,9 +293,364 @@ class Message(db.Model):
         nullable=False,
     )
 
+    __mapper_args__ = {'primary_key': [id]}
+
     # backref defined in User model
     # user = db.relationship('User')
 
+    tags = db.relationship(
+        'Tag',
+        secondary="message_tags",
+        primaryjoin="Message.id == foreign(MessageTag.message_id)",
+        secondaryjoin="Tag.id == foreign(MessageTag.tag_id)",
+    )
+
+    mentioned_users = db.relationship(
+        'User',
+        secondary="mentions",
+        primaryjoin="Message.id == foreign(Mention.message_id)",
+        secondaryjoin="User.id == foreign(Mention.user_id)",
+    )
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def create_message_partitions(table, connection, **kw):
+    """A partitioned table accepts no rows until its partitions exist."""
+
+    if connection.dialect.name == 'postgresql':
+        from partitions import create_upcoming
+        create_upcoming(connection)
+
+
+class Tag(db.Model):
+    """A hashtag used in one or more messages."""
+
+    __tablename__ = 'tags'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # stored lower case, without the leading "#"
+    name = db.Column(
+        db.Text,
+        nullable=False,
+        unique=True,
+    )
+
+    def __repr__(self):
+        return f"<Tag #{self.id}: {self.name}>"
+
+
+class MessageTag(db.Model):
+    """Inverted index of tag -> messages using it."""
+
+    __tablename__ = 'message_tags'
+
+    # the primary key serves a tag's timeline newest first;
+    # the message_id index serves deletes and re-indexing of a message
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+    tag_id = db.Column(
+        db.Integer,
+        db.ForeignKey('tags.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+
+class Mention(db.Model):
+    """Inverted index of user -> messages mentioning them."""
+
+    __tablename__ = 'mentions'
+
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+
+class MessageArchive(db.Model):
+    """Archived messages of one month with consecutive ids, gzipped.
+
+    A month is split into chunks of up to ARCHIVE_CHUNK_ROWS messages
+    (see partitions.py), so reading one message decompresses one chunk.
+    """
+
+    __tablename__ = 'message_archives'
+
+    # finds the chunks that may hold an id
+    __table_args__ = (
+        db.Index('ix_message_archives_ids', 'min_id', 'max_id'),
+        db.Index('ix_message_archives_month', 'month'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # first day of the month archived
+    month = db.Column(
+        db.Date,
+        nullable=False,
+    )
+
+    min_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    max_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    row_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # gzipped JSON lines, one message per line, ordered by id
+    data = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+
+class MessageArchiveUser(db.Model):
+    """An archive chunk holding messages of a user."""
+
+    __tablename__ = 'message_archive_users'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    archive_id = db.Column(
+        db.Integer,
+        db.ForeignKey('message_archives.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Notification(db.Model):
+    """Someone followed a user or liked one of their messages.
+
+    Events of the same kind about the same subject add up in one row
+    until the user has read it ("12 people liked your warble").
+    """
+
+    __tablename__ = 'notifications'
+
+    __table_args__ = (
+        # a user's inbox, newest first
+        db.Index('ix_notifications_user_id_updated_at',
+                 'user_id', 'updated_at'),
+        # the unread row new events join
+        db.Index('uq_notifications_unread',
+                 'user_id', 'kind', 'subject_id',
+                 unique=True, postgresql_where=db.text('NOT read')),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # who is notified
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # "follow" or "like"
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the liked message's id; 0 for follows
+    subject_id = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # the most recent follower or liker
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class UserShard(db.Model):
+    """Which message shard holds a user's messages and likes."""
+
+    __tablename__ = 'user_shards'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # writes are refused while the user's rows are copied to a new shard
+    moving = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
+
+class IdBlock(db.Model):
+    """Next unallocated id of a table whose rows live on several shards."""
+
+    __tablename__ = 'id_blocks'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    next_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work, claimed and run by a worker process."""
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        db.Index('ix_jobs_claim', 'status', 'priority', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default="{}",
+    )
+
+    # one of "queued", "running", "done", "failed"
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="queued",
+    )
+
+    # higher priority jobs are claimed first
+    priority = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind}, {self.status}>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
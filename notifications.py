@@ -0,0 +1,256 @@
+"""Notifications: "alice followed you", "12 people liked your warble".
+
+Views call `notifications.notify(kind, target, actor_id)` once their own
+commit succeeded. Writing a row per event would double the writes of
+the busiest endpoints, so events are buffered in process memory instead:
+repeats of the same kind about the same target coalesce, and a
+background thread writes the buffer every NOTIFICATIONS_FLUSH_INTERVAL
+seconds (sooner once NOTIFICATIONS_BATCH_SIZE events are waiting) in
+one transaction:
+
+    - one upsert into the unread row of each (user, kind, subject),
+      adding to its actor count
+    - a trim of each affected inbox to its newest NOTIFICATIONS_INBOX_SIZE
+    - a recount of users.unread_notifications for those users
+
+so the unread badge is read straight off the user row the request has
+loaded anyway. Like recipients are looked up at flush time too, one
+query per shard per batch.
+
+Buffered events are lost if the process dies before a flush; at exit
+the buffer is flushed. With NOTIFICATIONS_FLUSH_INTERVAL set to 0 no
+thread is started and the buffer is written only by `flush`, or when it
+reaches the batch size.
+"""
+
+import atexit
+import os
+import threading
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import Message, Notification, User, db
+from sharding import shards
+
+FOLLOW = "follow"
+LIKE = "like"
+
+NOTIFICATIONS = Notification.__table__
+USERS = User.__table__
+
+
+def _unread_count():
+    """Unread notifications of the users row being updated."""
+
+    return (select([func.count()])
+            .where(NOTIFICATIONS.c.user_id == USERS.c.id)
+            .where(NOTIFICATIONS.c.read.is_(False))
+            .as_scalar())
+
+
+class _Buffer:
+    """Per-app pending events and the thread writing them."""
+
+    def __init__(self, app):
+        self.app = app
+        self.flush_interval = app.config['NOTIFICATIONS_FLUSH_INTERVAL']
+        self.batch_size = app.config['NOTIFICATIONS_BATCH_SIZE']
+        self.inbox_size = app.config['NOTIFICATIONS_INBOX_SIZE']
+        # (kind, target) -> {actor_id: time of their latest event}
+        self.events = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        # one flush at a time, so upserts of the same row don't race
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pid = None
+
+
+class Notifier:
+    """Buffers notification events and writes them in batches; bind with
+    `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault('NOTIFICATIONS_FLUSH_INTERVAL', float(
+            os.environ.get('NOTIFICATIONS_FLUSH_INTERVAL', 2)))
+        app.config.setdefault('NOTIFICATIONS_BATCH_SIZE', 500)
+        app.config.setdefault('NOTIFICATIONS_INBOX_SIZE', 100)
+
+        buffer = app.extensions['notifications'] = _Buffer(app)
+        atexit.register(self._flush_at_exit, buffer)
+
+    def _buffer(self):
+        return current_app.extensions['notifications']
+
+    def notify(self, kind, target, actor_id):
+        """Record that `actor_id` followed user `target` (FOLLOW) or liked
+        message `target` (LIKE)."""
+
+        buffer = self._buffer()
+        with buffer.lock:
+            actors = buffer.events.setdefault((kind, target), {})
+            if actor_id not in actors:
+                buffer.size += 1
+            actors[actor_id] = datetime.utcnow()
+            full = buffer.size >= buffer.batch_size
+
+        if buffer.flush_interval:
+            self._start(buffer)
+            if full:
+                buffer.wake.set()
+        elif full:
+            self.flush()
+
+    def _start(self, buffer):
+        """Start the flush thread, again in each forked worker."""
+
+        with buffer.lock:
+            if buffer.pid == os.getpid():
+                return
+            buffer.pid = os.getpid()
+        threading.Thread(target=self._run, args=(buffer,),
+                         name="notifications", daemon=True).start()
+
+    def _run(self, buffer):
+        while True:
+            buffer.wake.wait(buffer.flush_interval)
+            buffer.wake.clear()
+            with buffer.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    buffer.app.logger.exception(
+                        "Writing notifications failed")
+
+    def _flush_at_exit(self, buffer):
+        if buffer.events:
+            with buffer.app.app_context():
+                self.flush()
+
+    def flush(self):
+        """Write the buffered events; return notifications written."""
+
+        buffer = self._buffer()
+        with buffer.flush_lock:
+            with buffer.lock:
+                events, buffer.events, buffer.size = buffer.events, {}, 0
+            if not events:
+                return 0
+
+            rows = self._rows(events)
+            if rows:
+                with db.engine.begin() as conn:
+                    self._write(conn, rows, buffer.inbox_size)
+            return len(rows)
+
+    def _rows(self, events):
+        """Notification rows for `events`, recipients resolved."""
+
+        message_ids = [target for kind, target in events if kind == LIKE]
+        authors = dict(shards.gather(
+            lambda session, shard:
+                session.query(Message.id, Message.user_id)
+                .filter(Message.id.in_(message_ids)))) if message_ids else {}
+
+        recipients = {target if kind == FOLLOW else authors.get(target)
+                      for kind, target in events}
+        recipients.discard(None)
+        # skip users deleted since the event
+        existing = {user_id for (user_id,) in db.session.query(User.id)
+                    .filter(User.id.in_(recipients))} if recipients else set()
+
+        rows = []
+        for (kind, target), actors in events.items():
+            recipient = target if kind == FOLLOW else authors.get(target)
+            actors = {actor_id: when for actor_id, when in actors.items()
+                      if actor_id != recipient}
+            if recipient not in existing or not actors:
+                continue
+            latest = max(actors, key=actors.get)
+            rows.append({
+                "user_id": recipient,
+                "kind": kind,
+                "subject_id": target if kind == LIKE else 0,
+                "actor_id": latest,
+                "actor_count": len(actors),
+                "read": False,
+                "created_at": actors[latest],
+                "updated_at": actors[latest],
+            })
+        return rows
+
+    def _write(self, conn, rows, inbox_size):
+        upsert = insert(NOTIFICATIONS)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=['user_id', 'kind', 'subject_id'],
+            index_where=text('NOT read'),
+            set_={
+                "actor_id": upsert.excluded.actor_id,
+                "actor_count": (NOTIFICATIONS.c.actor_count
+                                + upsert.excluded.actor_count),
+                "updated_at": upsert.excluded.updated_at,
+            })
+        conn.execute(upsert, rows)
+
+        user_ids = sorted({row["user_id"] for row in rows})
+
+        ranked = (select([
+            NOTIFICATIONS.c.id,
+            func.row_number().over(
+                partition_by=NOTIFICATIONS.c.user_id,
+                order_by=NOTIFICATIONS.c.updated_at.desc()).label('rank'),
+        ]).where(NOTIFICATIONS.c.user_id.in_(user_ids)).alias('ranked'))
+        conn.execute(NOTIFICATIONS.delete().where(NOTIFICATIONS.c.id.in_(
+            select([ranked.c.id]).where(ranked.c.rank > inbox_size))))
+
+        conn.execute(USERS.update()
+                     .where(USERS.c.id.in_(user_ids))
+                     .values(unread_notifications=_unread_count()))
+
+    def inbox(self, user):
+        """`user`'s notifications, newest first, and mark them read.
+
+        Each has `actor`, `message` (likes) and `unread` set.
+        """
+
+        unread_ids = set()
+        if user.unread_notifications:
+            mark_read = (NOTIFICATIONS.update()
+                         .where(NOTIFICATIONS.c.user_id == user.id)
+                         .where(NOTIFICATIONS.c.read.is_(False))
+                         .values(read=True)
+                         .returning(NOTIFICATIONS.c.id))
+            with db.engine.begin() as conn:
+                unread_ids = {notification_id for (notification_id,)
+                              in conn.execute(mark_read)}
+                # recounted rather than zeroed: a flush may have added more
+                conn.execute(USERS.update()
+                             .where(USERS.c.id == user.id)
+                             .values(unread_notifications=_unread_count()))
+            set_committed_value(user, 'unread_notifications', 0)
+
+        notifications = (Notification.query
+                         .filter(Notification.user_id == user.id)
+                         .order_by(Notification.updated_at.desc())
+                         .limit(self._buffer().inbox_size)
+                         .all())
+
+        actor_ids = {n.actor_id for n in notifications if n.actor_id}
+        actors = {
+            actor.id: actor
+            for actor in User.query.filter(User.id.in_(actor_ids))
+        } if actor_ids else {}
+        messages = shards.get_messages(
+            [n.subject_id for n in notifications if n.kind == LIKE])
+        for notification in notifications:
+            notification.actor = actors.get(notification.actor_id)
+            notification.message = messages.get(notification.subject_id)
+            notification.unread = notification.id in unread_ids
+        return notifications
+
+
+notifications = Notifier()
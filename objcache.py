@@ -0,0 +1,406 @@
+"""Read-through cache of User and Message rows by id.
+
+Profile pages and message pages look up the same few hot users and
+messages over and over, and they rarely change. `object_cache.get_user`
+and `object_cache.get_message` answer from
+
+    1. an LRU of CACHE_SIZE rows in each worker process,
+    2. a shared redis tier, if CACHE_STORAGE_URL is a redis:// URL,
+    3. the database (messages from their shard), filling both tiers.
+
+Rows are cached as their column values (never the password hash) and
+turned back into objects on each hit: users are added to db.session so
+relationships still load, messages come back detached with their
+author attached, as `shards.get_messages` returns them.
+
+Changes go through the session: a flush that updates or deletes a
+cached row, or a bulk update/delete of its table, marks it, and when
+that transaction commits the row is dropped from this worker's LRU and
+the shared tier, and the keys are sent to the other workers with a
+Postgres NOTIFY on CACHE_CHANNEL, which a listener thread in each worker
+applies to its own LRU. Writes that bypass the ORM (Core updates of
+users.unread_notifications and users.influence, partition archiving)
+are covered by CACHE_TTL seconds, the longest a row is served from
+either tier. If the listener loses its connection it clears the LRU
+once reconnected, as notifications may have been missed.
+
+Hits and misses per tier are counted per worker (`stats`, served at
+/api/cache/stats).
+"""
+
+import json
+import os
+import pickle
+import select
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from flask import abort, current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import Message, User, db
+from sharding import shards
+
+CACHE_CHANNEL = "warbler_cache"
+
+# per model: the table keys are made from and columns left out
+MODELS = {
+    User.__tablename__: (User, {"password"}),
+    Message.__tablename__: (Message, set()),
+}
+
+# seconds between reconnect attempts of the invalidation listener
+LISTEN_RETRY = 5
+
+
+def _key(table, row_id):
+    return f"{table}:{row_id}"
+
+
+def _snapshot(obj, excluded):
+    return {attr.key: getattr(obj, attr.key)
+            for attr in inspect(type(obj)).column_attrs
+            if attr.key not in excluded}
+
+
+def _restore(model, values):
+    """A detached `model` instance with the cached column `values`; other
+    columns load on first access once it is in a session."""
+
+    obj = inspect(model).class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    return obj
+
+
+class LocalTier:
+    """LRU of snapshots in process memory, each kept `ttl` seconds."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, values):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                if key.endswith(":*"):
+                    prefix = key[:-1]
+                    for cached in [cached for cached in self._entries
+                                   if cached.startswith(prefix)]:
+                        del self._entries[cached]
+                else:
+                    self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisTier:
+    """Snapshots in redis, shared by every process using the same server."""
+
+    def __init__(self, url, ttl, prefix="objcache:"):
+        # redis is only needed for multi-process deployments
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        data = self._redis.get(self.prefix + key)
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, values):
+        self._redis.setex(self.prefix + key, self.ttl, pickle.dumps(values))
+
+    def delete(self, keys):
+        exact = [self.prefix + key for key in keys if not key.endswith(":*")]
+        if exact:
+            self._redis.delete(*exact)
+        for key in keys:
+            if key.endswith(":*"):
+                for cached in self._redis.scan_iter(self.prefix + key):
+                    self._redis.delete(cached)
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + "*"):
+            self._redis.delete(key)
+
+
+class _Cache:
+    """Per-app tiers, counters and invalidation listener."""
+
+    def __init__(self, app):
+        self.enabled = app.config['CACHE_ENABLED']
+        ttl = app.config['CACHE_TTL']
+        self.local = LocalTier(app.config['CACHE_SIZE'], ttl)
+        url = app.config['CACHE_STORAGE_URL']
+        self.shared = RedisTier(url, ttl) if url.startswith('redis') else None
+        self.broadcast = app.config['CACHE_BROADCAST']
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        # bumped by every invalidation: a row loaded across one isn't
+        # stored, as it may predate the change
+        self.generation = 0
+        # this worker's own notifications are skipped by the listener
+        self.origin = uuid.uuid4().hex
+        self.listener = None
+        self.listener_pid = None
+        # set once the listener is subscribed
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+
+class ObjectCache:
+    """Read-through cache of users and messages; bind with `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_ENABLED', True)
+        app.config.setdefault('CACHE_SIZE', 10_000)
+        app.config.setdefault('CACHE_TTL', 300)
+        app.config.setdefault('CACHE_STORAGE_URL', os.environ.get(
+            'CACHE_STORAGE_URL', 'memory://'))
+        app.config.setdefault('CACHE_BROADCAST', True)
+        app.extensions['objcache'] = _Cache(app)
+
+    def _cache(self):
+        cache = current_app.extensions['objcache']
+        if (cache.enabled and cache.broadcast
+                and cache.listener_pid != os.getpid()):
+            self._start_listener(cache)
+        return cache
+
+    ##########################################################################
+    # Lookups
+
+    def _lookup(self, table, row_id, load):
+        """Cached snapshot of a row, loading it with `load(row_id)` (which
+        returns the object or None) on a miss. Returns (snapshot or None,
+        object if it was just loaded)."""
+
+        cache = self._cache()
+        if not cache.enabled:
+            return None, load(row_id)
+
+        key = _key(table, row_id)
+        values = cache.local.get(key)
+        if values is not None:
+            cache.count(f"{table}.local_hits")
+            return values, None
+
+        if cache.shared is not None:
+            values = cache.shared.get(key)
+            if values is not None:
+                cache.count(f"{table}.shared_hits")
+                cache.local.set(key, values)
+                return values, None
+
+        cache.count(f"{table}.misses")
+        generation = cache.generation
+        obj = load(row_id)
+        if obj is None:
+            return None, None
+        values = _snapshot(obj, MODELS[table][1])
+        if generation == cache.generation:
+            cache.local.set(key, values)
+            if cache.shared is not None:
+                cache.shared.set(key, values)
+        return values, obj
+
+    def get_user(self, user_id):
+        """The user with `user_id`, in db.session, or None."""
+
+        self._cache()
+        # already loaded in this session (e.g. g.user): use that one
+        existing = db.session.identity_map.get(
+            inspect(User).identity_key_from_primary_key([user_id]))
+        if existing is not None:
+            return existing
+
+        values, loaded = self._lookup(User.__tablename__, user_id,
+                                      db.session.query(User).get)
+        if loaded is not None or values is None:
+            return loaded
+        return db.session.merge(_restore(User, values), load=False)
+
+    def get_user_or_404(self, user_id):
+        return self.get_user(user_id) or abort(404)
+
+    def get_message(self, message_id):
+        """The message with `message_id` and its author, detached, or
+        None."""
+
+        values, loaded = self._lookup(
+            Message.__tablename__, message_id,
+            lambda row_id: shards.get_messages([row_id]).get(row_id))
+        if loaded is not None or values is None:
+            return loaded
+        msg = _restore(Message, values)
+        set_committed_value(msg, 'user', self.get_user(msg.user_id))
+        return msg
+
+    ##########################################################################
+    # Invalidation
+
+    def invalidate(self, keys, broadcast=True):
+        """Drop "table:id" (or "table:*") `keys` from this worker's LRU
+        and the shared tier, and tell the other workers."""
+
+        cache = self._cache()
+        if not keys:
+            return
+        keys = sorted(keys)
+        cache.generation += 1
+        cache.local.delete(keys)
+        if cache.shared is not None:
+            cache.shared.delete(keys)
+        with cache.stats_lock:
+            cache.stats["invalidations"] += len(keys)
+        if broadcast and cache.broadcast:
+            payload = json.dumps({"origin": cache.origin, "keys": keys})
+            # a SELECT isn't autocommitted, and NOTIFY waits for a commit
+            notify = (db.text("SELECT pg_notify(:channel, :payload)")
+                      .execution_options(autocommit=True))
+            db.engine.execute(notify, channel=CACHE_CHANNEL, payload=payload)
+
+    def clear(self):
+        cache = current_app.extensions['objcache']
+        cache.generation += 1
+        cache.local.clear()
+        if cache.shared is not None:
+            cache.shared.clear()
+
+    def stats(self):
+        """This worker's counters and LRU size."""
+
+        cache = current_app.extensions['objcache']
+        with cache.stats_lock:
+            stats = dict(cache.stats)
+        stats["local_size"] = len(cache.local)
+        stats["pid"] = os.getpid()
+        return stats
+
+    def _start_listener(self, cache):
+        with cache.lock:
+            # after a fork the parent's thread is gone
+            if cache.listener_pid == os.getpid():
+                return
+            if db.engine.dialect.name != 'postgresql':
+                cache.broadcast = False
+                return
+            cache.listener = threading.Thread(
+                target=self._listen,
+                args=(current_app._get_current_object(), cache),
+                name="objcache-listener", daemon=True)
+            cache.listener_pid = os.getpid()
+            cache.listener.start()
+
+    def _listen(self, app, cache):
+        connected_before = False
+        while True:
+            try:
+                with app.app_context():
+                    # a connection of its own, outside the pool
+                    raw = db.engine.raw_connection()
+                raw.detach()
+                conn = raw.connection
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {CACHE_CHANNEL}")
+                cache.ready.set()
+                if connected_before:
+                    # notifications may have been missed meanwhile
+                    cache.generation += 1
+                    cache.local.clear()
+                connected_before = True
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._apply(cache, conn.notifies.pop(0).payload)
+            except Exception:
+                app.logger.exception("Cache invalidation listener failed")
+                time.sleep(LISTEN_RETRY)
+
+    def _apply(self, cache, payload):
+        message = json.loads(payload)
+        if message["origin"] != cache.origin:
+            cache.generation += 1
+            cache.local.delete(message["keys"])
+            cache.count("remote_invalidations")
+
+
+object_cache = ObjectCache()
+
+
+##############################################################################
+# Session events: any session (main or shard) changing a cached row
+
+def _pending(session):
+    return session.info.setdefault('objcache_keys', set())
+
+
+@event.listens_for(Session, "after_flush")
+def _note_changes(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        # following someone changes a collection, not the user's row
+        if table in MODELS and (
+                obj in session.deleted
+                or session.is_modified(obj, include_collections=False)):
+            _pending(session).add(_key(table, inspect(obj).identity[0]))
+
+
+def _note_bulk(context):
+    table = context.mapper.local_table.name
+    if table in MODELS:
+        _pending(context.session).add(_key(table, "*"))
+
+
+event.listen(Session, "after_bulk_update", _note_bulk)
+event.listen(Session, "after_bulk_delete", _note_bulk)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate(session):
+    keys = session.info.pop('objcache_keys', None)
+    if keys and has_app_context() and 'objcache' in current_app.extensions:
+        object_cache.invalidate(keys)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget(session):
+    session.info.pop('objcache_keys', None)
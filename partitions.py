@@ -0,0 +1,350 @@
+"""Monthly partitions of the messages table, and archiving old months.
+
+On Postgres, messages is partitioned by RANGE (timestamp), one partition
+per calendar month named messages_pYYYY_MM. Queries filtered or ordered
+by timestamp only touch the months they need, and dropping a month is a
+metadata change instead of a huge DELETE.
+
+Postgres rejects rows no partition accepts, so partitions are created
+ahead of time: `maintain` (run daily by the "partitions.maintain" job,
+or `flask partitions maintain`) keeps MONTHS_AHEAD months ready and
+moves partitions older than ARCHIVE_AFTER months into message_archives
+as gzipped JSON lines, in chunks of up to ARCHIVE_CHUNK_ROWS messages
+with consecutive ids. message_archive_users records which chunks hold
+each user's messages. Archived messages leave the feeds and timelines;
+`find_archived` still finds them by id for the message page, reading
+only the chunk whose id range covers it. Deleting archived messages,
+one by its owner (`delete_archived`) or all of a deleted user's
+(`delete_user_archives`), rewrites the chunks holding them.
+
+Likes, tags and mentions keep pointing at archived messages; they have
+no foreign key to messages (a partitioned table's primary key has to
+include the partition key), so `ShardRouter.purge_messages` deletes them
+instead.
+
+Only the main database is partitioned; shards keep a plain table.
+"""
+
+import gzip
+import io
+import json
+import re
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+from sqlalchemy import select, text
+
+from jobs import enqueue, job
+from models import Job, Message, MessageArchive, MessageArchiveUser, db
+from sharding import attach_authors
+
+ARCHIVES = MessageArchive.__table__
+ARCHIVE_USERS = MessageArchiveUser.__table__
+
+# partitions kept ready beyond the current month
+MONTHS_AHEAD = 3
+
+# partitions older than this many months are archived
+ARCHIVE_AFTER = 12
+
+# messages per archive chunk, read and rewritten as a whole
+ARCHIVE_CHUNK_ROWS = 1000
+
+# decompressed archive chunks kept in memory per process
+ARCHIVE_CACHE_SIZE = 32
+
+PARTITION_NAME = re.compile(r"^messages_p(\d{4})_(\d{2})$")
+
+
+def month_start(when):
+    """First day of the month `when` falls in."""
+
+    return date(when.year, when.month, 1)
+
+
+def add_months(month, months):
+    """The first day of the month `months` after `month` (may be negative)."""
+
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_p{month.year:04d}_{month.month:02d}"
+
+
+def existing_partitions(conn):
+    """{month: partition name} of the partitions of messages."""
+
+    rows = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'messages'::regclass"))
+    partitions = {}
+    for (name,) in rows:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def create_partitions(conn, start, end):
+    """Create the missing partitions for the months from `start` to `end`
+    (dates or datetimes, both inclusive); return the months created."""
+
+    existing = existing_partitions(conn)
+    archived = {month for (month,) in conn.execute(
+        select([ARCHIVES.c.month]).distinct())} if conn.dialect.has_table(
+        conn, ARCHIVES.name) else set()
+
+    created = []
+    month, last = month_start(start), month_start(end)
+    while month <= last:
+        if month not in existing and month not in archived:
+            conn.execute(text(
+                f"CREATE TABLE {partition_name(month)} PARTITION OF messages "
+                f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"))
+            created.append(month)
+        month = add_months(month, 1)
+    return created
+
+
+def create_upcoming(conn, months_ahead=MONTHS_AHEAD):
+    """Create partitions for this month and the next `months_ahead`."""
+
+    this_month = month_start(datetime.utcnow())
+    return create_partitions(conn, this_month,
+                             add_months(this_month, months_ahead))
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Alembic filter: partitions are managed here, not by migrations."""
+
+    return not (type_ == "table" and reflected
+                and PARTITION_NAME.match(name))
+
+
+##############################################################################
+# Archiving
+
+def serialize_row(row):
+    timestamp = row["timestamp"]
+    return json.dumps({
+        "id": row["id"],
+        "text": row["text"],
+        "timestamp": (timestamp if isinstance(timestamp, str)
+                      else timestamp.isoformat()),
+        "user_id": row["user_id"],
+    })
+
+
+def _decode(data):
+    with gzip.open(io.BytesIO(data), "rt") as lines:
+        return [json.loads(line) for line in lines]
+
+
+def _store_chunk(conn, month, rows, archive_id=None):
+    """Write `rows` (ordered by id) as one chunk of `month`, replacing
+    chunk `archive_id` if given, and index its users."""
+
+    values = dict(month=month,
+                  min_id=rows[0]["id"],
+                  max_id=rows[-1]["id"],
+                  row_count=len(rows),
+                  data=gzip.compress(
+                      "\n".join(serialize_row(row) for row in rows).encode()))
+    if archive_id is None:
+        archive_id = conn.execute(ARCHIVES.insert().values(**values)
+                                  .returning(ARCHIVES.c.id)).scalar()
+    else:
+        conn.execute(ARCHIVES.update()
+                     .where(ARCHIVES.c.id == archive_id)
+                     .values(**values))
+        conn.execute(ARCHIVE_USERS.delete()
+                     .where(ARCHIVE_USERS.c.archive_id == archive_id))
+    conn.execute(ARCHIVE_USERS.insert(), [
+        {"user_id": user_id, "archive_id": archive_id}
+        for user_id in sorted({row["user_id"] for row in rows})])
+
+
+def archive_rows(conn, month, rows):
+    """Store `rows` of `month` (dicts or rows with id, text, timestamp
+    and user_id, ordered by id) in ARCHIVE_CHUNK_ROWS chunks; return the
+    number of chunks."""
+
+    chunks = 0
+    for start in range(0, len(rows), ARCHIVE_CHUNK_ROWS):
+        _store_chunk(conn, month, rows[start:start + ARCHIVE_CHUNK_ROWS])
+        chunks += 1
+    return chunks
+
+
+def archive_partition(conn, month):
+    """Move one month of messages into message_archives; return the count.
+
+    Detaching takes a brief exclusive lock on messages, so run this off
+    peak (the daily job does).
+    """
+
+    name = existing_partitions(conn)[month]
+    rows = conn.execute(text(
+        f"SELECT id, text, timestamp, user_id FROM {name} ORDER BY id")
+    ).fetchall()
+    archive_rows(conn, month, rows)
+
+    conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+    conn.execute(text(f"DROP TABLE {name}"))
+    return len(rows)
+
+
+def maintain(months_ahead=MONTHS_AHEAD, archive_after=ARCHIVE_AFTER):
+    """Create upcoming partitions and archive old ones.
+
+    Returns (months created, months archived).
+    """
+
+    cutoff = add_months(month_start(datetime.utcnow()), -archive_after)
+    with db.engine.begin() as conn:
+        created = create_upcoming(conn, months_ahead)
+        archived = [month for month in sorted(existing_partitions(conn))
+                    if month < cutoff]
+        for month in archived:
+            archive_partition(conn, month)
+    return created, archived
+
+
+@lru_cache(maxsize=ARCHIVE_CACHE_SIZE)
+def _archived_rows(archive_id, max_id, row_count):
+    """{id: row} of one chunk; `max_id` and `row_count` tell a
+    rewritten chunk apart (rewrites only ever remove rows)."""
+
+    data = (db.session.query(MessageArchive.data)
+            .filter(MessageArchive.id == archive_id)
+            .scalar())
+    return {row["id"]: row for row in _decode(data)}
+
+
+def iter_archived(conn, user_id):
+    """Rows of `user_id`'s archived messages, oldest month first.
+
+    Archives are loaded one chunk at a time.
+    """
+
+    archive_ids = [archive_id for (archive_id,) in conn.execute(
+        select([ARCHIVES.c.id])
+        .order_by(ARCHIVES.c.month, ARCHIVES.c.min_id))]
+    for archive_id in archive_ids:
+        data = conn.execute(select([ARCHIVES.c.data])
+                            .where(ARCHIVES.c.id == archive_id)).scalar()
+        for row in _decode(data):
+            if row["user_id"] == user_id:
+                yield row
+
+
+def find_archived(message_id):
+    """The archived message with `message_id`, with its author, or None.
+
+    Returns a Message that isn't in any session.
+    """
+
+    candidates = (db.session
+                  .query(MessageArchive.id, MessageArchive.max_id,
+                         MessageArchive.row_count)
+                  .filter(MessageArchive.min_id <= message_id,
+                          MessageArchive.max_id >= message_id))
+
+    for archive_id, max_id, row_count in candidates:
+        row = _archived_rows(archive_id, max_id, row_count).get(message_id)
+        if row is not None:
+            msg = Message(id=row["id"],
+                          text=row["text"],
+                          timestamp=datetime.fromisoformat(row["timestamp"]),
+                          user_id=row["user_id"])
+            msg = attach_authors([msg])[0]
+            # left behind by a user deleted without their archive
+            return msg if msg.user is not None else None
+    return None
+
+
+def _remove_rows(conn, archive_ids, remove):
+    """Rewrite chunks `archive_ids` without the rows `remove(row)` is
+    true for; return the ids of the messages removed."""
+
+    removed = []
+    for archive_id in sorted(archive_ids):
+        chunk = conn.execute(select([ARCHIVES.c.month, ARCHIVES.c.data])
+                             .where(ARCHIVES.c.id == archive_id)
+                             .with_for_update()).first()
+        if chunk is None:
+            continue
+        rows = _decode(chunk.data)
+        kept = [row for row in rows if not remove(row)]
+        if len(kept) == len(rows):
+            continue
+        removed += [row["id"] for row in rows if remove(row)]
+        if kept:
+            _store_chunk(conn, chunk.month, kept, archive_id)
+        else:
+            conn.execute(ARCHIVES.delete()
+                         .where(ARCHIVES.c.id == archive_id))
+    return removed
+
+
+def _user_archive_ids(conn, user_id, *criteria):
+    """Ids of the chunks holding messages of `user_id`, optionally only
+    those matching `criteria` too."""
+
+    query = (select([ARCHIVE_USERS.c.archive_id])
+             .select_from(ARCHIVE_USERS.join(
+                 ARCHIVES, ARCHIVES.c.id == ARCHIVE_USERS.c.archive_id))
+             .where(ARCHIVE_USERS.c.user_id == user_id))
+    for criterion in criteria:
+        query = query.where(criterion)
+    return [archive_id for (archive_id,) in conn.execute(query)]
+
+
+def delete_archived(message_id, user_id):
+    """Delete archived message `message_id` if `user_id` wrote it;
+    return whether it did."""
+
+    with db.engine.begin() as conn:
+        archive_ids = _user_archive_ids(
+            conn, user_id,
+            ARCHIVES.c.min_id <= message_id, ARCHIVES.c.max_id >= message_id)
+        return bool(_remove_rows(
+            conn, archive_ids,
+            lambda row: row["id"] == message_id
+            and row["user_id"] == user_id))
+
+
+def delete_user_archives(user_id):
+    """Delete every archived message of `user_id`; return their ids."""
+
+    with db.engine.begin() as conn:
+        return _remove_rows(conn, _user_archive_ids(conn, user_id),
+                            lambda row: row["user_id"] == user_id)
+
+
+@job("partitions.maintain", max_concurrency=1)
+def maintain_daily():
+    """Run `maintain`, then queue the next run for a day from now."""
+
+    maintain()
+    schedule(delay=timedelta(days=1).total_seconds())
+
+
+def schedule(delay=0):
+    """Queue the maintenance job unless one is already queued.
+
+    Returns the job, or None if one was queued already. Commits.
+    """
+
+    queued = (Job.query
+              .filter(Job.kind == "partitions.maintain",
+                      Job.status == "queued")
+              .first())
+    if queued is not None:
+        return None
+    new_job = enqueue("partitions.maintain", delay=delay)
+    db.session.commit()
+    return new_job
@@ -0,0 +1,279 @@
+"""Opt-in profiling of single requests in production.
+
+A request is profiled when
+
+    - it carries an `X-Warbler-Profile` header holding a token from
+      `flask profiler token` (signed with SECRET_KEY, valid for
+      PROFILER_TOKEN_MAX_AGE seconds), or
+    - it is drawn by PROFILER_SAMPLE_RATE (0 to 1, default 0).
+
+While it runs, a thread samples its stack every PROFILER_INTERVAL
+seconds (no more often than the interpreter's switch interval, 5ms by
+default, while the request holds the GIL), and the SQL it executes is
+timed. When it finishes (for a streamed response, once the body has
+been sent) two files are written to PROFILER_DIR:
+
+    <name>.folded   one "frame;frame;frame count" line per stack, for
+                    flamegraph.pl, speedscope or inferno
+    <name>.json     url, endpoint, status, duration and each statement
+                    with its parameters and time
+
+Only the newest PROFILER_KEEP profiles are kept. The response names
+the profile in an `X-Warbler-Profile-Id` header.
+
+Requests not profiled pay for a header lookup and, with a sample rate,
+one random draw. The SQL hooks are only installed once something has
+been profiled, and then cost a dict lookup per statement.
+"""
+
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+from flask import current_app, g, request, stream_with_context
+from itsdangerous import BadSignature, TimestampSigner
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+HEADER = "X-Warbler-Profile"
+ID_HEADER = "X-Warbler-Profile-Id"
+
+# thread id -> _Profile running on it, for the SQL hooks
+_running = {}
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+
+class _Profile:
+    """Stack samples and SQL timings of one request."""
+
+    def __init__(self, interval):
+        self.thread_id = threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self.queries = []
+        self.started = time.perf_counter()
+        self.duration = None
+        self._query_started = None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample,
+                                         name="profiler", daemon=True)
+
+    def start(self):
+        _running[self.thread_id] = self
+        self._sampler.start()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started
+        _running.pop(self.thread_id, None)
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_fold(frame)] += 1
+
+    def before_execute(self, statement, parameters):
+        self._query_started = time.perf_counter()
+
+    def after_execute(self, statement, parameters):
+        self.queries.append({
+            "statement": statement,
+            "parameters": repr(parameters),
+            "seconds": round(time.perf_counter() - self._query_started, 6),
+        })
+
+
+@lru_cache(maxsize=None)
+def _frame_name(code):
+    filename = code.co_filename
+    for path in sys.path:
+        if path and filename.startswith(path):
+            filename = filename[len(path):].lstrip(os.sep)
+            break
+    # frames are separated by ";"
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(
+        ";", ":")
+
+
+def _fold(frame):
+    """The stack above `frame`, root first, in folded form."""
+
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    profile = _running.get(threading.get_ident())
+    if profile is not None:
+        profile.before_execute(statement, parameters)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = _running.get(threading.get_ident())
+    if profile is not None:
+        profile.after_execute(statement, parameters)
+
+
+def _install_hooks():
+    global _hooks_installed
+
+    with _hooks_lock:
+        if not _hooks_installed:
+            # every engine, sharded ones included
+            event.listen(Engine, "before_cursor_execute",
+                         _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute",
+                         _after_cursor_execute)
+            _hooks_installed = True
+
+
+class Profiler:
+    """Profiles sampled or flagged requests; bind with `init_app`."""
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_SAMPLE_RATE', float(
+            os.environ.get('PROFILER_SAMPLE_RATE', 0)))
+        app.config.setdefault('PROFILER_INTERVAL', 0.005)
+        app.config.setdefault('PROFILER_DIR', os.environ.get(
+            'PROFILER_DIR',
+            os.path.join(tempfile.gettempdir(), 'warbler-profiles')))
+        app.config.setdefault('PROFILER_KEEP', 200)
+        app.config.setdefault('PROFILER_TOKEN_MAX_AGE', 3600)
+
+        app.extensions['profiler'] = TimestampSigner(app.config['SECRET_KEY'],
+                                                     salt='profile')
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        # after_request is skipped when a view raises
+        app.teardown_request(self._abandon)
+
+    def token(self):
+        """A header value that has the request profiled."""
+
+        return current_app.extensions['profiler'].sign("profile").decode()
+
+    def _wanted(self):
+        config = current_app.config
+        token = request.headers.get(HEADER)
+        if token:
+            try:
+                current_app.extensions['profiler'].unsign(
+                    token, max_age=config['PROFILER_TOKEN_MAX_AGE'])
+                return True
+            except BadSignature:
+                current_app.logger.warning("Bad profiler token")
+        rate = config['PROFILER_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def _start(self):
+        if not self._wanted():
+            return
+        _install_hooks()
+        g.profile = _Profile(current_app.config['PROFILER_INTERVAL'])
+        g.profile.start()
+
+    def _finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        name = self._name()
+        if response.is_streamed:
+            # the body, and the queries behind it, come after this returns
+            response.response = stream_with_context(self._streamed(
+                response.response, profile, response.status_code, name))
+            response.headers[ID_HEADER] = name
+            return response
+        profile.stop()
+        if self._save(profile, response.status_code, name):
+            response.headers[ID_HEADER] = name
+        return response
+
+    def _streamed(self, body, profile, status_code, name):
+        try:
+            yield from body
+        finally:
+            profile.stop()
+            self._save(profile, status_code, name)
+
+    def _abandon(self, exc):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.stop()
+            self._save(profile, 500, self._name())
+
+    def _name(self):
+        endpoint = re.sub(r"[^\w.-]", "_", request.endpoint or "unknown")
+        return (f"{datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}"
+                f"-{next(self._counter)}-{endpoint}")
+
+    def _save(self, profile, status_code, name):
+        try:
+            self._write(profile, status_code, name)
+            return True
+        except OSError:
+            current_app.logger.exception("Saving a profile failed")
+            return False
+
+    def _write(self, profile, status_code, name):
+        """Save `profile` as `name` and rotate old ones out."""
+
+        config = current_app.config
+        directory = config['PROFILER_DIR']
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, name)
+
+        with open(base + ".folded", "w") as folded:
+            for stack, count in profile.stacks.most_common():
+                folded.write(f"{stack} {count}\n")
+        with open(base + ".json", "w") as summary:
+            json.dump({
+                "url": request.url,
+                "method": request.method,
+                "endpoint": request.endpoint,
+                "status": status_code,
+                "seconds": round(profile.duration, 6),
+                "samples": sum(profile.stacks.values()),
+                "sql_seconds": round(sum(query["seconds"]
+                                         for query in profile.queries), 6),
+                "queries": profile.queries,
+            }, summary, indent=2)
+
+        self._rotate(directory, config['PROFILER_KEEP'])
+
+    def _rotate(self, directory, keep):
+        profiles = sorted(
+            (entry for entry in os.scandir(directory)
+             if entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        for entry in profiles[keep:]:
+            base = entry.path[:-len(".json")]
+            for path in (base + ".json", base + ".folded"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # another worker rotated it already
+                    pass
+
+
+profiler = Profiler()
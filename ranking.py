@@ -0,0 +1,217 @@
+"""Ranked home feed ("Top" on the home page).
+
+Instead of newest first, the messages of the people a user follows are
+ordered by
+
+    score = recency * (1 + FEED_AFFINITY_WEIGHT * affinity
+                         + FEED_ENGAGEMENT_WEIGHT * engagement)
+
+    recency     halves every FEED_HALF_LIFE hours
+    affinity    log(1 + the viewer's likes of the author's messages),
+                over their FEED_AFFINITY_LIKES latest likes
+    engagement  log(1 + the message's likes)
+
+The candidate pool is the newest FEED_POOL_SIZE messages of the last
+FEED_WINDOW days, fetched as bare (id, author, timestamp) rows; it is
+scored in one pass of NumPy array operations and only the page shown is
+loaded as Message objects. The pool size bounds the work however many
+accounts the user follows. If fetching the pool already used up
+FEED_BUDGET_MS, likes are left out of the score rather than queried,
+so slow pages degrade towards newest first instead of timing out.
+
+Pages are keyed by (score, id) and pinned to the time the first page
+was ranked at, so paging doesn't repeat or skip messages when new ones
+are posted, and ties break the same way every time.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import func
+
+from models import Likes, Message
+from sharding import shards
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def init_app(app):
+    app.config.setdefault('FEED_POOL_SIZE', 2000)
+    app.config.setdefault('FEED_WINDOW', 7)
+    app.config.setdefault('FEED_HALF_LIFE', 24)
+    app.config.setdefault('FEED_AFFINITY_LIKES', 1000)
+    app.config.setdefault('FEED_AFFINITY_WEIGHT', 1.0)
+    app.config.setdefault('FEED_ENGAGEMENT_WEIGHT', 0.5)
+    app.config.setdefault('FEED_BUDGET_MS', 150)
+
+
+##############################################################################
+# Signals
+
+def candidates(author_ids, at, window, pool_size):
+    """(ids, author ids, timestamps in epoch seconds) of the newest
+    `pool_size` messages by `author_ids` up to `at`, as arrays."""
+
+    authors_by_shard = shards.group_by_shard(author_ids)
+    rows = shards.gather(
+        lambda session, shard: (
+            session.query(Message.id, Message.user_id, Message.timestamp)
+            .filter(Message.user_id.in_(authors_by_shard[shard]),
+                    Message.timestamp <= at,
+                    Message.timestamp > at - window)
+            .order_by(Message.timestamp.desc())
+            .limit(pool_size)),
+        shards=list(authors_by_shard),
+        key=lambda row: row.timestamp, limit=pool_size)
+
+    ids = np.array([row.id for row in rows], dtype=np.int64)
+    authors = np.array([row.user_id for row in rows], dtype=np.int64)
+    timestamps = (np.array([row.timestamp for row in rows],
+                           dtype='datetime64[us]').astype(np.int64) / 1e6)
+    return ids, authors, timestamps
+
+
+def like_counts(ids):
+    """Likes of each message in `ids`, as an array aligned with it."""
+
+    message_ids = ids.tolist()
+    rows = shards.gather(
+        lambda session, shard: (
+            session.query(Likes.message_id, func.count())
+            .filter(Likes.message_id.in_(message_ids))
+            .group_by(Likes.message_id)))
+    return _align(ids, rows)
+
+
+def author_affinity(viewer_id, authors, recent_likes):
+    """How many of the viewer's `recent_likes` latest likes went to each
+    of `authors`, as an array aligned with it."""
+
+    liked = [message_id for (message_id,) in (
+        shards.session_for(viewer_id)
+        .query(Likes.message_id)
+        .filter(Likes.user_id == viewer_id)
+        .order_by(Likes.id.desc())
+        .limit(recent_likes))]
+    if not liked:
+        return np.zeros(len(authors))
+
+    rows = shards.gather(
+        lambda session, shard: (
+            session.query(Message.user_id, func.count())
+            .filter(Message.id.in_(liked))
+            .group_by(Message.user_id)))
+    return _align(authors, rows)
+
+
+def _align(keys, rows):
+    """Sum the (key, count) `rows` onto the matching entries of `keys`."""
+
+    counts = np.zeros(len(keys))
+    if not rows:
+        return counts
+    row_keys = np.array([key for key, _ in rows], dtype=np.int64)
+    row_counts = np.array([count for _, count in rows], dtype=np.float64)
+
+    unique, inverse = np.unique(keys, return_inverse=True)
+    totals = np.zeros(len(unique))
+    positions = np.searchsorted(unique, row_keys)
+    found = ((positions < len(unique))
+             & (unique[np.minimum(positions, len(unique) - 1)] == row_keys))
+    # shards each count their own likes of a message: add them up
+    np.add.at(totals, positions[found], row_counts[found])
+    return totals[inverse.reshape(-1)]
+
+
+##############################################################################
+# Scoring
+
+def score(timestamps, at, half_life, affinity, engagement,
+          affinity_weight, engagement_weight):
+    """Scores of a pool (see the module docstring), as an array."""
+
+    age_hours = ((at - EPOCH).total_seconds() - timestamps) / 3600
+    recency = np.exp2(-np.maximum(age_hours, 0) / half_life)
+    return recency * (1 + affinity_weight * np.log1p(affinity)
+                      + engagement_weight * np.log1p(engagement))
+
+
+def rank(ids, scores, after=None):
+    """Positions of the pool, best first, ties newest (largest id)
+    first; only those after the (score, id) `after` cursor if given."""
+
+    order = np.lexsort((-ids, -scores))
+    if after is not None:
+        after_score, after_id = after
+        ranked_scores, ranked_ids = scores[order], ids[order]
+        order = order[(ranked_scores < after_score)
+                      | ((ranked_scores == after_score)
+                         & (ranked_ids < after_id))]
+    return order
+
+
+##############################################################################
+# Cursors
+
+def encode_cursor(at, after_score, after_id):
+    at = (at - EPOCH) // timedelta(microseconds=1)
+    return f"{at}_{after_score!r}_{after_id}"
+
+
+def decode_cursor(cursor):
+    """(at, (score, id)) of a cursor, or None if it is missing or
+    malformed."""
+
+    try:
+        at, after_score, after_id = cursor.split("_")
+        return (EPOCH + timedelta(microseconds=int(at)),
+                (float(after_score), int(after_id)))
+    except (AttributeError, ValueError):
+        return None
+
+
+##############################################################################
+# Feed
+
+def ranked_feed(viewer_id, author_ids, cursor=None, page_size=100):
+    """One page of the ranked feed of `viewer_id`, who follows
+    `author_ids`: (messages, cursor of the next page or None)."""
+
+    config = current_app.config
+    started = time.perf_counter()
+    budget = config['FEED_BUDGET_MS'] / 1000
+
+    decoded = decode_cursor(cursor)
+    at, after = decoded or (datetime.utcnow(), None)
+
+    ids, authors, timestamps = candidates(
+        author_ids, at, timedelta(days=config['FEED_WINDOW']),
+        config['FEED_POOL_SIZE'])
+    if not len(ids):
+        return [], None
+
+    affinity = engagement = np.zeros(len(ids))
+    if time.perf_counter() - started < budget:
+        affinity = author_affinity(viewer_id, authors,
+                                   config['FEED_AFFINITY_LIKES'])
+    if time.perf_counter() - started < budget:
+        engagement = like_counts(ids)
+
+    scores = score(timestamps, at, config['FEED_HALF_LIFE'], affinity,
+                   engagement, config['FEED_AFFINITY_WEIGHT'],
+                   config['FEED_ENGAGEMENT_WEIGHT'])
+    order = rank(ids, scores, after)
+
+    page, more = order[:page_size], len(order) > page_size
+    page_ids = ids[page].tolist()
+    messages = shards.get_messages(page_ids)
+    messages = [messages[message_id] for message_id in page_ids
+                if message_id in messages]
+
+    next_cursor = None
+    if more:
+        last = page[-1]
+        next_cursor = encode_cursor(at, float(scores[last]), int(ids[last]))
+    return messages, next_cursor
@@ -0,0 +1,196 @@
+"""Token-bucket rate limiting for write and auth endpoints.
+
+Apply per route next to `util.login_required`:
+
+    @app.route('/api/likes', methods=['POST'])
+    @login_required()
+    @rate_limit(60, per=60, scope="user")
+    def create_like(): ...
+
+Buckets live in process memory by default. Set RATELIMIT_STORAGE_URL to a
+redis:// URL to share them between worker processes.
+"""
+
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, jsonify, request
+
+# Lua version of MemoryBackend.consume so check-and-take is atomic in redis.
+REDIS_CONSUME = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+  tokens = tokens - cost
+else
+  wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class MemoryBackend:
+    """Token buckets in this process's memory, shared by its threads."""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, capacity, cost=1):
+        """Take `cost` tokens from bucket `key`.
+
+        Buckets refill at `rate` tokens per second up to `capacity`.
+        Return 0 if the tokens were taken, otherwise the seconds to wait
+        until they would be available.
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (cost - tokens) / rate
+
+            if len(self._buckets) > self.max_keys:
+                self._evict()
+
+        return wait
+
+    def _evict(self):
+        """Drop the oldest half of the buckets; a missing bucket starts full."""
+
+        by_age = sorted(self._buckets, key=lambda key: self._buckets[key][1])
+        for key in by_age[:len(by_age) // 2]:
+            del self._buckets[key]
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBackend:
+    """Token buckets in redis, shared by every process using the same server."""
+
+    def __init__(self, url, prefix="ratelimit:"):
+        # redis is only needed for multi-process deployments
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        self._consume = self._redis.register_script(REDIS_CONSUME)
+
+    def consume(self, key, rate, capacity, cost=1):
+        wait = self._consume(keys=[self.prefix + key],
+                             args=[rate, capacity, cost, time.time()])
+        return float(wait)
+
+    def reset(self):
+        for key in self._redis.scan_iter(self.prefix + "*"):
+            self._redis.delete(key)
+
+
+class _Limits:
+    """Per-app switch and backend."""
+
+    def __init__(self, app):
+        self.enabled = app.config['RATELIMIT_ENABLED']
+        url = app.config['RATELIMIT_STORAGE_URL']
+        if url.startswith('redis'):
+            self.backend = RedisBackend(url)
+        else:
+            self.backend = MemoryBackend()
+
+
+class RateLimiter:
+    """Holds each app's configured backend; bind it to an app with
+    `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE_URL', 'memory://')
+
+        app.extensions['ratelimit'] = _Limits(app)
+
+    def _limits(self):
+        return current_app.extensions['ratelimit']
+
+    @property
+    def enabled(self):
+        return self._limits().enabled
+
+    @property
+    def backend(self):
+        return self._limits().backend
+
+    def reset(self):
+        self.backend.reset()
+
+
+limiter = RateLimiter()
+
+
+def _client_key(scope):
+    """Identify who is making the request for a `scope` bucket."""
+
+    if scope == "user" and g.get("user"):
+        return f"user:{g.user.id}"
+    return f"ip:{request.remote_addr}"
+
+
+def too_many_requests(wait):
+    """429 response telling the client how long to back off."""
+
+    retry_after = str(max(1, math.ceil(wait)))
+    message = "Too many requests, please slow down."
+
+    if request.is_json or request.path.startswith("/api/"):
+        resp = jsonify({"message": message})
+    else:
+        resp = message
+
+    return (resp, 429, {"Retry-After": retry_after})
+
+
+def rate_limit(limit, per=60, scope="ip", methods=None, burst=None):
+    """Allow `limit` requests every `per` seconds to the decorated view.
+
+    `scope` is "ip" or "user" (falls back to the IP when logged out).
+    `methods` limits counting to those HTTP methods, e.g. ("POST",) so
+    rendering a form is free. `burst` is the bucket size (default `limit`).
+    """
+
+    rate = limit / per
+    capacity = burst or limit
+
+    def _rate_limit(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            limits = limiter._limits()
+            if limits.enabled and (methods is None
+                                   or request.method in methods):
+                key = f"{request.endpoint}:{_client_key(scope)}"
+                wait = limits.backend.consume(key, rate, capacity)
+                if wait:
+                    return too_many_requests(wait)
+
+            return function(*args, **kwargs)
+        return wrapper
+    return _rate_limit
@@ -1,12 +1,28 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
 
+from flask_migrate import upgrade
 
+from app import create_app
+import partitions
+from models import User, Message, Follows, db
+
+app = create_app({'LOAD_MIGRATIONS': True})
+
+# rebuild the schema through migrations so indexes match production
 db.drop_all()
-db.create_all()
+db.engine.execute("DROP TABLE IF EXISTS alembic_version")
+with app.app_context():
+    upgrade()
+
+# the sample messages are older than the partitions migrations create
+with open('generator/messages.csv') as messages:
+    timestamps = [datetime.fromisoformat(row['timestamp'])
+                  for row in DictReader(messages)]
+with db.engine.begin() as conn:
+    partitions.create_partitions(conn, min(timestamps), max(timestamps))
 
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
@@ -0,0 +1,622 @@
+"""Messages and likes split across several databases by user id.
+
+With SHARD_URLS unset (the default) everything lives in the main database
+and the router just hands out `db.session`, so views are written the same
+way either way.
+
+With SHARD_URLS set to a list of database URLs, each user's messages and
+likes, plus the tag and mention rows of their messages, live on one shard.
+Users, follows, tags and the bookkeeping below stay in the main database:
+
+    user_shards   user_id -> shard, and whether the user is moving;
+                  filled in on a user's first write as user_id % N
+    id_blocks     next id of each sharded table, reserved in blocks
+
+Users without an entry have no rows anywhere, so reads route them to
+user_id % N without recording it.
+
+Ids come from `next_id` rather than each shard's own sequence, so ids are
+unique across shards and survive a user moving shards. Shards have no
+foreign keys (a like points at a message on another shard), so deletes
+cascade through `purge_messages` and `purge_user` instead. The main
+database has none to messages either (see partitions.py), so these run
+unsharded too.
+
+Reads spanning many users (home feed, trending, tag timelines) run on
+every shard they need in parallel and merge the results (`gather`).
+
+`move_user` copies a user's rows to another shard and repoints the
+directory. First it flags the user as moving and waits until every
+worker's cached directory entry from before the flag has expired
+(SHARD_DIRECTORY_TTL), plus SHARD_MOVE_GRACE for writes already under
+way. From then until the move is done, writes of that user are refused
+with `ShardMoving` (views answer 503; buffered likes and ingested rows
+wait or are rejected), so nothing is written to the old copy after it
+has been copied. Reads carry on from the old copy, which stays until
+`prune`; run that once the cached entries have expired again, or other
+workers may briefly read an empty profile.
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, func
+from sqlalchemy import UniqueConstraint, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import (IdBlock, Likes, Mention, Message, MessageTag, User,
+                    UserShard, db)
+
+MESSAGES = Message.__table__
+LIKES = Likes.__table__
+MESSAGE_TAGS = MessageTag.__table__
+MENTIONS = Mention.__table__
+SHARDED_TABLES = [MESSAGES, LIKES, MESSAGE_TAGS, MENTIONS]
+
+# longest IN list sent in one statement when copying or deleting rows
+CHUNK_SIZE = 500
+
+# directory entries cached per process before the cache is reset
+DIRECTORY_CACHE_SIZE = 100_000
+
+
+class ShardMoving(Exception):
+    """Writes of `user_ids` are refused while their rows change shards."""
+
+    def __init__(self, user_ids):
+        super().__init__(f"Moving shards: users {sorted(user_ids)}")
+        self.user_ids = set(user_ids)
+
+
+def shard_metadata():
+    """The sharded tables without foreign keys, to create shard schemas."""
+
+    metadata = MetaData()
+    for table in SHARDED_TABLES:
+        copy = Table(table.name, metadata, *[
+            Column(column.name, column.type,
+                   primary_key=column.primary_key,
+                   nullable=column.nullable,
+                   unique=column.unique,
+                   autoincrement=False)
+            for column in table.columns
+        ])
+        for index in table.indexes:
+            Index(index.name, *[copy.c[column.name] for column in index.columns],
+                  unique=index.unique)
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint):
+                copy.append_constraint(UniqueConstraint(
+                    *[column.name for column in constraint.columns],
+                    name=constraint.name))
+    return metadata
+
+
+def attach_authors(messages):
+    """Load the authors of `messages` from the main database in one query.
+
+    Sets `msg.user` without touching any session, so it works for
+    messages loaded from a shard, where the users table doesn't exist.
+    """
+
+    user_ids = {msg.user_id for msg in messages}
+    users = {
+        user.id: user
+        for user in User.query.filter(User.id.in_(user_ids))
+    } if user_ids else {}
+
+    for msg in messages:
+        set_committed_value(msg, 'user', users.get(msg.user_id))
+    return messages
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def _user_clauses(user_id, message_ids):
+    """(table, where clause) pairs selecting all of a user's shard rows."""
+
+    yield MESSAGES, MESSAGES.c.user_id == user_id
+    yield LIKES, LIKES.c.user_id == user_id
+    for chunk in _chunks(message_ids):
+        yield MESSAGE_TAGS, MESSAGE_TAGS.c.message_id.in_(chunk)
+        yield MENTIONS, MENTIONS.c.message_id.in_(chunk)
+
+
+def _message_ids(conn, user_id):
+    return [message_id for (message_id,) in conn.execute(
+        select([MESSAGES.c.id]).where(MESSAGES.c.user_id == user_id))]
+
+
+def _delete_user_rows(conn, user_id):
+    """Delete a user's rows from one database; return their message ids."""
+
+    message_ids = _message_ids(conn, user_id)
+    for table, clause in _user_clauses(user_id, message_ids):
+        conn.execute(table.delete().where(clause))
+    return message_ids
+
+
+def _copy_user(src, dst, user_id):
+    """Copy a user's rows between databases; return messages copied."""
+
+    # leftovers of an earlier move away from dst would collide
+    _delete_user_rows(dst, user_id)
+
+    message_ids = _message_ids(src, user_id)
+    for table, clause in _user_clauses(user_id, message_ids):
+        rows = [dict(row) for row in src.execute(table.select().where(clause))]
+        if rows:
+            dst.execute(table.insert(), rows)
+    return len(message_ids)
+
+
+class _ShardState:
+    """Per-app engines and caches."""
+
+    def __init__(self, urls, block_size, directory_ttl, move_grace):
+        self.engines = [create_engine(url) for url in urls]
+        self.block_size = block_size
+        self.directory_ttl = directory_ttl
+        self.move_grace = move_grace
+        # user_id -> (shard, moving, placed, expires)
+        self.directory = {}
+        self.blocks = {}
+        self.lock = threading.Lock()
+        self.executor = (ThreadPoolExecutor(max_workers=len(self.engines))
+                         if self.engines else None)
+
+
+class ShardRouter:
+    """Routes message and like queries to shards; bind with `init_app`.
+
+    State is kept per app (in `app.extensions`), so a sharded and an
+    unsharded app can live in one process.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('SHARD_URLS', [
+            url for url in os.environ.get('SHARD_URLS', '').split(',') if url
+        ])
+        app.config.setdefault('SHARD_ID_BLOCK_SIZE', 100)
+        app.config.setdefault('SHARD_DIRECTORY_TTL', 30)
+        app.config.setdefault('SHARD_MOVE_GRACE', 5)
+
+        app.extensions['shards'] = _ShardState(
+            app.config['SHARD_URLS'],
+            app.config['SHARD_ID_BLOCK_SIZE'],
+            app.config['SHARD_DIRECTORY_TTL'],
+            app.config['SHARD_MOVE_GRACE'])
+        app.teardown_appcontext(self._close_sessions)
+
+    def _state(self):
+        return current_app.extensions['shards']
+
+    @property
+    def enabled(self):
+        return bool(self._state().engines)
+
+    @property
+    def count(self):
+        """Number of shards; the main database counts as one."""
+
+        return len(self._state().engines) or 1
+
+    ##########################################################################
+    # Routing
+
+    def shard_for(self, user_id, write=False):
+        """Index of the shard holding `user_id`'s rows.
+
+        With `write`, for writing them: see `group_by_shard`.
+        """
+
+        return next(iter(self.group_by_shard([user_id], write)))
+
+    def group_by_shard(self, user_ids, write=False):
+        """Return {shard: [user ids]} for `user_ids`.
+
+        With `write` the users are placed in the directory if they
+        weren't yet, and ShardMoving is raised if any is being moved.
+        """
+
+        user_ids = list(user_ids)
+        state = self._state()
+        if not state.engines:
+            return {0: user_ids}
+
+        entries = self._entries(user_ids, write)
+        if write:
+            moving = [user_id for user_id in user_ids
+                      if entries[user_id][1]]
+            if moving:
+                raise ShardMoving(moving)
+
+        groups = defaultdict(list)
+        for user_id in user_ids:
+            groups[entries[user_id][0]].append(user_id)
+        return dict(groups)
+
+    def moving(self, user_ids):
+        """Those of `user_ids` whose writes are refused for a move."""
+
+        if not self._state().engines:
+            return set()
+        return {user_id for user_id, (_, moving, _)
+                in self._entries(list(user_ids), False).items() if moving}
+
+    def _entries(self, user_ids, place):
+        """{user_id: (shard, moving, placed)}, cached for
+        SHARD_DIRECTORY_TTL; `place` as for `_lookup`."""
+
+        state = self._state()
+        now = time.monotonic()
+        entries = {}
+        for user_id in user_ids:
+            cached = state.directory.get(user_id)
+            if cached and cached[3] > now and (cached[2] or not place):
+                entries[user_id] = cached[:3]
+
+        missing = [user_id for user_id in user_ids if user_id not in entries]
+        if missing:
+            if len(state.directory) > DIRECTORY_CACHE_SIZE:
+                state.directory.clear()
+            for user_id, entry in self._lookup(missing, place).items():
+                state.directory[user_id] = (*entry,
+                                            now + state.directory_ttl)
+                entries[user_id] = entry
+        return entries
+
+    def _lookup(self, user_ids, place=False):
+        """Read directory entries as {user_id: (shard, moving, placed)}.
+
+        Users without one are routed to user_id % N; with `place` that
+        is recorded, as it has to be before their first write.
+        """
+
+        directory = UserShard.__table__
+        query = (select([directory.c.user_id, directory.c.shard,
+                         directory.c.moving])
+                 .where(directory.c.user_id.in_(user_ids)))
+        entries = {user_id: (shard, moving, True) for user_id, shard, moving
+                   in db.engine.execute(query)}
+
+        for user_id in user_ids:
+            if user_id in entries:
+                continue
+            shard = user_id % len(self._state().engines)
+            if not place:
+                entries[user_id] = (shard, False, False)
+                continue
+            try:
+                db.engine.execute(directory.insert(),
+                                  user_id=user_id, shard=shard)
+                entries[user_id] = (shard, False, True)
+            except IntegrityError:
+                # another process placed them first, or no such user
+                placed = db.engine.execute(
+                    query.where(directory.c.user_id == user_id)).first()
+                entries[user_id] = ((shard, False, False) if placed is None
+                                    else (placed.shard, placed.moving, True))
+
+        return entries
+
+    ##########################################################################
+    # Sessions and queries
+
+    def session(self, shard):
+        """This app context's session on `shard` (db.session if unsharded).
+
+        Callers commit it themselves; it is closed with the app context.
+        """
+
+        state = self._state()
+        if not state.engines:
+            return db.session
+
+        sessions = g.setdefault('_shard_sessions', {})
+        if shard not in sessions:
+            sessions[shard] = Session(bind=state.engines[shard])
+        return sessions[shard]
+
+    def session_for(self, user_id, write=False):
+        """Session on the shard holding `user_id`'s rows; pass `write`
+        to change them (see `group_by_shard`)."""
+
+        return self.session(self.shard_for(user_id, write))
+
+    def engine_for(self, user_id):
+        """Engine of the shard holding `user_id`'s rows."""
+
+        state = self._state()
+        if not state.engines:
+            return db.engine
+        return state.engines[self.shard_for(user_id)]
+
+    def _close_sessions(self, exc):
+        for session in g.pop('_shard_sessions', {}).values():
+            session.close()
+
+    def gather(self, build, shards=None, key=None, limit=None):
+        """Run `build(session, shard)` on shards and merge the rows.
+
+        `shards` defaults to all of them. Shards are queried in parallel,
+        each on its own short-lived session, so rows come back detached.
+        With `key` the merged rows are sorted largest key first; `limit`
+        then keeps the top rows.
+        """
+
+        state = self._state()
+        if not state.engines:
+            rows = build(db.session, 0).all()
+        else:
+            shards = list(range(len(state.engines)) if shards is None
+                          else shards)
+
+            def run(shard):
+                session = Session(bind=state.engines[shard])
+                try:
+                    return build(session, shard).all()
+                finally:
+                    session.close()
+
+            if len(shards) == 1:
+                parts = [run(shards[0])]
+            else:
+                parts = state.executor.map(run, shards)
+            rows = [row for part in parts for row in part]
+
+        if key is not None:
+            rows.sort(key=key, reverse=True)
+        return rows if limit is None else rows[:limit]
+
+    def get_messages(self, message_ids):
+        """Return {id: Message} for `message_ids`, with authors loaded.
+
+        A message id doesn't say which shard holds it, so every shard is
+        asked (in parallel, one indexed lookup each).
+        """
+
+        if not message_ids:
+            return {}
+
+        messages = self.gather(
+            lambda session, shard:
+                session.query(Message).filter(Message.id.in_(message_ids)))
+        attach_authors(messages)
+        return {msg.id: msg for msg in messages}
+
+    ##########################################################################
+    # Ids
+
+    def next_id(self, table):
+        """A new id for a row of sharded `table`, or None when unsharded.
+
+        Ids are reserved from the main database SHARD_ID_BLOCK_SIZE at a
+        time, so most calls don't touch the database. Ids are unique but
+        only roughly ordered across processes.
+        """
+
+        state = self._state()
+        if not state.engines:
+            return None
+
+        with state.lock:
+            block = state.blocks.get(table)
+            if not block or block[0] >= block[1]:
+                start = self._reserve(table, state.block_size)
+                block = state.blocks[table] = [start, start + state.block_size]
+            block[0] += 1
+            return block[0] - 1
+
+    def next_ids(self, table, count):
+        """`count` new ids for rows of sharded `table`, or None when
+        unsharded; reserved together for bulk loads."""
+
+        if not self._state().engines:
+            return None
+        start = self._reserve(table, count)
+        return range(start, start + count)
+
+    def _reserve(self, name, size):
+        """Reserve `size` ids of `name`; return the first."""
+
+        blocks = IdBlock.__table__
+        while True:
+            with db.engine.begin() as conn:
+                updated = conn.execute(
+                    blocks.update()
+                    .where(blocks.c.name == name)
+                    .values(next_id=blocks.c.next_id + size))
+                if updated.rowcount:
+                    return conn.execute(
+                        select([blocks.c.next_id])
+                        .where(blocks.c.name == name)).scalar() - size
+            try:
+                db.engine.execute(blocks.insert(), name=name, next_id=1)
+            except IntegrityError:
+                pass
+
+    def _reserve_past(self, name, max_id):
+        """Make sure ids of `name` handed out from now on exceed `max_id`."""
+
+        blocks = IdBlock.__table__
+        with db.engine.begin() as conn:
+            current = conn.execute(
+                select([blocks.c.next_id]).where(blocks.c.name == name)).scalar()
+            if current is None:
+                conn.execute(blocks.insert(), name=name, next_id=max_id + 1)
+            elif current <= max_id:
+                conn.execute(blocks.update()
+                             .where(blocks.c.name == name)
+                             .values(next_id=max_id + 1))
+
+    ##########################################################################
+    # Cascading deletes
+
+    def purge_messages(self, message_ids):
+        """Delete likes, tag and mention rows of deleted messages.
+
+        Unsharded, from the main database: messages is partitioned there,
+        so these rows have no foreign key to cascade them either.
+        """
+
+        if not message_ids:
+            return
+
+        for engine in self._state().engines or [db.engine]:
+            with engine.begin() as conn:
+                for chunk in _chunks(message_ids):
+                    for table in (LIKES, MESSAGE_TAGS, MENTIONS):
+                        conn.execute(table.delete()
+                                     .where(table.c.message_id.in_(chunk)))
+
+    def purge_user(self, user_id):
+        """Delete a user's rows, and everything pointing at them.
+
+        Call before deleting the user.
+        """
+
+        message_ids = []
+        for engine in self._state().engines or [db.engine]:
+            with engine.begin() as conn:
+                message_ids += _delete_user_rows(conn, user_id)
+                conn.execute(MENTIONS.delete()
+                             .where(MENTIONS.c.user_id == user_id))
+        self.purge_messages(message_ids)
+
+    ##########################################################################
+    # Maintenance
+
+    def create_schemas(self):
+        """Create the sharded tables on every shard that lacks them."""
+
+        metadata = shard_metadata()
+        for engine in self._state().engines:
+            metadata.create_all(engine)
+
+    def import_main(self):
+        """Copy messages and likes from the main database onto shards.
+
+        For switching an existing database to sharding; the main
+        database's copies are left alone. Returns messages copied.
+        """
+
+        state = self._state()
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+        copied = 0
+        with db.engine.connect() as src:
+            for shard, members in self.group_by_shard(user_ids,
+                                                      write=True).items():
+                with state.engines[shard].begin() as dst:
+                    for user_id in members:
+                        copied += _copy_user(src, dst, user_id)
+
+            # new ids continue after the imported ones
+            for table in (MESSAGES, LIKES):
+                max_id = src.execute(select([func.max(table.c.id)])).scalar()
+                self._reserve_past(table.name, max_id or 0)
+
+        return copied
+
+    def move_user(self, user_id, target):
+        """Copy a user's rows to shard `target` and route them there.
+
+        Returns messages copied. The old copy is left for `prune`.
+        """
+
+        return self.move_users({user_id: target})
+
+    def move_users(self, targets):
+        """Move users to shards, `targets` mapping user ids to shards.
+
+        Their writes are refused from the start until each is copied
+        and repointed; this waits SHARD_DIRECTORY_TTL plus
+        SHARD_MOVE_GRACE first, once for all of them. Returns messages
+        copied. The old copies are left for `prune`.
+        """
+
+        state = self._state()
+        directory = UserShard.__table__
+        sources = self._lookup(list(targets), place=True)
+        moves = {user_id: target for user_id, target in targets.items()
+                 if sources[user_id][0] != target}
+        if not moves:
+            return 0
+
+        db.engine.execute(directory.update()
+                          .where(directory.c.user_id.in_(moves))
+                          .values(moving=True))
+        copied = 0
+        try:
+            # until now, workers may hold entries cached before the flag
+            time.sleep(state.directory_ttl + state.move_grace)
+            for user_id, target in sorted(moves.items()):
+                source = sources[user_id][0]
+                with state.engines[source].connect() as src, \
+                        state.engines[target].begin() as dst:
+                    copied += _copy_user(src, dst, user_id)
+                db.engine.execute(directory.update()
+                                  .where(directory.c.user_id == user_id)
+                                  .values(shard=target, moving=False))
+                state.directory.pop(user_id, None)
+        finally:
+            # users not copied because of an error stay where they were
+            db.engine.execute(directory.update()
+                              .where(directory.c.user_id.in_(moves))
+                              .where(directory.c.moving.is_(True))
+                              .values(moving=False))
+        return copied
+
+    def rebalance(self):
+        """Move every user to shard user_id % N; return users moved.
+
+        Users are moved CHUNK_SIZE at a time, each chunk waiting out the
+        directory caches once. Run after adding shards to SHARD_URLS,
+        then `prune` once the directory caches have expired.
+        """
+
+        placements = db.session.query(UserShard.user_id, UserShard.shard).all()
+        targets = {user_id: user_id % self.count
+                   for user_id, shard in placements
+                   if shard != user_id % self.count}
+        for chunk in _chunks(sorted(targets)):
+            self.move_users({user_id: targets[user_id] for user_id in chunk})
+        return len(targets)
+
+    def prune(self):
+        """Delete rows left behind on shards users moved away from.
+
+        Returns users pruned.
+        """
+
+        state = self._state()
+        pruned = 0
+        for shard, engine in enumerate(state.engines):
+            with engine.begin() as conn:
+                user_ids = sorted(
+                    {user_id for (user_id,) in conn.execute(
+                        select([MESSAGES.c.user_id]).distinct())} |
+                    {user_id for (user_id,) in conn.execute(
+                        select([LIKES.c.user_id]).distinct())})
+                if not user_ids:
+                    continue
+                entries = self._lookup(user_ids)
+                for user_id, (home, moving, _) in entries.items():
+                    # a user being moved here isn't copied completely yet
+                    if home != shard and not moving:
+                        _delete_user_rows(conn, user_id)
+                        pruned += 1
+        return pruned
+
+
+shards = ShardRouter()
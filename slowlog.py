@@ -0,0 +1,362 @@
+"""Slow-query log.
+
+Every statement run through SQLAlchemy, on any engine (shards
+included), is timed. One that takes SLOW_QUERY_THRESHOLD_MS or longer
+is written as a JSON line to `slow-queries-<pid>.log` in SLOW_QUERY_DIR.
+Each line holds
+
+    ms            how long it took
+    statement     its text, normalized: parameters and literals become
+                  "?" and lists of them "?, ...", so runs with different
+                  values (and IN lists of different lengths) group
+    fingerprint   a hash of the normalized text
+    parameters    the type (and length, for strings and lists) of each
+                  bound parameter, never the values
+    endpoint      the Flask endpoint it ran for, if in a request
+    plan          its EXPLAIN plan
+
+The plan is taken right after the statement, on the same connection
+and inside a savepoint, so it sees what the statement saw and a failed
+EXPLAIN leaves the transaction alone. Each statement is explained at
+most once every SLOW_QUERY_EXPLAIN_INTERVAL seconds per worker; the
+lines in between have no plan. With SLOW_QUERY_ANALYZE, SELECTs are
+explained with ANALYZE. That runs them again, so it doubles the time of
+slow queries, and is skipped for SELECTs with side effects a rollback
+can't undo (sequences, advisory locks, row locks).
+
+Each worker rotates its own log at SLOW_QUERY_LOG_BYTES, keeping
+SLOW_QUERY_LOG_BACKUPS old ones; logs of workers gone for
+SLOW_QUERY_RETENTION_DAYS are removed. `report` (`flask slow-queries
+report`) reads them all and ranks statements by total time.
+
+Statements under the threshold cost two clock reads and a few lookups
+on top of SQLAlchemy's event dispatch, about 20µs in all. Apps with
+SLOW_QUERY_ENABLED off don't install the hooks.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context, has_request_context, request
+from psycopg2 import Error as DBAPIError
+from psycopg2.extensions import (TRANSACTION_STATUS_INERROR,
+                                 TRANSACTION_STATUS_INTRANS)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LOG_PATTERN = "slow-queries-*.log*"
+
+# connection.info key of the start times of running statements
+_STARTED = "slowlog_started"
+
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+# bound parameters (named, positional or numbered) and literals
+_VALUE = re.compile(r"%\(\w+\)s|%s|\$\d+|'(?:[^']|'')*'"
+                    r"|(?<![\w.])-?\d+(?:\.\d+)?\b")
+_VALUE_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_WHITESPACE = re.compile(r"\s+")
+
+_EXPLAINABLE = re.compile(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b",
+                          re.IGNORECASE)
+_ANALYZABLE = re.compile(r"\s*SELECT\b", re.IGNORECASE)
+# what running a SELECT again would do that rolling back doesn't undo
+_SIDE_EFFECTS = re.compile(
+    r"\b(nextval|setval|pg_advisory\w*)\s*\(|\bFOR\s+(NO\s+KEY\s+)?"
+    r"(UPDATE|SHARE)\b|\bFOR\s+KEY\s+SHARE\b", re.IGNORECASE)
+
+
+def normalize(statement):
+    """`statement` with its values replaced by "?" and whitespace
+    collapsed."""
+
+    normalized = _VALUE.sub("?", statement)
+    normalized = _VALUE_LIST.sub("?, ...", normalized)
+    return _WHITESPACE.sub(" ", normalized).strip()
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def _shape(value):
+    name = type(value).__name__
+    if isinstance(value, (str, bytes, list, tuple, set, frozenset, dict)):
+        return f"{name}[{len(value)}]"
+    return name
+
+
+def shapes(parameters, executemany=False):
+    """Type (and length) of each parameter in `parameters`, as a dict
+    for named ones and a list for positional ones."""
+
+    if executemany:
+        return {"rows": len(parameters),
+                "each": shapes(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: _shape(value) for key, value in parameters.items()}
+    return [_shape(value) for value in parameters or ()]
+
+
+def explain(dbapi_conn, statement, parameters, analyze=False):
+    """Plan of `statement` as run on `dbapi_conn`, or None if it can't be
+    explained. Rows changed by ANALYZE are rolled back."""
+
+    status = dbapi_conn.get_transaction_status()
+    if status == TRANSACTION_STATUS_INERROR:
+        return None
+    savepoint = status == TRANSACTION_STATUS_INTRANS
+    if analyze and not savepoint:
+        # nothing to roll back to
+        analyze = False
+    options = "(ANALYZE, BUFFERS) " if analyze else ""
+
+    with dbapi_conn.cursor() as cursor:
+        if savepoint:
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(f"EXPLAIN {options}{statement}", parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        except DBAPIError:
+            plan = None
+        if savepoint:
+            if analyze or plan is None:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    return plan
+
+
+class _SlowLog:
+    """Per-app settings, log file and when each statement was last
+    explained."""
+
+    def __init__(self, app):
+        config = app.config
+        self.threshold = config['SLOW_QUERY_THRESHOLD_MS'] / 1000
+        self.explain = config['SLOW_QUERY_EXPLAIN']
+        self.analyze = config['SLOW_QUERY_ANALYZE']
+        self.explain_interval = config['SLOW_QUERY_EXPLAIN_INTERVAL']
+        self.directory = config['SLOW_QUERY_DIR']
+        self.log_bytes = config['SLOW_QUERY_LOG_BYTES']
+        self.log_backups = config['SLOW_QUERY_LOG_BACKUPS']
+        self.retention = timedelta(days=config['SLOW_QUERY_RETENTION_DAYS'])
+        # fingerprint -> time.monotonic() of its last plan
+        self.explained = {}
+        self.logger = None
+        self.logger_pid = None
+        self.lock = threading.Lock()
+
+    def _logger(self):
+        # after a fork each worker opens a file of its own
+        if self.logger_pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            self._remove_stale()
+            logger = logging.Logger("warbler.slow_queries")
+            logger.addHandler(logging.handlers.RotatingFileHandler(
+                os.path.join(self.directory,
+                             f"slow-queries-{os.getpid()}.log"),
+                maxBytes=self.log_bytes, backupCount=self.log_backups,
+                delay=True))
+            self.logger, self.logger_pid = logger, os.getpid()
+        return self.logger
+
+    def _remove_stale(self):
+        cutoff = time.time() - self.retention.total_seconds()
+        for path in glob.glob(os.path.join(self.directory, LOG_PATTERN)):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                # another worker removed it already
+                pass
+
+    def _due(self, key):
+        """Whether statement `key` should be explained now."""
+
+        now = time.monotonic()
+        with self.lock:
+            last = self.explained.get(key)
+            if last is not None and now - last < self.explain_interval:
+                return False
+            self.explained[key] = now
+            return True
+
+    def record(self, conn, cursor, statement, parameters, executemany,
+               seconds):
+        normalized = normalize(statement)
+        key = fingerprint(normalized)
+
+        plan, analyzed = None, False
+        if (self.explain and not executemany
+                and _EXPLAINABLE.match(statement) and self._due(key)):
+            analyzed = (self.analyze and bool(_ANALYZABLE.match(statement))
+                        and not _SIDE_EFFECTS.search(statement))
+            plan = explain(cursor.connection, statement, parameters,
+                           analyze=analyzed)
+
+        entry = {
+            "time": datetime.utcnow().isoformat(timespec="milliseconds"),
+            "pid": os.getpid(),
+            "ms": round(seconds * 1000, 3),
+            "fingerprint": key,
+            "statement": normalized,
+            "parameters": shapes(parameters, executemany),
+            "endpoint": request.endpoint if has_request_context() else None,
+            "database": conn.engine.url.database,
+            "rows": cursor.rowcount,
+            "plan": plan,
+            "analyzed": analyzed and plan is not None,
+        }
+        with self.lock:
+            self._logger().info(json.dumps(entry))
+
+
+class SlowQueryLog:
+    """Logs statements over a time threshold; bind with `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_ENABLED', True)
+        app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', float(
+            os.environ.get('SLOW_QUERY_THRESHOLD_MS', 250)))
+        app.config.setdefault('SLOW_QUERY_EXPLAIN', True)
+        app.config.setdefault('SLOW_QUERY_ANALYZE', bool(
+            os.environ.get('SLOW_QUERY_ANALYZE')))
+        app.config.setdefault('SLOW_QUERY_EXPLAIN_INTERVAL', 60)
+        app.config.setdefault('SLOW_QUERY_DIR', os.environ.get(
+            'SLOW_QUERY_DIR',
+            os.path.join(tempfile.gettempdir(), 'warbler-slow-queries')))
+        app.config.setdefault('SLOW_QUERY_LOG_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', 5)
+        app.config.setdefault('SLOW_QUERY_RETENTION_DAYS', 7)
+
+        if not app.config['SLOW_QUERY_ENABLED']:
+            return
+        app.extensions['slowlog'] = _SlowLog(app)
+        _install_hooks()
+
+    def report(self, top=20, since=None):
+        """The `top` statements by total time over the logs of every
+        worker, since the datetime `since` if given; see `report`."""
+
+        return report(current_app.config['SLOW_QUERY_DIR'], top, since)
+
+
+slow_query_log = SlowQueryLog()
+
+
+##############################################################################
+# Engine hooks
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault(_STARTED, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.get(_STARTED)
+    # hooks installed while this statement ran
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    if not has_app_context():
+        return
+    state = current_app.extensions.get('slowlog')
+    if state is not None and seconds >= state.threshold:
+        state.record(conn, cursor, statement, parameters, executemany,
+                     seconds)
+
+
+def _handle_error(context):
+    # after_cursor_execute isn't called for a statement that failed
+    started = context.connection.info.get(_STARTED)
+    if started:
+        started.pop()
+
+
+def _install_hooks():
+    global _hooks_installed
+
+    with _hooks_lock:
+        if not _hooks_installed:
+            # every engine, sharded ones included
+            event.listen(Engine, "before_cursor_execute",
+                         _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute",
+                         _after_cursor_execute)
+            event.listen(Engine, "handle_error", _handle_error)
+            _hooks_installed = True
+
+
+##############################################################################
+# Report
+
+def read_entries(directory, since=None):
+    """Entries of every slow-query log in `directory`, logged at or after
+    the datetime `since` if given."""
+
+    since = since.isoformat(timespec="milliseconds") if since else ""
+    for path in glob.glob(os.path.join(directory, LOG_PATTERN)):
+        try:
+            with open(path) as lines:
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # cut short by a crash
+                        continue
+                    if entry["time"] >= since:
+                        yield entry
+        except FileNotFoundError:
+            # rotated away while we were listing
+            continue
+
+
+def report(directory, top=20, since=None):
+    """The `top` slowest statements by total time logged in `directory`,
+    slowest first. Each is a dict of the normalized statement, count,
+    total, mean and max ms, most common endpoints and the plan of its
+    slowest run that has one."""
+
+    groups = {}
+    for entry in read_entries(directory, since):
+        group = groups.get(entry["fingerprint"])
+        if group is None:
+            group = groups[entry["fingerprint"]] = {
+                "fingerprint": entry["fingerprint"],
+                "statement": entry["statement"],
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "endpoints": Counter(),
+                "parameters": entry["parameters"],
+                "plan": None,
+                "plan_ms": None,
+                "last_seen": entry["time"],
+            }
+        group["count"] += 1
+        group["total_ms"] += entry["ms"]
+        group["max_ms"] = max(group["max_ms"], entry["ms"])
+        group["endpoints"][entry["endpoint"]] += 1
+        group["last_seen"] = max(group["last_seen"], entry["time"])
+        if entry["plan"] and (group["plan_ms"] is None
+                              or entry["ms"] > group["plan_ms"]):
+            group["plan"], group["plan_ms"] = entry["plan"], entry["ms"]
+
+    ranked = sorted(groups.values(), key=lambda group: -group["total_ms"])
+    for group in ranked[:top]:
+        group["total_ms"] = round(group["total_ms"], 3)
+        group["mean_ms"] = round(group["total_ms"] / group["count"], 3)
+        group["endpoints"] = dict(group["endpoints"].most_common(5))
+    return ranked[:top]
@@ -47,6 +47,12 @@ function axiosErrorHandler(error) {
 }
 
 
+function adjustLikeCount($form, change) {
+  const $count = $form.find('.like-count');
+  $count.text(Number($count.text()) + change);
+}
+
+
 $(async function(){
   const $messages = $('#messages');
   const session = new Session();
@@ -65,6 +71,7 @@ $(async function(){
       const $likeBtn = $(this).find('button');
       $likeBtn.children().remove();
       $likeBtn.append('<i class="far fa-thumbs-up"></i>');
+      adjustLikeCount($(this), -1);
     } else {
       const messageId = $(this).data("message-id");
       const userId = $(this).data("user-id");
@@ -76,6 +83,7 @@ $(async function(){
       const $likeBtn = $(this).find('button');
       $likeBtn.children().remove();
       $likeBtn.append('<i class="fas fa-thumbs-up"></i>');
+      adjustLikeCount($(this), 1);
     }
   })
 
@@ -0,0 +1,40 @@
+// Tell users a username or email is taken while they type it.
+
+const AVAILABILITY_DELAY = 300;
+
+
+async function checkAvailability($input) {
+  const field = $input.attr('name');
+  const value = $input.val().trim();
+  const $note = $input.prev('.availability');
+  if (!value) {
+    $note.text('');
+    return;
+  }
+
+  try {
+    const response = await axios.get(
+      '/api/availability', {params: {[field]: value}}
+    );
+    // ignore answers for what the user has typed over since
+    if ($input.val().trim() === value) {
+      $note.text(response.data[field] ? '' : `${value} is already taken`);
+    }
+  } catch (error) {
+    axiosErrorHandler(error);
+  }
+}
+
+
+$(function(){
+  $('#user_form').find('#username, #email').each(function(){
+    const $input = $(this);
+    let timer = null;
+
+    $input.before('<span class="availability text-danger"></span>');
+    $input.on('input', function(){
+      clearTimeout(timer);
+      timer = setTimeout(() => checkAvailability($input), AVAILABILITY_DELAY);
+    });
+  });
+});
@@ -0,0 +1,81 @@
+"""Streamed rendering of long pages.
+
+`render_template` renders the whole page into one string before the
+first byte goes out, so time to first byte and memory grow with the
+page. `stream_template` uses Jinja's `generate` instead, which yields
+the page piece by piece as the template runs. Pieces are gathered into
+chunks of about STREAM_CHUNK_SIZE characters and each one is sent as
+soon as it fills. Given a query built with `yield_per`, rows come from a
+server-side cursor as the template loops over them, so neither the rows
+nor the page are ever held whole.
+
+When the client accepts it (and STREAM_GZIP is set), the stream is
+gzipped. Every chunk is flushed out of the compressor (Z_SYNC_FLUSH), so
+compression doesn't hold the page back until it ends, at the cost of a
+few bytes per chunk.
+
+The body is produced after the view returns, inside its request
+context. An error halfway through can no longer change the status; it
+propagates to the server, which logs it and cuts the response short.
+"""
+
+import zlib
+
+from flask import (Response, before_render_template, current_app, request,
+                   stream_with_context, template_rendered)
+
+
+def init_app(app):
+    app.config.setdefault('STREAM_CHUNK_SIZE', 8 * 1024)
+    app.config.setdefault('STREAM_GZIP', True)
+    app.config.setdefault('STREAM_GZIP_LEVEL', 6)
+
+
+def chunked(pieces, size):
+    """Join the strings `pieces` into chunks of at least `size`
+    characters (the last may be shorter), encoded as UTF-8."""
+
+    buffered, length = [], 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffered).encode()
+            buffered, length = [], 0
+    if buffered:
+        yield "".join(buffered).encode()
+
+
+def gzipped(chunks, level):
+    """Compress `chunks` into a gzip stream, one flushed block per chunk."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def stream_template(name, **context):
+    """A streamed response rendering template `name` with `context`."""
+
+    app = current_app._get_current_object()
+    config = app.config
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(name)
+
+    def render():
+        before_render_template.send(app, template=template, context=context)
+        yield from template.generate(context)
+        template_rendered.send(app, template=template, context=context)
+
+    body = chunked(render(), config['STREAM_CHUNK_SIZE'])
+    compress = (config['STREAM_GZIP']
+                and request.accept_encodings['gzip'] > 0)
+    if compress:
+        body = gzipped(body, config['STREAM_GZIP_LEVEL'])
+
+    response = Response(stream_with_context(body), mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    if compress:
+        response.content_encoding = 'gzip'
+    return response
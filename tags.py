@@ -0,0 +1,150 @@
+"""Hashtag and mention extraction for messages.
+
+Tags and mentions are parsed once when a message is saved and stored in
+the `message_tags` and `mentions` tables, so tag and mention timelines
+are index lookups instead of LIKE scans over `messages.text`.
+"""
+
+import re
+
+from sqlalchemy.exc import IntegrityError
+
+from models import Mention, Message, MessageTag, Tag, User, db
+
+# "#" or "@" not preceded by a word character, so emails and
+# "C#" don't count
+HASHTAG_RE = re.compile(r"(?<![\w#])#(\w{1,50})")
+MENTION_RE = re.compile(r"(?<![\w@])@(\w{1,50})")
+
+
+def _unique(values):
+    """Drop repeats, keeping first-seen order."""
+
+    return list(dict.fromkeys(values))
+
+
+def extract_hashtags(text):
+    """Return the distinct hashtags in `text`, lower case without "#"."""
+
+    return _unique(tag.lower() for tag in HASHTAG_RE.findall(text or ""))
+
+
+def extract_mentions(text):
+    """Return the distinct usernames mentioned in `text`, without "@"."""
+
+    return _unique(MENTION_RE.findall(text or ""))
+
+
+def get_or_create_tags(names):
+    """Return {name: Tag} for `names`, creating tags that don't exist yet."""
+
+    if not names:
+        return {}
+
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
+
+    for name in names:
+        if name in tags:
+            continue
+        try:
+            # a concurrent post may create the same tag first
+            with db.session.begin_nested():
+                tag = Tag(name=name)
+                db.session.add(tag)
+        except IntegrityError:
+            tag = Tag.query.filter_by(name=name).one()
+        tags[name] = tag
+
+    return tags
+
+
+def index_message(msg, session=None):
+    """Add tag and mention rows parsed from a new message's text.
+
+    The rows go in `session`, the one holding the message (its shard);
+    tags themselves are created in the main database.
+    """
+
+    session = session or db.session
+    tags = get_or_create_tags(extract_hashtags(msg.text))
+    usernames = extract_mentions(msg.text)
+    user_ids = [
+        user_id for (user_id,) in
+        db.session.query(User.id).filter(User.username.in_(usernames))
+    ] if usernames else []
+
+    if msg.id is None:
+        session.flush()
+    session.add_all([MessageTag(tag_id=tag.id, message_id=msg.id)
+                     for tag in tags.values()])
+    session.add_all([Mention(user_id=user_id, message_id=msg.id)
+                     for user_id in user_ids])
+
+
+def index_rows(messages):
+    """message_tags and mentions rows for (id, text) pairs of messages.
+
+    Tags that don't exist yet are created in db.session, uncommitted.
+    """
+
+    parsed = [(msg_id, extract_hashtags(text), extract_mentions(text))
+              for msg_id, text in messages]
+
+    tags = get_or_create_tags(
+        _unique(name for _, names, _ in parsed for name in names))
+    usernames = _unique(name for _, _, names in parsed for name in names)
+    user_ids = dict(
+        db.session.query(User.username, User.id)
+        .filter(User.username.in_(usernames))
+    ) if usernames else {}
+
+    tag_rows = [{"tag_id": tags[name].id, "message_id": msg_id}
+                for msg_id, names, _ in parsed
+                for name in names]
+    mention_rows = [{"user_id": user_ids[name], "message_id": msg_id}
+                    for msg_id, _, names in parsed
+                    for name in names
+                    if name in user_ids]
+    return tag_rows, mention_rows
+
+
+def backfill(batch_size=1000, session=None):
+    """(Re)build tag and mention rows for every message; return count.
+
+    Walks messages in id order one batch per transaction, so it can run
+    against a live database and be restarted safely. `session` is the
+    database (shard) holding the messages; the main one by default.
+    """
+
+    session = session or db.session
+    last_id = 0
+    count = 0
+
+    while True:
+        batch = (session
+                 .query(Message.id, Message.text)
+                 .filter(Message.id > last_id)
+                 .order_by(Message.id)
+                 .limit(batch_size)
+                 .all())
+        if not batch:
+            return count
+
+        ids = [msg_id for msg_id, _ in batch]
+        tag_rows, mention_rows = index_rows(batch)
+
+        (session.query(MessageTag)
+         .filter(MessageTag.message_id.in_(ids))
+         .delete(synchronize_session=False))
+        (session.query(Mention)
+         .filter(Mention.message_id.in_(ids))
+         .delete(synchronize_session=False))
+
+        session.bulk_insert_mappings(MessageTag, tag_rows)
+        session.bulk_insert_mappings(Mention, mention_rows)
+        # new tags are created in the main database
+        db.session.commit()
+        session.commit()
+
+        last_id = ids[-1]
+        count += len(batch)
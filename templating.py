@@ -0,0 +1,95 @@
+"""Compiled template cache shared by every worker on a host.
+
+Jinja compiles each template to Python code the first time a process
+renders it. `init_app` stores that bytecode under TEMPLATE_CACHE_DIR so
+a new worker loads it from disk instead of recompiling. Cache entries
+are keyed by template name and checked against a checksum of the
+source, so an edited template is simply recompiled on next use.
+
+Bytecode is unmarshalled and run, so whoever can write the directory
+can run code in the workers. The default is private to the user the
+app runs as, created with mode 0700; a directory owned by anyone else,
+or writable by group or others, is refused and the app runs without
+the cache, as Jinja's own default does.
+
+`warm_up` loads every template up front, so neither the cache nor the
+worker's in-memory template cache is cold when traffic arrives.
+"""
+
+import os
+import stat
+import tempfile
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache whose files are never seen half written.
+
+    Several workers may compile the same template at once; each writes
+    a private temp file and renames it into place.
+    """
+
+    def dump_bytecode(self, bucket):
+        path = self._get_cache_filename(bucket)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                bucket.write_bytecode(tmp)
+            os.replace(tmp_path, path)
+        except OSError:
+            # a read-only or full disk only costs us the cache
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def _is_private(directory):
+    """Create `directory` (mode 0700) if missing; whether it is a real
+    directory owned by this user and writable by no one else."""
+
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(info.st_mode)
+            and info.st_uid == os.getuid()
+            and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def init_app(app):
+    """Give `app`'s Jinja environment an on-disk bytecode cache.
+
+    Must run before anything touches `app.jinja_env`.
+    """
+
+    app.config.setdefault(
+        'TEMPLATE_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(),
+                     f'warbler-templates-{os.getuid()}'))
+
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if not directory:
+        return
+
+    if not _is_private(directory):
+        app.logger.warning(
+            "Not caching template bytecode in %s: it must be a directory "
+            "owned by this user and writable by no one else", directory)
+        return
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=AtomicBytecodeCache(directory))
+
+
+def warm_up(app):
+    """Compile (or load from the bytecode cache) every app template.
+
+    Returns the names loaded.
+    """
+
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
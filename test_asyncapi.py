@@ -0,0 +1,129 @@
+"""Async read endpoint tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_asyncapi.py
+
+
+import os
+from unittest import TestCase
+
+from starlette.testclient import TestClient
+
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY
+from asyncapi import create_asgi_app
+
+asgi_app = create_asgi_app()
+flask_app = asgi_app.state.flask_app
+
+db.create_all()
+
+
+class AsyncAPITestCase(TestCase):
+    """Test the async JSON endpoints against the test database."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        self.carol = User.signup("carol", "carol@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.bob.id,
+                               user_following_id=self.alice.id))
+        self.msgs = [Message(text=f"{user.username} says hi", user_id=user.id)
+                     for user in (self.alice, self.bob, self.carol)]
+        db.session.add_all(self.msgs)
+        db.session.commit()
+        self.ids = {user.username: user.id
+                    for user in (self.alice, self.bob, self.carol)}
+
+        self.client = TestClient(asgi_app)
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        db.session.rollback()
+
+    def login(self, username):
+        """Set the Flask session cookie for `username` on the client."""
+
+        serializer = (flask_app.session_interface
+                      .get_signing_serializer(flask_app))
+        self.client.cookies.set(
+            flask_app.session_cookie_name,
+            serializer.dumps({CURR_USER_KEY: self.ids[username]}))
+
+    def test_feed_requires_login(self):
+        self.assertEqual(self.client.get("/api/feed").status_code, 401)
+
+        self.client.cookies.set(flask_app.session_cookie_name, "forged")
+        self.assertEqual(self.client.get("/api/feed").status_code, 401)
+
+    def test_feed(self):
+        self.login("alice")
+        resp = self.client.get("/api/feed")
+
+        self.assertEqual(resp.status_code, 200)
+        texts = {msg["text"] for msg in resp.json()["messages"]}
+        self.assertEqual(texts, {"alice says hi", "bob says hi"})
+
+    def test_user_show(self):
+        db.session.add(Likes(user_id=self.ids["bob"],
+                             message_id=self.msgs[2].id))
+        db.session.commit()
+
+        resp = self.client.get(f"/api/users/{self.ids['bob']}")
+        data = resp.json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data["user"]["username"], "bob")
+        self.assertNotIn("password", data["user"])
+        self.assertEqual((data["user"]["messages"], data["user"]["followers"],
+                          data["user"]["following"], data["user"]["likes"]),
+                         (1, 1, 0, 1))
+        self.assertEqual(data["messages"][0]["text"], "bob says hi")
+
+        self.assertEqual(self.client.get("/api/users/0").status_code, 404)
+
+    def test_user_likes(self):
+        db.session.add_all([Likes(user_id=self.ids["alice"], message_id=msg.id)
+                            for msg in self.msgs[1:]])
+        db.session.commit()
+
+        url = f"/api/users/{self.ids['alice']}/likes"
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+        self.login("bob")
+        resp = self.client.get(url)
+        texts = [msg["text"] for msg in resp.json()["messages"]]
+
+        self.assertEqual(texts, ["carol says hi", "bob says hi"])
+        self.assertIsNone(resp.json()["next_before"])
+
+    def test_message_show(self):
+        resp = self.client.get(f"/api/messages/{self.msgs[1].id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["message"]["user"]["username"], "bob")
+        self.assertEqual(self.client.get("/api/messages/0").status_code, 404)
+
+    def test_flask_routes_mounted(self):
+        resp = self.client.get("/login")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Welcome back.", resp.text)
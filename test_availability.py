@@ -0,0 +1,151 @@
+"""Username and email availability tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_availability.py
+
+
+import os
+from unittest import TestCase, mock
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app
+from availability import BloomFilter, availability
+
+app = create_app({
+    'RATELIMIT_ENABLED': False,
+    'WTF_CSRF_ENABLED': False,
+})
+
+db.create_all()
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the filter on its own."""
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+        for i in range(1000):
+            self.assertIn(f"user{i}", bloom)
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10_000))
+        self.assertLess(false_positives, 300)
+
+    def test_counts_new_items(self):
+        bloom = BloomFilter(10, 0.01)
+        self.assertTrue(bloom.add("alice"))
+        self.assertFalse(bloom.add("alice"))
+        self.assertEqual(bloom.count, 1)
+
+
+class AvailabilityTestCase(TestCase):
+    """Test the availability API and signup checks."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        db.session.commit()
+        app.extensions['availability'].bloom = None
+
+        self.client = app.test_client()
+
+        User.signup(username="taken", email="taken@test.com",
+                    password="password", image_url=None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def count_queries(self, func, *args):
+        statements = []
+
+        def record(*args):
+            statements.append(args)
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            result = func(*args)
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+        return result, len(statements)
+
+    def test_api(self):
+        resp = self.client.get(
+            "/api/availability?username=taken&email=free@test.com")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {"username": False, "email": True})
+
+        self.assertEqual(self.client.get("/api/availability").status_code,
+                         400)
+
+    def test_negative_skips_database(self):
+        # the first check builds the filter
+        availability.is_available("username", "warmup")
+
+        self.assertEqual(
+            self.count_queries(availability.is_available,
+                               "username", "nobody"), (True, 0))
+        # maybes are confirmed
+        self.assertEqual(
+            self.count_queries(availability.is_available,
+                               "username", "taken"), (False, 1))
+
+    def test_learns_new_users(self):
+        availability.is_available("username", "warmup")
+
+        User.signup(username="newbie", email="newbie@test.com",
+                    password="password", image_url=None)
+        db.session.commit()
+        self.assertFalse(availability.is_available("username", "newbie"))
+
+        # rows inserted by other workers are found on the next refresh
+        db.session.execute(User.__table__.insert().values(
+            username="elsewhere", email="elsewhere@test.com",
+            password="x"))
+        db.session.commit()
+        self.assertTrue(availability.is_available("username", "elsewhere"))
+        app.extensions['availability'].refreshed_at = 0
+        self.assertFalse(availability.is_available("username", "elsewhere"))
+
+    def test_signup_checks_before_hashing(self):
+        with mock.patch("models.get_bcrypt") as get_bcrypt:
+            resp = self.client.post("/signup", data={
+                "username": "taken",
+                "email": "another@test.com",
+                "password": "password",
+                "image_url": "http://example.com/me.jpg",
+            })
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Username already taken", resp.get_data(as_text=True))
+        get_bcrypt.assert_not_called()
+        self.assertEqual(User.query.count(), 1)
+
+        resp = self.client.post("/signup", data={
+            "username": "another",
+            "email": "another@test.com",
+            "password": "password",
+            "image_url": "http://example.com/me.jpg",
+        })
+        self.assertEqual(resp.status_code, 302)
+        self.assertFalse(availability.is_available("email",
+                                                   "another@test.com"))
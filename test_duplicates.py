@@ -0,0 +1,135 @@
+"""Near-duplicate detection tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_duplicates.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+from duplicates import Index, duplicates, signature, similarity
+
+app = create_app({
+    'RATELIMIT_ENABLED': False,
+    'WTF_CSRF_ENABLED': False,
+})
+
+db.create_all()
+
+SPAM = "Win a free cruise today!!! Click http://example.com/cruise now"
+
+
+class IndexTestCase(TestCase):
+    """Test the index on its own."""
+
+    def setUp(self):
+        self.now = datetime(2020, 1, 1, 12)
+        self.index = Index(timedelta(minutes=10), 100)
+
+    def test_similarity(self):
+        self.assertEqual(similarity(signature(SPAM), signature(SPAM)), 1)
+        # case and punctuation don't count
+        self.assertEqual(similarity(signature(SPAM),
+                                    signature(SPAM.upper() + "!!")), 1)
+        self.assertGreater(
+            similarity(signature(SPAM),
+                       signature(SPAM.replace("today", "tonight"))), 0.6)
+        self.assertLess(
+            similarity(signature(SPAM),
+                       signature("Had a lovely walk by the river")), 0.2)
+        self.assertIsNone(signature("!!!"))
+
+    def test_matches(self):
+        self.index.add(1, 10, self.now, SPAM)
+        self.index.add(2, 11, self.now, "Had a lovely walk by the river")
+
+        matches = self.index.matches(SPAM.replace("!!!", "!"), 0.8)
+        self.assertEqual([(message_id, user_id)
+                          for message_id, user_id, _ in matches], [(1, 10)])
+        self.assertEqual(self.index.matches("Something else entirely", 0.8),
+                         [])
+
+    def test_window_bounds_memory(self):
+        for i in range(5):
+            self.index.add(i, 10, self.now + timedelta(minutes=i),
+                           f"{SPAM} {i}")
+        # out of order, from another worker
+        self.index.add(99, 10, self.now + timedelta(seconds=30), SPAM)
+        self.assertFalse(self.index.add(99, 10, self.now, SPAM))
+
+        self.index.expire(self.now + timedelta(minutes=12))
+        self.assertEqual(sorted(self.index.by_id), [2, 3, 4])
+        self.index.expire(self.now + timedelta(minutes=20))
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.buckets, {})
+
+        small = Index(timedelta(minutes=10), 3)
+        for i in range(5):
+            small.add(i, 10, self.now, f"message number {i}")
+        self.assertEqual(sorted(small.by_id), [2, 3, 4])
+
+
+class DuplicatePostTestCase(TestCase):
+    """Test the checks made when posting."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+        app.extensions['duplicates'].index = None
+        app.extensions['duplicates'].seen_until = None
+
+        user = User.signup(username="spammer", email="spammer@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def post(self, text):
+        return self.client.post("/messages/new", data={"text": text})
+
+    def test_throttles_copies(self):
+        for i in range(3):
+            self.assertEqual(self.post(f"{SPAM} #{i}").status_code, 302)
+
+        resp = self.post(f"{SPAM} #3")
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn("posted many times", resp.get_data(as_text=True))
+        self.assertEqual(Message.query.count(), 3)
+
+        self.assertEqual(self.post("Something else entirely").status_code,
+                         302)
+
+    def test_sees_other_workers(self):
+        # committed elsewhere: found on the next refresh
+        for i in range(3):
+            db.session.add(Message(text=f"{SPAM} {i}", user_id=self.user_id))
+        db.session.commit()
+
+        self.assertEqual(len(duplicates.check(SPAM)), 3)
+        self.assertEqual(self.post(SPAM).status_code, 429)
@@ -0,0 +1,120 @@
+"""Account export tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_export.py
+
+
+import gzip
+import json
+import os
+from datetime import date, datetime
+from unittest import TestCase
+
+from click.testing import CliRunner
+
+from models import db, Follows, Likes, Message, MessageArchive, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+import export
+
+app = create_app()
+
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    """Test streaming a user's account out."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        MessageArchive.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=name, email=f"{name}@test.com",
+                             password="password", image_url=None)
+                 for name in ("exporter", "friend", "fan")]
+        db.session.commit()
+        self.user_id, self.friend_id, self.fan_id = [u.id for u in users]
+
+        messages = [Message(text=f"Warble {i}", user_id=self.user_id)
+                    for i in range(5)]
+        friends = Message(text="Friend's", user_id=self.friend_id)
+        db.session.add_all(messages + [friends])
+        db.session.commit()
+
+        db.session.add_all([
+            Likes(user_id=self.user_id, message_id=friends.id),
+            Follows(user_following_id=self.user_id,
+                    user_being_followed_id=self.friend_id),
+            Follows(user_following_id=self.fan_id,
+                    user_being_followed_id=self.user_id),
+        ])
+        row = {"id": 1, "text": "Archived", "user_id": self.user_id,
+               "timestamp": datetime(2019, 3, 5).isoformat()}
+        db.session.add(MessageArchive(
+            month=date(2019, 3, 1), min_id=1, max_id=1, row_count=1,
+            data=gzip.compress(json.dumps(row).encode())))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def check(self, lines):
+        records = [json.loads(line) for line in lines]
+        kinds = [record["type"] for record in records]
+        self.assertEqual(kinds, ["user"] + ["message"] * 6
+                         + ["like", "following", "follower"])
+
+        self.assertEqual(records[0]["username"], "exporter")
+        self.assertNotIn("password", records[0])
+        self.assertEqual([r["text"] for r in records[1:7]],
+                         ["Archived"] + [f"Warble {i}" for i in range(5)])
+        self.assertEqual(records[-2]["username"], "friend")
+        self.assertEqual(records[-1]["username"], "fan")
+
+    def test_endpoint_streams(self):
+        resp = self.client.get("/users/export")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.check(resp.get_data().splitlines())
+
+    def test_endpoint_gzip(self):
+        resp = self.client.get("/users/export?gzip=1")
+        self.assertEqual(resp.mimetype, "application/gzip")
+        self.assertIn(".ndjson.gz", resp.headers["Content-Disposition"])
+        self.check(gzip.decompress(resp.get_data()).splitlines())
+
+    def test_small_batches_and_chunks(self):
+        with app.app_context():
+            records = export.records(self.user_id, batch_size=2)
+        # read outside any app context
+        chunks = list(export.ndjson(records, chunk_size=100))
+        self.assertGreater(len(chunks), 1)
+        self.check(b"".join(chunks).splitlines())
+
+    def test_cli(self):
+        runner = CliRunner()
+        result = runner.invoke(app.cli, ["export", "exporter", "--gzip"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.check(gzip.decompress(result.stdout_bytes).splitlines())
+
+        result = runner.invoke(app.cli, ["export", "nobody"])
+        self.assertEqual(result.exit_code, 1)
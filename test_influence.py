@@ -0,0 +1,137 @@
+"""Influence score tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_influence.py
+
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, Follows, Job, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+import influence
+
+app = create_app()
+
+db.create_all()
+
+
+def dense_pagerank(n, edges, damping=influence.DAMPING, iterations=200):
+    """Textbook PageRank with a dense transition matrix."""
+
+    matrix = np.zeros((n, n))
+    for follower, followed in edges:
+        matrix[followed, follower] += 1
+    out_degree = matrix.sum(axis=0)
+    # users following no one link to everyone
+    matrix[:, out_degree == 0] = 1
+    matrix /= matrix.sum(axis=0)
+    rank = np.full(n, 1 / n)
+    for _ in range(iterations):
+        rank = (1 - damping) / n + damping * matrix @ rank
+    return rank
+
+
+class PageRankTestCase(TestCase):
+    """Test the iteration on its own."""
+
+    def test_matches_dense(self):
+        rng = np.random.RandomState(0)
+        n = 50
+        edges = {(a, b) for a, b in rng.randint(0, n, (300, 2)) if a != b}
+        followers, followed = (np.array(side) for side in zip(*edges))
+
+        rank, iterations = influence.pagerank(n, followers, followed)
+        self.assertLess(iterations, influence.MAX_ITERATIONS)
+        self.assertAlmostEqual(rank.sum(), 1)
+        np.testing.assert_allclose(rank, dense_pagerank(n, edges),
+                                   atol=1e-6)
+
+    def test_empty(self):
+        rank, _ = influence.pagerank(3, np.array([], dtype=int),
+                                     np.array([], dtype=int))
+        np.testing.assert_allclose(rank, [1 / 3] * 3)
+        self.assertEqual(len(influence.pagerank(0, [], [])[0]), 0)
+
+
+class InfluenceTestCase(TestCase):
+    """Test computing, storing and using the scores."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Job.query.delete()
+        db.session.commit()
+
+        users = [User.signup(username=name, email=f"{name}@test.com",
+                             password="password", image_url=None)
+                 for name in ("star", "fan1", "fan2", "loner")]
+        db.session.commit()
+        self.star, self.fan1, self.fan2, self.loner = [u.id for u in users]
+        db.session.add_all([
+            Follows(user_following_id=self.fan1,
+                    user_being_followed_id=self.star),
+            Follows(user_following_id=self.fan2,
+                    user_being_followed_id=self.star),
+            Follows(user_following_id=self.star,
+                    user_being_followed_id=self.fan1),
+        ])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Job.query.delete()
+        db.session.commit()
+        self.ctx.pop()
+
+    def scores(self):
+        return dict(db.session.query(User.id, User.influence))
+
+    def test_compute(self):
+        self.assertEqual(influence.compute()[0], 4)
+
+        scores = self.scores()
+        self.assertAlmostEqual(sum(scores.values()) / len(scores), 1)
+        self.assertEqual(max(scores, key=scores.get), self.star)
+        self.assertGreater(scores[self.fan1], scores[self.fan2])
+        self.assertAlmostEqual(scores[self.fan2], scores[self.loner])
+
+    def test_search_and_suggestions(self):
+        influence.compute()
+
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertLess(html.index("@star"), html.index("@fan1"))
+        self.assertLess(html.index("@fan1"), html.index("@loner"))
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan2
+        html = self.client.get("/").get_data(as_text=True)
+        suggestions = html[html.index("Who to follow"):]
+        # fan2 already follows star
+        self.assertNotIn("@star", suggestions)
+        self.assertLess(suggestions.index("@fan1"),
+                        suggestions.index("@loner"))
+
+    def test_schedule(self):
+        self.assertIsNotNone(influence.schedule())
+        self.assertIsNone(influence.schedule())
+        self.assertEqual(Job.query.filter_by(kind="influence.compute")
+                         .count(), 1)
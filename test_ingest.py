@@ -0,0 +1,145 @@
+"""Bulk message ingest tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_ingest.py
+
+
+import json
+import os
+import tempfile
+from datetime import date, datetime
+from unittest import TestCase
+
+from click.testing import CliRunner
+
+from models import db, Mention, Message, MessageArchive, MessageTag, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app
+import partitions
+
+TOKEN = "partner-token"
+OLD_MONTH = date(2018, 6, 1)
+
+app = create_app({'INGEST_TOKENS': [TOKEN]})
+
+db.create_all()
+
+
+class IngestTestCase(TestCase):
+    """Test validating and COPYing messages in bulk."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        MessageArchive.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=name, email=f"{name}@test.com",
+                             password="password", image_url=None)
+                 for name in ("partner", "friend")]
+        db.session.commit()
+        self.user_id, self.friend_id = [user.id for user in users]
+
+    def tearDown(self):
+        db.session.rollback()
+        with db.engine.begin() as conn:
+            name = partitions.existing_partitions(conn).get(OLD_MONTH)
+            if name:
+                conn.execute(f"DROP TABLE {name}")
+
+    def post(self, body, content_type, token=TOKEN):
+        return self.client.post("/api/messages/bulk", data=body,
+                                content_type=content_type,
+                                headers={"Authorization": f"Bearer {token}"})
+
+    def test_requires_token(self):
+        resp = self.post("", "text/csv", token="guess")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_csv(self):
+        body = "\n".join([
+            "text,timestamp,user_id",
+            f"Old #news for @friend,2018-06-02 10:00:00.5,{self.user_id}",
+            f'"Quoted, with comma\nand newline",2018-06-01T02:00:00+02:00,'
+            f'{self.user_id}',
+            f",2018-06-01 00:00:00,{self.user_id}",
+            f"Bad time,yesterday,{self.user_id}",
+            "Nobody,2018-06-01 00:00:00,0",
+            f"{'x' * 141},2018-06-01 00:00:00,{self.user_id}",
+        ])
+        resp = self.post(body, "text/csv")
+        self.assertEqual(resp.status_code, 200)
+        report = resp.json
+        self.assertEqual((report["inserted"], report["rejected"]), (2, 4))
+        self.assertEqual([error["line"] for error in report["errors"]],
+                         [5, 6, 7, 8])
+        self.assertIn("Missing text", report["errors"][0]["error"])
+        self.assertIn("No user 0", report["errors"][2]["error"])
+
+        old = Message.query.filter(Message.text.like("Old%")).one()
+        self.assertEqual(old.timestamp, datetime(2018, 6, 2, 10, 0, 0, 500000))
+        self.assertEqual(Message.query.filter_by(
+            text="Quoted, with comma\nand newline").count(), 1)
+
+        # indexed like messages posted through the form
+        self.assertEqual(MessageTag.query.filter_by(message_id=old.id)
+                         .count(), 1)
+        self.assertEqual(Mention.query.filter_by(message_id=old.id)
+                         .one().user_id, self.friend_id)
+
+    def test_bad_csv_header(self):
+        resp = self.post("body,user\nhi,1", "text/csv")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_ndjson_archived_month(self):
+        db.session.add(MessageArchive(month=date(2019, 3, 1), min_id=1,
+                                      max_id=1, row_count=0, data=b""))
+        db.session.commit()
+
+        lines = [
+            json.dumps({"text": "Now", "user_id": self.user_id,
+                        "timestamp": datetime.utcnow().isoformat()}),
+            json.dumps({"text": "Archived", "user_id": self.user_id,
+                        "timestamp": "2019-03-05T00:00:00"}),
+            "not json",
+            "[1, 2]",
+            "",
+        ]
+        report = self.post("\n".join(lines), "application/x-ndjson").json
+        self.assertEqual((report["inserted"], report["rejected"]), (1, 3))
+        self.assertEqual(report["errors"], [
+            {"line": 2, "error": "2019-03 is archived"},
+            {"line": 3, "error": "Not valid JSON"},
+            {"line": 4, "error": "Not a JSON object"},
+        ])
+
+    def test_cli_refused_chunk(self):
+        now = datetime.utcnow()
+        rows = [f"Row {i},{now},{self.user_id}" for i in range(5)]
+        # Postgres refuses NUL characters in text
+        rows[2] = f"Bad\x00row,{now},{self.user_id}"
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as data:
+            data.write("text,timestamp,user_id\n" + "\n".join(rows))
+            data.flush()
+            result = CliRunner(mix_stderr=False).invoke(
+                app.cli, ["ingest", data.name, "--chunk-size", "2"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Inserted 3, rejected 2.", result.stdout)
+        self.assertIn("line 4:", result.stderr)
+        self.assertIn("line 5:", result.stderr)
+        self.assertEqual(Message.query.count(), 3)
@@ -0,0 +1,186 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import create_app
+
+app = create_app()
+import jobs
+from models import Job, db
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+calls = []
+
+
+@jobs.job("test.record")
+def record(value):
+    calls.append(value)
+
+
+@jobs.job("test.explode", max_attempts=2)
+def explode():
+    raise RuntimeError("boom")
+
+
+@jobs.job("test.limited", max_concurrency=1)
+def limited():
+    calls.append("limited")
+
+
+@jobs.job("test.slow")
+def slow():
+    time.sleep(0.3)
+    calls.append(db.session.query(Job.locked_at)
+                 .filter(Job.kind == "test.slow").scalar())
+
+
+class JobQueueTestCase(TestCase):
+    """Test enqueueing, claiming and running jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_enqueue_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue("test.missing")
+
+    def test_work_runs_jobs(self):
+        jobs.enqueue("test.record", {"value": 1})
+        jobs.enqueue("test.record", {"value": 2})
+        db.session.commit()
+
+        self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(
+            Job.query.filter(Job.status == jobs.DONE).count(), 2)
+
+    def test_priority_order(self):
+        jobs.enqueue("test.record", {"value": "low"})
+        jobs.enqueue("test.record", {"value": "high"}, priority=10)
+        db.session.commit()
+
+        jobs.work(burst=True)
+        self.assertEqual(calls, ["high", "low"])
+
+    def test_delayed_job_not_claimed(self):
+        jobs.enqueue("test.record", {"value": 1}, delay=60)
+        db.session.commit()
+
+        self.assertIsNone(jobs.claim())
+
+    def test_retry_with_backoff_then_fail(self):
+        failing = jobs.enqueue("test.explode")
+        db.session.commit()
+        job_id = failing.id
+
+        jobs.run(jobs.claim())
+        retried = Job.query.get(job_id)
+        self.assertEqual(retried.status, jobs.QUEUED)
+        self.assertEqual(retried.attempts, 1)
+        self.assertGreater(retried.run_at, datetime.utcnow())
+        self.assertIn("boom", retried.last_error)
+
+        # make the retry due now
+        retried.run_at = datetime.utcnow()
+        db.session.commit()
+
+        jobs.run(jobs.claim())
+        self.assertEqual(Job.query.get(job_id).status, jobs.FAILED)
+
+    def test_concurrency_limit(self):
+        jobs.enqueue("test.limited")
+        jobs.enqueue("test.limited")
+        db.session.commit()
+
+        running = jobs.claim(worker="a")
+        self.assertEqual(running.status, jobs.RUNNING)
+        self.assertIsNone(jobs.claim(worker="b"))
+
+        jobs.run(running)
+        self.assertIsNotNone(jobs.claim(worker="b"))
+
+    def test_requeue_stale(self):
+        jobs.enqueue("test.record", {"value": 1})
+        db.session.commit()
+
+        stuck = jobs.claim()
+        stuck.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(jobs.requeue_stale(timeout=60), 1)
+        self.assertEqual(Job.query.get(stuck.id).status, jobs.QUEUED)
+
+    def test_missing_handler_fails_at_once(self):
+        orphan = Job(kind="test.gone", payload="{}", max_attempts=5)
+        db.session.add(orphan)
+        db.session.commit()
+        job_id = orphan.id
+
+        self.assertFalse(jobs.run(jobs.claim(kinds=["test.gone"])))
+        failed = Job.query.get(job_id)
+        self.assertEqual((failed.status, failed.attempts), (jobs.FAILED, 1))
+        self.assertIn("LookupError", failed.last_error)
+
+    def test_heartbeat_keeps_long_jobs(self):
+        jobs.enqueue("test.slow")
+        db.session.commit()
+        running = jobs.claim()
+        running.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        interval, jobs.HEARTBEAT_INTERVAL = jobs.HEARTBEAT_INTERVAL, 0.05
+        try:
+            self.assertTrue(jobs.run(running))
+        finally:
+            jobs.HEARTBEAT_INTERVAL = interval
+        # the beats refreshed it while it ran, so it wasn't stale any more
+        self.assertGreater(calls[0], datetime.utcnow() - timedelta(minutes=1))
+
+    def test_concurrent_claims_respect_limit(self):
+        for _ in range(4):
+            jobs.enqueue("test.limited")
+        db.session.commit()
+
+        barrier = threading.Barrier(4)
+        claimed = []
+
+        def claim(worker):
+            with app.app_context():
+                barrier.wait()
+                claimed.append(jobs.claim(worker=worker) is not None)
+                db.session.remove()
+
+        threads = [threading.Thread(target=claim, args=(f"w{i}",))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(claimed.count(True), 1)
+        self.assertEqual(Job.query.filter_by(status=jobs.RUNNING).count(), 1)
@@ -0,0 +1,194 @@
+"""Write-behind like buffer tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_likebuffer.py
+
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from models import db, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+from likebuffer import like_buffer
+
+journal_dir = tempfile.mkdtemp()
+app = create_app({
+    'LIKES_WRITE_BEHIND': True,
+    'LIKES_FLUSH_INTERVAL': 0,
+    'LIKES_JOURNAL_DIR': journal_dir,
+    'NOTIFICATIONS_FLUSH_INTERVAL': 0,
+})
+
+db.create_all()
+
+
+def dead_pid():
+    """A pid no process has any more."""
+
+    proc = subprocess.Popen([sys.executable, "-c", ""])
+    proc.wait()
+    return proc.pid
+
+
+class LikeBufferTestCase(TestCase):
+    """Test coalescing, read-your-writes and recovery of buffered likes."""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(journal_dir)
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        self.state = app.extensions['like_buffer']
+        self.restart()
+        for name in os.listdir(journal_dir):
+            os.remove(os.path.join(journal_dir, name))
+
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=name, email=f"{name}@test.com",
+                             password="password", image_url=None)
+                 for name in ("author", "fan")]
+        db.session.commit()
+        self.author_id, self.fan_id = [user.id for user in users]
+
+        msg = Message(text="Toggle me", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def restart(self):
+        """Forget the buffer, as a new worker process would."""
+
+        if self.state.journal is not None:
+            self.state.journal.close()
+            self.state.journal = None
+        self.state.pending.clear()
+        self.state.pid = None
+
+    def like(self):
+        resp = self.client.post("/api/likes",
+                                json={"message_id": self.message_id})
+        self.assertEqual(resp.status_code, 201)
+        return resp.json["likes"]["id"]
+
+    def unlike(self, like_id):
+        return self.client.delete(f"/api/likes/{like_id}").status_code
+
+    def stored(self):
+        return [(like.id, like.user_id, like.message_id)
+                for like in Likes.query.all()]
+
+    def test_toggles_cancel_out(self):
+        for _ in range(3):
+            like_id = self.like()
+            self.assertEqual(self.unlike(like_id), 200)
+
+        self.assertEqual(like_buffer.flush(), 0)
+        self.assertEqual(self.stored(), [])
+
+    def test_net_like_written_with_its_id(self):
+        first = self.like()
+        self.assertEqual(self.unlike(first), 200)
+        like_id = self.like()
+        self.assertEqual(self.like(), like_id)
+
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual(self.stored(),
+                         [(like_id, self.fan_id, self.message_id)])
+
+    def test_unlike_stored_like(self):
+        like_id = self.like()
+        like_buffer.flush()
+
+        self.assertEqual(self.unlike(like_id), 200)
+        self.assertEqual(self.unlike(like_id), 404)
+        self.assertEqual(len(self.stored()), 1)
+        like_buffer.flush()
+        self.assertEqual(self.stored(), [])
+
+        # liking again before the unlike is written cancels it
+        self.restart()
+        like_id = self.like()
+        like_buffer.flush()
+        self.unlike(like_id)
+        self.assertEqual(self.like(), like_id)
+        self.assertEqual(like_buffer.flush(), 0)
+        self.assertEqual(len(self.stored()), 1)
+
+    def test_only_owner_can_unlike(self):
+        like_id = self.like()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        self.assertEqual(self.unlike(like_id), 404)
+
+    def test_read_your_writes(self):
+        self.like()
+        html = (self.client.get(f"/users/{self.fan_id}/likes")
+                .get_data(as_text=True))
+        self.assertIn("Toggle me", html)
+        self.assertEqual(len(self.stored()), 1)
+
+    def test_journal_replayed_after_crash(self):
+        like_id = self.like()
+        path = like_buffer._journal_path(self.state)
+
+        # the worker dies without flushing
+        self.state.journal.close()
+        os.rename(path, os.path.join(journal_dir,
+                                     f"likes-{dead_pid()}.journal"))
+        self.restart()
+
+        # the next worker takes over its journal when it starts buffering
+        other = Message(text="Other", user_id=self.author_id)
+        db.session.add(other)
+        db.session.commit()
+        resp = self.client.post("/api/likes", json={"message_id": other.id})
+        self.assertEqual(resp.status_code, 201)
+
+        self.assertEqual(like_buffer.flush(), 2)
+        self.assertIn((like_id, self.fan_id, self.message_id), self.stored())
+        self.assertEqual(os.listdir(journal_dir),
+                         [os.path.basename(path)])
+
+    def test_deleted_user_skipped(self):
+        self.like()
+        User.query.filter_by(id=self.fan_id).delete()
+        db.session.commit()
+        self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual(self.stored(), [])
+
+    def test_flushed_at_exit(self):
+        self.like()
+        like_buffer._flush_at_exit(self.state)
+        self.assertEqual(len(self.stored()), 1)
@@ -18,8 +18,11 @@ from sqlalchemy.exc import IntegrityError
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
-from app import app
+from app import create_app
+
+app = create_app()
 from models import Follows, Message, User, db
+import tags
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -103,3 +106,27 @@ class MessageModelTestCase(TestCase):
 
         self.assertIsNone(User.query.get(self.user_id))
         self.assertIsNone(Message.query.get(msg_id))
+
+    def test_extract_hashtags(self):
+        self.assertEqual(tags.extract_hashtags("#One two #one #Three_3"),
+                         ["one", "three_3"])
+        self.assertEqual(tags.extract_hashtags("C# and a#b"), [])
+
+    def test_extract_mentions(self):
+        self.assertEqual(tags.extract_mentions("@bob and @amy, @bob"),
+                         ["bob", "amy"])
+        self.assertEqual(tags.extract_mentions("mail me@example.com"), [])
+
+    def test_backfill_tags(self):
+        msg = Message(text="hey @testuser1 #backfill", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(msg.tags, [])
+
+        self.assertEqual(tags.backfill(), 1)
+        # running it again replaces rather than duplicates
+        self.assertEqual(tags.backfill(), 1)
+
+        msg = Message.query.get(msg.id)
+        self.assertEqual([tag.name for tag in msg.tags], ["backfill"])
+        self.assertEqual(msg.mentioned_users, [self.user1])
@@ -11,8 +11,10 @@ from collections import namedtuple
 from unittest import TestCase
 
 from flask import escape
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Likes, Message, User
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -24,7 +26,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import create_app, CURR_USER_KEY
+
+app = create_app()
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -158,3 +162,122 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertIsNone(Message.query.get(msg_id))
 
+    def test_add_message_indexes_tags(self):
+        other = User.signup(username="other", email="other@test.com",
+                            password="testuser", image_url=None)
+        db.session.commit()
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/messages/new",
+                          data={"text": "Hi @other, see #Flask and #flask"})
+            self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.one()
+        self.assertEqual([tag.name for tag in msg.tags], ["flask"])
+        self.assertEqual(msg.mentioned_users, [User.query.get(other_id)])
+
+    def test_tag_timeline(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for i in range(3):
+                c.post("/messages/new", data={"text": f"Post {i} #paging"})
+            c.post("/messages/new", data={"text": "Untagged"})
+
+            resp = c.get("/tags/paging")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Post 0 #paging", html)
+            self.assertIn("Post 2 #paging", html)
+            self.assertNotIn("Untagged", html)
+
+            resp = c.get("/tags/missing")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_tag_timeline_keyset_paging(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Older #paging"})
+            c.post("/messages/new", data={"text": "Newer #paging"})
+            newer = Message.query.filter_by(text="Newer #paging").one()
+
+            resp = c.get(f"/tags/paging?before={newer.id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Older #paging", html)
+            self.assertNotIn("Newer #paging", html)
+
+    def test_user_mentions(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Talking to @testuser"})
+            c.post("/messages/new", data={"text": "Talking to nobody"})
+
+            resp = c.get(f"/users/{self.testuser.id}/mentions")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Talking to @testuser", html)
+            self.assertNotIn("Talking to nobody", html)
+
+    def count_queries(self, client, url):
+        """Run a GET of `url`; return the number of statements it ran."""
+
+        statements = []
+
+        def record(*args):
+            statements.append(args)
+
+        # every engine: which one db.session uses depends on the app
+        # that was current when it was created
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            resp = client.get(url)
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def test_board_like_counts(self):
+        likers = [User.signup(username=f"liker{i}", email=f"liker{i}@test.com",
+                              password="testuser", image_url=None)
+                  for i in range(2)]
+        msg = Message(text="Popular", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add_all([Likes(user_id=liker.id, message_id=msg.id)
+                            for liker in likers])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/messages").get_data(as_text=True)
+        self.assertIn('<span class="like-count text-muted">2</span>', html)
+
+    def test_board_query_count_constant(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            counts = []
+            for batch in (2, 20):
+                messages = [Message(text=f"Post {i}", user_id=self.testuser.id)
+                            for i in range(batch)]
+                db.session.add_all(messages)
+                db.session.commit()
+                db.session.add_all([Likes(user_id=self.testuser.id,
+                                          message_id=msg.id)
+                                    for msg in messages])
+                db.session.commit()
+                counts.append(self.count_queries(c, "/messages"))
+
+        self.assertEqual(counts[0], counts[1])
@@ -0,0 +1,146 @@
+"""Notification inbox tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_notifications.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, Notification, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+from notifications import LIKE, notifications
+
+app = create_app({
+    'NOTIFICATIONS_FLUSH_INTERVAL': 0,
+    'NOTIFICATIONS_INBOX_SIZE': 3,
+    'WTF_CSRF_ENABLED': False,
+})
+
+db.create_all()
+
+
+class NotificationTestCase(TestCase):
+    """Test buffering, coalescing and reading notifications."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+        app.extensions['notifications'].events.clear()
+        app.extensions['notifications'].size = 0
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=name, email=f"{name}@test.com",
+                             password="password", image_url=None)
+                 for name in ("author", "fan1", "fan2", "fan3")]
+        db.session.commit()
+        self.author_id, *self.fan_ids = [user.id for user in users]
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def as_user(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, text):
+        msg = Message(text=text, user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def like(self, user_id, message_id):
+        self.as_user(user_id)
+        resp = self.client.post("/api/likes", json={"message_id": message_id})
+        self.assertEqual(resp.status_code, 201)
+
+    def unread(self):
+        db.session.expire_all()
+        return User.query.get(self.author_id).unread_notifications
+
+    def test_follows_coalesce(self):
+        for fan_id in self.fan_ids:
+            self.as_user(fan_id)
+            self.client.post(f"/users/follow/{self.author_id}")
+
+        # buffered until flushed
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(notifications.flush(), 1)
+
+        notification = Notification.query.one()
+        self.assertEqual((notification.kind, notification.actor_count,
+                          notification.actor_id),
+                         ("follow", 3, self.fan_ids[-1]))
+        self.assertEqual(self.unread(), 1)
+
+    def test_likes_coalesce_across_flushes(self):
+        message_id = self.post("Like me")
+        self.like(self.fan_ids[0], message_id)
+        notifications.flush()
+        self.like(self.fan_ids[1], message_id)
+        # liking your own message notifies nobody
+        self.like(self.author_id, message_id)
+        notifications.flush()
+
+        notification = Notification.query.one()
+        self.assertEqual((notification.kind, notification.subject_id,
+                          notification.actor_count),
+                         (LIKE, message_id, 2))
+        self.assertEqual(self.unread(), 1)
+
+    def test_batch_size_flushes(self):
+        app.extensions['notifications'].batch_size = 2
+        try:
+            message_id = self.post("Busy")
+            self.like(self.fan_ids[0], message_id)
+            self.assertEqual(Notification.query.count(), 0)
+            self.like(self.fan_ids[1], message_id)
+            self.assertEqual(Notification.query.count(), 1)
+        finally:
+            app.extensions['notifications'].batch_size = 500
+
+    def test_inbox_is_capped(self):
+        for i in range(5):
+            self.like(self.fan_ids[0], self.post(f"Post {i}"))
+        notifications.flush()
+
+        self.assertEqual(Notification.query.count(), 3)
+        self.assertEqual(self.unread(), 3)
+
+    def test_reading_marks_read(self):
+        message_id = self.post("Read me")
+        self.like(self.fan_ids[0], message_id)
+        notifications.flush()
+
+        self.as_user(self.author_id)
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn('badge-primary">1</span>', html)
+
+        html = self.client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@fan1", html)
+        self.assertIn("liked your warble", html)
+        self.assertEqual(self.unread(), 0)
+
+        # new likes after reading start a new notification
+        self.like(self.fan_ids[1], message_id)
+        notifications.flush()
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(self.unread(), 1)
@@ -0,0 +1,156 @@
+"""Object cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_objcache.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+from objcache import object_cache
+
+app = create_app({'RATELIMIT_ENABLED': False})
+
+# another worker, as far as invalidation goes
+other_app = create_app({'RATELIMIT_ENABLED': False})
+
+db.create_all()
+
+
+class ObjectCacheTestCase(TestCase):
+    """Test lookups, invalidation and metrics."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+        object_cache.clear()
+        app.extensions['objcache'].stats.clear()
+
+        user = User.signup(username="cached", email="cached@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+        msg = Message(text="Cache me", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def count_queries(self, func, *args):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            result = func(*args)
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+        return result, statements
+
+    def get_user(self):
+        # each lookup as in a new request
+        db.session.remove()
+        return self.count_queries(object_cache.get_user, self.user_id)
+
+    def test_user_hits(self):
+        user, statements = self.get_user()
+        self.assertEqual(len(statements), 1)
+
+        user, statements = self.get_user()
+        self.assertEqual(statements, [])
+        self.assertEqual(user.username, "cached")
+        # attached: the password and relationships still load
+        self.assertIn(user, db.session)
+        self.assertTrue(user.password.startswith("$2b$"))
+        self.assertEqual(user.following, [])
+
+        stats = object_cache.stats()
+        self.assertEqual(stats["users.misses"], 1)
+        self.assertEqual(stats["users.local_hits"], 1)
+        self.assertIsNone(object_cache.get_user(self.user_id + 1000))
+
+    def test_commit_invalidates(self):
+        user, _ = self.get_user()
+        user.bio = "Changed"
+        db.session.commit()
+
+        user, statements = self.get_user()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(user.bio, "Changed")
+
+        User.query.filter_by(id=self.user_id).update({"bio": "Bulk"})
+        db.session.commit()
+        user, _ = self.get_user()
+        self.assertEqual(user.bio, "Bulk")
+
+        # a change rolled back leaves the cache alone
+        user.bio = "Rolled back"
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.get_user()[1], [])
+
+    def test_message_pages(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.assertIn("Cache me", client.get(f"/messages/{self.message_id}")
+                      .get_data(as_text=True))
+        msg, statements = self.count_queries(object_cache.get_message,
+                                             self.message_id)
+        self.assertEqual(statements, [])
+        self.assertEqual(msg.user.username, "cached")
+
+        client.post(f"/messages/{self.message_id}/delete")
+        self.assertEqual(
+            client.get(f"/messages/{self.message_id}").status_code, 404)
+
+        resp = client.get("/api/cache/stats")
+        self.assertEqual(resp.json["messages.misses"], 2)
+
+    def test_other_workers_invalidated(self):
+        other = other_app.extensions['objcache']
+        key = f"users:{self.user_id}"
+        with other_app.app_context():
+            object_cache.get_user(self.user_id)
+        self.assertIsNotNone(other.local.get(key))
+        self.assertTrue(other.ready.wait(5))
+
+        user, _ = self.get_user()
+        user.bio = "Changed elsewhere"
+        db.session.commit()
+
+        for _ in range(50):
+            if other.local.get(key) is None:
+                break
+            time.sleep(0.05)
+        self.assertIsNone(other.local.get(key))
+        self.assertGreaterEqual(other.stats["remote_invalidations"], 1)
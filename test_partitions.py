@@ -0,0 +1,213 @@
+"""Message partition and archive tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_partitions.py
+
+
+import os
+from datetime import date, datetime, timedelta
+from unittest import TestCase, mock
+
+from sqlalchemy.exc import IntegrityError
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+
+app = create_app()
+
+import jobs
+import partitions
+from models import (db, Job, Likes, Message, MessageArchive,
+                    MessageArchiveUser, User)
+
+db.create_all()
+
+OLD_MONTH = date(2019, 3, 1)
+
+
+class PartitionTestCase(TestCase):
+    """Test partition upkeep and reading archived messages."""
+
+    def setUp(self):
+        User.query.delete()
+        MessageArchive.query.delete()
+        Job.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+    def tearDown(self):
+        db.session.rollback()
+        with db.engine.begin() as conn:
+            name = partitions.existing_partitions(conn).get(OLD_MONTH)
+            if name:
+                conn.execute(f"DROP TABLE {name}")
+
+    def existing(self):
+        with db.engine.connect() as conn:
+            return partitions.existing_partitions(conn)
+
+    def test_upcoming_partitions_exist(self):
+        this_month = partitions.month_start(datetime.utcnow())
+        for ahead in range(partitions.MONTHS_AHEAD + 1):
+            self.assertIn(partitions.add_months(this_month, ahead),
+                          self.existing())
+
+    def test_add_months(self):
+        self.assertEqual(partitions.add_months(date(2019, 11, 1), 3),
+                         date(2020, 2, 1))
+        self.assertEqual(partitions.add_months(date(2019, 1, 1), -1),
+                         date(2018, 12, 1))
+
+    def test_message_needs_partition(self):
+        db.session.add(Message(text="Too old", user_id=self.user_id,
+                               timestamp=datetime(2019, 3, 5)))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_archive_old_month(self):
+        with db.engine.begin() as conn:
+            created = partitions.create_partitions(conn, OLD_MONTH, OLD_MONTH)
+        self.assertEqual(created, [OLD_MONTH])
+
+        old = Message(text="From the archive", user_id=self.user_id,
+                      timestamp=datetime(2019, 3, 5))
+        recent = Message(text="Still live", user_id=self.user_id)
+        db.session.add_all([old, recent])
+        db.session.commit()
+        old_id = old.id
+        db.session.add(Likes(user_id=self.user_id, message_id=old_id))
+        db.session.commit()
+
+        created, archived = partitions.maintain()
+        self.assertEqual(created, [])
+        self.assertIn(OLD_MONTH, archived)
+        self.assertNotIn(OLD_MONTH, self.existing())
+
+        archive = MessageArchive.query.filter_by(month=OLD_MONTH).one()
+        self.assertEqual((archive.min_id, archive.max_id, archive.row_count),
+                         (old_id, old_id, 1))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.filter_by(message_id=old_id).count(), 1)
+
+        resp = self.client.get(f"/messages/{old_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("From the archive", resp.get_data(as_text=True))
+        self.assertIn("testuser", resp.get_data(as_text=True))
+        self.assertEqual(self.client.get(f"/messages/{old_id + 100}")
+                         .status_code, 404)
+
+        # archived months aren't recreated
+        with db.engine.begin() as conn:
+            self.assertEqual(
+                partitions.create_partitions(conn, OLD_MONTH, OLD_MONTH), [])
+
+    def archive(self, *messages):
+        """Archive (user id, text) `messages` in OLD_MONTH; return ids."""
+
+        with db.engine.begin() as conn:
+            partitions.create_partitions(conn, OLD_MONTH, OLD_MONTH)
+        rows = [Message(text=text, user_id=user_id,
+                        timestamp=datetime(2019, 3, 5))
+                for user_id, text in messages]
+        db.session.add_all(rows)
+        db.session.flush()
+        ids = [msg.id for msg in rows]
+        # no transaction left open: detaching waits for every one
+        db.session.commit()
+        partitions.maintain()
+        return ids
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_archive_in_chunks(self):
+        with mock.patch.object(partitions, 'ARCHIVE_CHUNK_ROWS', 2):
+            ids = self.archive(*[(self.user_id, f"Old {i}")
+                                 for i in range(5)])
+
+        chunks = (MessageArchive.query.filter_by(month=OLD_MONTH)
+                  .order_by(MessageArchive.min_id).all())
+        self.assertEqual([chunk.row_count for chunk in chunks], [2, 2, 1])
+        self.assertEqual(MessageArchiveUser.query.count(), 3)
+
+        # a cold read decompresses only the chunk holding the id
+        partitions._archived_rows.cache_clear()
+        self.assertEqual(partitions.find_archived(ids[2]).text, "Old 2")
+        self.assertEqual(partitions._archived_rows.cache_info().currsize, 1)
+
+    def test_delete_archived_message(self):
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        old_id, other_id = self.archive((self.user_id, "Regret"),
+                                        (other.id, "Keeper"))
+        db.session.add(Likes(user_id=other.id, message_id=old_id))
+        db.session.commit()
+
+        # only by its author
+        self.login(other.id)
+        resp = self.client.post(f"/messages/{old_id}/delete")
+        self.assertEqual(resp.status_code, 404)
+
+        self.login(self.user_id)
+        resp = self.client.post(f"/messages/{old_id}/delete")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.client.get(f"/messages/{old_id}").status_code,
+                         404)
+        self.assertEqual(Likes.query.filter_by(message_id=old_id).count(), 0)
+
+        # the rest of the chunk is still there, without its index entry
+        self.assertEqual(self.client.get(f"/messages/{other_id}").status_code,
+                         200)
+        self.assertEqual([row.user_id for row in MessageArchiveUser.query],
+                         [other.id])
+
+    def test_delete_user_removes_archive(self):
+        [old_id] = self.archive((self.user_id, "Gone with me"))
+        db.session.add(Likes(user_id=self.user_id, message_id=old_id))
+        db.session.commit()
+
+        self.login(self.user_id)
+        resp = self.client.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(MessageArchive.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(self.client.get(f"/messages/{old_id}").status_code,
+                         404)
+
+    def test_missing_author_not_found(self):
+        [old_id] = self.archive((self.user_id, "Orphaned"))
+        # deleted without going through the delete view
+        User.query.filter_by(id=self.user_id).delete()
+        db.session.commit()
+
+        self.assertEqual(self.client.get(f"/messages/{old_id}").status_code,
+                         404)
+
+    def test_maintenance_job_reschedules(self):
+        self.assertIsNotNone(partitions.schedule())
+        self.assertIsNone(partitions.schedule())
+
+        self.assertEqual(jobs.work(kinds=["partitions.maintain"], burst=True),
+                         1)
+
+        queued = Job.query.filter_by(kind="partitions.maintain",
+                                     status=jobs.QUEUED).one()
+        self.assertGreater(queued.run_at,
+                           datetime.utcnow() + timedelta(hours=23))
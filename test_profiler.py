@@ -0,0 +1,124 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_profiler.py
+
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app
+from profiler import HEADER, ID_HEADER, _Profile, profiler
+
+profile_dir = tempfile.mkdtemp()
+app = create_app({
+    'PROFILER_DIR': profile_dir,
+    'PROFILER_INTERVAL': 0.001,
+})
+
+db.create_all()
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilerTestCase(TestCase):
+    """Test choosing, recording and rotating request profiles."""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(profile_dir)
+
+    def setUp(self):
+        for name in os.listdir(profile_dir):
+            os.remove(os.path.join(profile_dir, name))
+        app.config['PROFILER_SAMPLE_RATE'] = 0
+        app.config['PROFILER_KEEP'] = 200
+
+        User.query.delete()
+        User.signup(username="testuser", email="test@test.com",
+                    password="password", image_url=None)
+        db.session.commit()
+
+        self.client = app.test_client()
+        with app.app_context():
+            self.token = profiler.token()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def profiles(self):
+        return sorted(name for name in os.listdir(profile_dir)
+                      if name.endswith(".json"))
+
+    def test_not_profiled_by_default(self):
+        resp = self.client.get("/users", buffered=True)
+        self.assertNotIn(ID_HEADER, resp.headers)
+        self.assertEqual(self.profiles(), [])
+
+    def test_forged_token_ignored(self):
+        resp = self.client.get("/users", buffered=True,
+                               headers={HEADER: "profile.forged"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn(ID_HEADER, resp.headers)
+
+    def test_signed_header_profiles(self):
+        resp = self.client.get("/users", buffered=True,
+                               headers={HEADER: self.token})
+        self.assertEqual(resp.status_code, 200)
+        name = resp.headers[ID_HEADER]
+        self.assertIn("warbler.list_users", name)
+
+        with open(os.path.join(profile_dir, name + ".json")) as summary:
+            summary = json.load(summary)
+        self.assertEqual((summary["endpoint"], summary["status"]),
+                         ("warbler.list_users", 200))
+        self.assertTrue(any("FROM users" in query["statement"]
+                            for query in summary["queries"]))
+        self.assertTrue(os.path.exists(
+            os.path.join(profile_dir, name + ".folded")))
+
+    def test_sample_rate(self):
+        app.config['PROFILER_SAMPLE_RATE'] = 1
+        resp = self.client.get("/users", buffered=True)
+        self.assertIn(ID_HEADER, resp.headers)
+
+    def test_rotation(self):
+        app.config['PROFILER_KEEP'] = 2
+        names = [self.client.get("/users", buffered=True,
+                                 headers={HEADER: self.token})
+                 .headers[ID_HEADER] for _ in range(3)]
+        self.assertEqual(self.profiles(),
+                         sorted(name + ".json" for name in names[1:]))
+        self.assertEqual(len(os.listdir(profile_dir)), 4)
+
+    def test_stack_samples(self):
+        profile = _Profile(0.001)
+        profile.start()
+        busy(0.1)
+        profile.stop()
+
+        self.assertGreater(sum(profile.stacks.values()), 5)
+        stack = profile.stacks.most_common(1)[0][0]
+        self.assertIn("test_stack_samples (test_profiler.py:", stack)
+        self.assertIn(";busy (test_profiler.py:", stack)
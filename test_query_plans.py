@@ -0,0 +1,178 @@
+"""Query plan regression tests.
+
+Requests each hot page against a database seeded from generator/*.csv,
+records every SELECT the page runs and EXPLAINs it with sequential scans
+disabled. Postgres still picks a Seq Scan when no index can serve the
+query, so any Seq Scan in a plan means a hot path lost its index.
+"""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_plans.py
+
+
+import os
+from csv import DictReader
+from datetime import datetime
+from unittest import TestCase
+
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import upgrade
+from sqlalchemy import event
+
+import partitions
+import tags
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+
+app = create_app({'LOAD_MIGRATIONS': True})
+
+
+def seed():
+    """Build the schema through migrations and load the sample CSVs."""
+
+    db.drop_all()
+    db.engine.execute("DROP TABLE IF EXISTS alembic_version")
+    with app.app_context():
+        upgrade()
+
+    # the sample messages are older than the partitions migrations create
+    with open('generator/messages.csv') as rows:
+        timestamps = [datetime.fromisoformat(row['timestamp'])
+                      for row in DictReader(rows)]
+    with db.engine.begin() as conn:
+        partitions.create_partitions(conn, min(timestamps), max(timestamps))
+
+    for model, path in [(User, 'generator/users.csv'),
+                        (Message, 'generator/messages.csv'),
+                        (Follows, 'generator/follows.csv')]:
+        with open(path) as rows:
+            db.session.bulk_insert_mappings(model, DictReader(rows))
+    db.session.commit()
+
+
+class QueryPlanTestCase(TestCase):
+    """Hot pages must not fall back to sequential scans."""
+
+    @classmethod
+    def setUpClass(cls):
+        seed()
+
+        # the seeded user that follows the most people
+        cls.user = (User.query
+                    .join(Follows, Follows.user_following_id == User.id)
+                    .group_by(User.id)
+                    .order_by(db.func.count().desc())
+                    .first())
+        liked = (Message.query
+                 .filter(Message.user_id != cls.user.id)
+                 .limit(20))
+        db.session.add_all([Likes(user_id=cls.user.id, message_id=msg.id)
+                            for msg in liked])
+        tagged = Message(text=f"#seeded hello @{cls.user.username}",
+                         user_id=cls.user.id)
+        db.session.add(tagged)
+        tags.index_message(tagged)
+        db.session.commit()
+        cls.user_id = cls.user.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.statements = []
+        event.listen(db.get_engine(app), "before_cursor_execute",
+                     self.record)
+
+    def tearDown(self):
+        event.remove(db.get_engine(app), "before_cursor_execute",
+                     self.record)
+        db.session.rollback()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            self.statements.append((statement, parameters))
+
+    def explain(self, statement, parameters):
+        """Return the plan for `statement` as one string."""
+
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("EXPLAIN " + statement, parameters)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        finally:
+            conn.rollback()
+            conn.close()
+
+    def assertIndexedPage(self, url):
+        """Request `url` as the seeded user and check every SELECT's plan."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            # record only what the page itself runs
+            del self.statements[:]
+            # read streamed pages to the end, queries and all
+            resp = c.get(url, buffered=True)
+            self.assertEqual(resp.status_code, 200, url)
+
+        self.assertTrue(self.statements, f"{url} ran no queries")
+        for statement, parameters in self.statements:
+            plan = self.explain(statement, parameters)
+            self.assertNotIn("Seq Scan", plan,
+                             f"{url} scans a whole table:\n{statement}\n{plan}")
+
+    def test_migrations_match_models(self):
+        with db.engine.connect() as conn:
+            context = MigrationContext.configure(
+                conn, opts=app.extensions['migrate'].configure_args)
+            diff = compare_metadata(context, db.metadata)
+        self.assertEqual(diff, [], "models.py changed without a migration")
+
+    def test_homepage(self):
+        self.assertIndexedPage("/")
+
+    def test_users_show(self):
+        self.assertIndexedPage(f"/users/{self.user_id}")
+
+    def test_list_messages(self):
+        self.assertIndexedPage("/messages")
+
+    def test_show_likes(self):
+        self.assertIndexedPage(f"/users/{self.user_id}/likes")
+
+    def test_show_following(self):
+        self.assertIndexedPage(f"/users/{self.user_id}/following")
+
+    def test_users_followers(self):
+        self.assertIndexedPage(f"/users/{self.user_id}/followers")
+
+    def test_tag_timeline(self):
+        self.assertIndexedPage("/tags/seeded")
+
+    def test_user_mentions(self):
+        self.assertIndexedPage(f"/users/{self.user_id}/mentions")
+
+    def test_relationships(self):
+        ids = ",".join(str(user_id) for (user_id,) in
+                       db.session.query(User.id).limit(300))
+        self.assertIndexedPage(f"/api/relationships?ids={ids}")
@@ -0,0 +1,185 @@
+"""Ranked home feed tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_ranking.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+import partitions
+import ranking
+
+app = create_app()
+
+db.create_all()
+
+
+class ScoringTestCase(TestCase):
+    """Test the array math on its own."""
+
+    def test_score(self):
+        at = datetime(2020, 1, 2)
+        timestamps = np.array([
+            (at - ranking.EPOCH).total_seconds(),
+            (at - timedelta(hours=24) - ranking.EPOCH).total_seconds(),
+        ])
+        scores = ranking.score(timestamps, at, 24, np.zeros(2), np.zeros(2),
+                               1.0, 0.5)
+        np.testing.assert_allclose(scores, [1, 0.5])
+
+        liked = ranking.score(timestamps, at, 24, np.array([0, np.e - 1]),
+                              np.zeros(2), 1.0, 0.5)
+        np.testing.assert_allclose(liked, [1, 1])
+
+    def test_rank_breaks_ties_by_id(self):
+        ids = np.array([3, 7, 5, 1])
+        scores = np.array([1.0, 2.0, 1.0, 1.0])
+        self.assertEqual(ids[ranking.rank(ids, scores)].tolist(),
+                         [7, 5, 3, 1])
+        self.assertEqual(ids[ranking.rank(ids, scores, (1.0, 5))].tolist(),
+                         [3, 1])
+
+    def test_align_sums_shards(self):
+        keys = np.array([10, 20, 10, 30])
+        rows = [(10, 2), (30, 1), (10, 1), (99, 5)]
+        self.assertEqual(ranking._align(keys, rows).tolist(),
+                         [3, 0, 3, 1])
+
+    def test_cursor_round_trip(self):
+        at = datetime(2020, 1, 2, 3, 4, 5, 678901)
+        cursor = ranking.encode_cursor(at, 0.1 + 0.2, 42)
+        self.assertEqual(ranking.decode_cursor(cursor), (at, (0.1 + 0.2, 42)))
+        self.assertIsNone(ranking.decode_cursor("garbage"))
+        self.assertIsNone(ranking.decode_cursor(None))
+
+
+class RankedFeedTestCase(TestCase):
+    """Test the ranked feed against the database."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+        self.now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            partitions.create_partitions(conn, self.now - timedelta(days=8),
+                                         self.now)
+
+        users = [User.signup(username=name, email=f"{name}@test.com",
+                             password="password", image_url=None)
+                 for name in ("viewer", "favorite", "other")]
+        db.session.commit()
+        self.viewer_id, self.favorite_id, self.other_id = [u.id for u in users]
+        db.session.add_all([
+            Follows(user_following_id=self.viewer_id,
+                    user_being_followed_id=author_id)
+            for author_id in (self.favorite_id, self.other_id)])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['FEED_BUDGET_MS'] = 150
+        self.ctx.pop()
+
+    def post(self, user_id, text, hours_ago):
+        msg = Message(text=text, user_id=user_id,
+                      timestamp=self.now - timedelta(hours=hours_ago))
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def feed(self, cursor=None, page_size=100):
+        messages, cursor = ranking.ranked_feed(
+            self.viewer_id, [self.viewer_id, self.favorite_id, self.other_id],
+            cursor, page_size)
+        return [msg.text for msg in messages], cursor
+
+    def test_affinity_outranks_recency(self):
+        old = self.post(self.favorite_id, "Old favorite", 24 * 3)
+        self.post(self.favorite_id, "Favorite", 2)
+        self.post(self.other_id, "Other", 1)
+        db.session.add(Likes(user_id=self.viewer_id, message_id=old))
+        db.session.commit()
+
+        texts, _ = self.feed()
+        self.assertEqual(texts[:2], ["Favorite", "Other"])
+
+        html = self.client.get("/?feed=top").get_data(as_text=True)
+        self.assertLess(html.index("Favorite"), html.index("Other"))
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertLess(html.index("Other"), html.index("Favorite"))
+
+    def test_engagement(self):
+        self.post(self.other_id, "Newer", 1)
+        popular = self.post(self.other_id, "Popular", 2)
+        db.session.add_all([Likes(user_id=user_id, message_id=popular)
+                            for user_id in (self.favorite_id, self.other_id)])
+        db.session.commit()
+
+        self.assertEqual(self.feed()[0], ["Popular", "Newer"])
+
+    def test_pages_are_stable(self):
+        for i in range(5):
+            self.post(self.other_id, f"Post {i}", i)
+
+        seen, cursor = self.feed(page_size=2)
+        self.assertIsNotNone(cursor)
+        # posted after the first page: not slotted into later pages
+        self.post(self.other_id, "Late", 0)
+        while cursor:
+            texts, cursor = self.feed(cursor, page_size=2)
+            seen += texts
+        self.assertEqual(seen, [f"Post {i}" for i in range(5)])
+
+        html = self.client.get("/?feed=top").get_data(as_text=True)
+        self.assertNotIn("cursor=", html)
+
+    def test_budget_skips_likes(self):
+        self.post(self.other_id, "Newer", 1)
+        popular = self.post(self.other_id, "Popular", 2)
+        db.session.add(Likes(user_id=self.favorite_id, message_id=popular))
+        db.session.commit()
+        app.config['FEED_BUDGET_MS'] = 0
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            texts, _ = self.feed()
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+
+        self.assertEqual(texts, ["Newer", "Popular"])
+        self.assertFalse(any("FROM likes" in statement
+                             for statement in statements))
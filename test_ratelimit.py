@@ -0,0 +1,139 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_ratelimit.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User
+from ratelimit import MemoryBackend, limiter
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+
+app = create_app()
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MemoryBackendTestCase(TestCase):
+    """Test the in-memory token bucket."""
+
+    def test_bucket_drains_and_refills(self):
+        backend = MemoryBackend()
+
+        for _ in range(3):
+            self.assertEqual(backend.consume("k", rate=1000, capacity=3), 0)
+        self.assertGreater(backend.consume("k", rate=0.001, capacity=3), 0)
+
+    def test_keys_are_independent(self):
+        backend = MemoryBackend()
+
+        backend.consume("a", rate=0.001, capacity=1)
+        self.assertGreater(backend.consume("a", rate=0.001, capacity=1), 0)
+        self.assertEqual(backend.consume("b", rate=0.001, capacity=1), 0)
+
+    def test_eviction_bounds_memory(self):
+        backend = MemoryBackend(max_keys=10)
+
+        for i in range(100):
+            backend.consume(str(i), rate=1, capacity=1)
+        self.assertLessEqual(len(backend._buckets), 10)
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test limits applied to views."""
+
+    def setUp(self):
+        with app.app_context():
+            limiter.reset()
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        with app.app_context():
+            limiter.reset()
+
+    def test_login_limited_per_ip(self):
+        with self.client as c:
+            for _ in range(10):
+                resp = c.post("/login", data={"username": "testuser",
+                                              "password": "wrong-password"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post("/login", data={"username": "testuser",
+                                          "password": "wrong-password"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+
+            # rendering the form is not counted
+            resp = c.get("/login")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_messages_limited_per_user(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for i in range(10):
+                resp = c.post("/messages/new", data={"text": f"Hello {i}"})
+                self.assertEqual(resp.status_code, 302)
+
+            resp = c.post("/messages/new", data={"text": "Hello 10"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(Message.query.count(), 10)
+
+    def test_api_limit_returns_json(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for _ in range(60):
+                c.post("/api/likes", json={"message_id": 0})
+
+            resp = c.post("/api/likes", json={"message_id": 0})
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("message", resp.json)
+
+    def test_settings_kept_per_app(self):
+        # an app created later doesn't switch this one's limits off
+        unlimited = create_app({'RATELIMIT_ENABLED': False})
+
+        for _ in range(10):
+            unlimited.test_client().post("/login", data={
+                "username": "testuser", "password": "wrong-password"})
+        for _ in range(10):
+            self.client.post("/login", data={"username": "testuser",
+                                             "password": "wrong-password"})
+
+        resp = self.client.post("/login", data={"username": "testuser",
+                                                "password": "wrong-password"})
+        self.assertEqual(resp.status_code, 429)
+        resp = unlimited.test_client().post("/login", data={
+            "username": "testuser", "password": "wrong-password"})
+        self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,280 @@
+"""Shard routing tests.
+
+The main database is the usual test database; messages and likes go to
+two SQLite files standing in for shard databases.
+"""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_sharding.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from sqlalchemy import func, select
+
+from models import db, Follows, IdBlock, Message, User, UserShard
+from sharding import LIKES, MENTIONS, MESSAGE_TAGS, MESSAGES, shards
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+
+shard_dir = tempfile.mkdtemp()
+app = create_app({
+    'SHARD_URLS': [f"sqlite:///{shard_dir}/shard{i}.db" for i in range(2)],
+    'WTF_CSRF_ENABLED': False,
+    'SHARD_MOVE_GRACE': 0,
+})
+
+db.create_all()
+with app.app_context():
+    shards.create_schemas()
+
+
+class ShardingTestCase(TestCase):
+    """Test views and maintenance with messages split over two shards."""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(shard_dir)
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        IdBlock.query.delete()
+        db.session.commit()
+        for engine in app.extensions['shards'].engines:
+            for table in (MESSAGES, LIKES, MESSAGE_TAGS, MENTIONS):
+                engine.execute(table.delete())
+        app.extensions['shards'].directory.clear()
+        app.extensions['shards'].blocks.clear()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=name, email=f"{name}@test.com",
+                             password="password", image_url=None)
+                 for name in ("alice", "bob")]
+        db.session.commit()
+        self.alice_id, self.bob_id = [user.id for user in users]
+        db.session.add(Follows(user_being_followed_id=self.bob_id,
+                               user_following_id=self.alice_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        with self.client as c:
+            self.login(c, user_id)
+            resp = c.post("/messages/new", data={"text": text})
+            self.assertEqual(resp.status_code, 302)
+        return (shards.session_for(user_id).query(Message)
+                .filter_by(text=text).one().id)
+
+    def count(self, shard, table, **where):
+        engine = app.extensions['shards'].engines[shard]
+        query = select([func.count()]).select_from(table)
+        for column, value in where.items():
+            query = query.where(table.c[column] == value)
+        return engine.execute(query).scalar()
+
+    def test_users_spread_over_shards(self):
+        self.assertNotEqual(shards.shard_for(self.alice_id),
+                            shards.shard_for(self.bob_id))
+
+    def test_message_stored_on_authors_shard(self):
+        self.post(self.alice_id, "Hello from alice #sharded")
+        home = shards.shard_for(self.alice_id)
+
+        self.assertEqual(self.count(home, MESSAGES), 1)
+        self.assertEqual(self.count(1 - home, MESSAGES), 0)
+        self.assertEqual(Message.query.count(), 0)
+
+        with self.client as c:
+            self.login(c, self.bob_id)
+            resp = c.get(f"/users/{self.alice_id}")
+            self.assertIn("Hello from alice", resp.get_data(as_text=True))
+            resp = c.get("/tags/sharded")
+            self.assertIn("Hello from alice", resp.get_data(as_text=True))
+
+    def test_home_feed_gathers_shards(self):
+        self.post(self.alice_id, "Alice was here")
+        self.post(self.bob_id, "Bob was here")
+
+        with self.client as c:
+            self.login(c, self.alice_id)
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("Alice was here", html)
+        self.assertIn("Bob was here", html)
+        self.assertLess(html.index("Bob was here"),
+                        html.index("Alice was here"))
+
+    def test_ids_unique_across_shards(self):
+        ids = [self.post(user_id, f"Post {i}")
+               for i, user_id in enumerate([self.alice_id, self.bob_id] * 3)]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_likes_on_likers_shard(self):
+        message_id = self.post(self.bob_id, "Like me")
+
+        with self.client as c:
+            self.login(c, self.alice_id)
+            resp = c.post("/api/likes", json={"message_id": message_id})
+            self.assertEqual(resp.status_code, 201)
+            likes_id = resp.json["likes"]["id"]
+
+            self.assertEqual(
+                self.count(shards.shard_for(self.alice_id), LIKES), 1)
+            html = c.get(f"/users/{self.alice_id}/likes").get_data(as_text=True)
+            self.assertIn("Like me", html)
+
+            # only the liker can remove it
+            self.login(c, self.bob_id)
+            self.assertEqual(c.delete(f"/api/likes/{likes_id}").status_code,
+                             404)
+            self.login(c, self.alice_id)
+            self.assertEqual(c.delete(f"/api/likes/{likes_id}").status_code,
+                             200)
+
+        self.assertEqual(self.count(shards.shard_for(self.alice_id), LIKES), 0)
+
+    def test_messages_show_finds_any_shard(self):
+        message_id = self.post(self.bob_id, "Find me")
+
+        resp = self.client.get(f"/messages/{message_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Find me", resp.get_data(as_text=True))
+        self.assertEqual(self.client.get("/messages/0").status_code, 404)
+
+    def test_destroy_message_purges_likes(self):
+        message_id = self.post(self.bob_id, "Short lived")
+        with self.client as c:
+            self.login(c, self.alice_id)
+            c.post("/api/likes", json={"message_id": message_id})
+
+            self.login(c, self.bob_id)
+            resp = c.post(f"/messages/{message_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(self.count(shards.shard_for(self.alice_id), LIKES), 0)
+
+    def test_move_user(self):
+        self.post(self.bob_id, "Bob moves @alice")
+        source = shards.shard_for(self.bob_id)
+        target = 1 - source
+
+        # moves wait for the directory caches to expire
+        with mock.patch('sharding.time.sleep') as sleep:
+            self.assertEqual(shards.move_user(self.bob_id, target), 1)
+        sleep.assert_called_once_with(30)
+        self.assertEqual(shards.shard_for(self.bob_id), target)
+        self.assertEqual(self.count(target, MESSAGES, user_id=self.bob_id), 1)
+        self.assertEqual(self.count(target, MENTIONS, user_id=self.alice_id),
+                         1)
+
+        # the old copy stays until pruned
+        self.assertEqual(self.count(source, MESSAGES, user_id=self.bob_id), 1)
+        self.assertEqual(shards.prune(), 1)
+        self.assertEqual(self.count(source, MESSAGES, user_id=self.bob_id), 0)
+
+        resp = self.client.get(f"/users/{self.bob_id}")
+        self.assertIn("Bob moves", resp.get_data(as_text=True))
+
+    def test_rebalance(self):
+        self.post(self.bob_id, "Misplaced")
+        with mock.patch('sharding.time.sleep'):
+            shards.move_user(self.bob_id, 1 - self.bob_id % 2)
+            self.assertEqual(shards.rebalance(), 1)
+        self.assertEqual(shards.shard_for(self.bob_id), self.bob_id % 2)
+
+    def test_writes_refused_while_moving(self):
+        message_id = self.post(self.bob_id, "Before the move")
+        source = shards.shard_for(self.bob_id)
+        target = 1 - source
+        responses = []
+
+        def wait(seconds):
+            # every worker's cached entry has expired by now
+            app.extensions['shards'].directory.clear()
+            with self.client as c:
+                self.login(c, self.bob_id)
+                responses.append(c.post("/messages/new",
+                                        data={"text": "During the move"}))
+                responses.append(c.post("/api/likes",
+                                        json={"message_id": message_id}))
+                # reads carry on from the old copy
+                responses.append(c.get(f"/users/{self.bob_id}"))
+
+        with mock.patch('sharding.time.sleep', wait):
+            shards.move_user(self.bob_id, target)
+
+        post, like, profile = responses
+        self.assertEqual((post.status_code, like.status_code), (503, 503))
+        self.assertIn("Retry-After", post.headers)
+        self.assertIn("Before the move", profile.get_data(as_text=True))
+        self.assertEqual(self.count(source, MESSAGES, user_id=self.bob_id), 1)
+        self.assertEqual(self.count(source, LIKES), 0)
+
+        # writes go to the new shard once moved
+        self.post(self.bob_id, "After the move")
+        self.assertEqual(self.count(target, MESSAGES, user_id=self.bob_id), 2)
+
+    def test_reads_dont_place_users(self):
+        with self.client as c:
+            self.login(c, self.alice_id)
+            self.assertEqual(c.get(f"/users/{self.bob_id}").status_code, 200)
+            self.assertEqual(c.get("/").status_code, 200)
+        self.assertEqual(UserShard.query.count(), 0)
+
+        self.post(self.alice_id, "Placed on first write")
+        self.assertEqual([row.user_id for row in UserShard.query],
+                         [self.alice_id])
+
+    def test_delete_user_purges_shards(self):
+        message_id = self.post(self.bob_id, "Goodbye")
+        with self.client as c:
+            self.login(c, self.alice_id)
+            c.post("/api/likes", json={"message_id": message_id})
+
+            self.login(c, self.bob_id)
+            c.post("/users/delete")
+
+        for shard in range(2):
+            self.assertEqual(self.count(shard, MESSAGES), 0)
+            self.assertEqual(self.count(shard, LIKES), 0)
+
+    def test_like_counts_sum_shards(self):
+        message_id = self.post(self.bob_id, "Liked everywhere")
+        for user_id in (self.alice_id, self.bob_id):
+            with self.client as c:
+                self.login(c, user_id)
+                resp = c.post("/api/likes", json={"message_id": message_id})
+                self.assertEqual(resp.status_code, 201)
+
+        # the two likes sit on different shards
+        self.assertEqual(self.count(0, LIKES) + self.count(1, LIKES), 2)
+        with self.client as c:
+            self.login(c, self.alice_id)
+            html = c.get("/messages").get_data(as_text=True)
+        self.assertIn('<span class="like-count text-muted">2</span>', html)
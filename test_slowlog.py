@@ -0,0 +1,172 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_slowlog.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app
+import slowlog
+
+log_dir = tempfile.mkdtemp(prefix="warbler-slow-queries-test-")
+app = create_app({
+    'SLOW_QUERY_DIR': log_dir,
+    'SLOW_QUERY_THRESHOLD_MS': 50,
+    'RATELIMIT_ENABLED': False,
+})
+
+db.create_all()
+
+SLOW = "SELECT pg_sleep(:seconds), :label AS label"
+
+
+class NormalizeTestCase(TestCase):
+    """Test normalizing statements and parameters on their own."""
+
+    def test_values_replaced(self):
+        self.assertEqual(
+            slowlog.normalize("SELECT users.id AS users_id FROM users\n"
+                              "  WHERE users.username LIKE %(username_1)s"
+                              " AND users.id IN (%(id_1)s, %(id_2)s)"
+                              " AND bio = 'it''s' LIMIT 10"),
+            "SELECT users.id AS users_id FROM users"
+            " WHERE users.username LIKE ? AND users.id IN (?, ...)"
+            " AND bio = ? LIMIT ?")
+
+    def test_same_fingerprint_for_any_list_length(self):
+        one = slowlog.normalize("SELECT 1 FROM t WHERE id IN (%(a)s)")
+        two = slowlog.normalize("SELECT 1 FROM t WHERE id IN (%(a)s, %(b)s)")
+        self.assertNotEqual(one, two)
+        three = slowlog.normalize(
+            "SELECT 1 FROM t WHERE id IN (%(a)s, %(b)s, %(c)s)")
+        self.assertEqual(slowlog.fingerprint(two),
+                         slowlog.fingerprint(three))
+
+    def test_names_with_digits_kept(self):
+        self.assertEqual(slowlog.normalize("SELECT anon_1.id FROM t2"),
+                         "SELECT anon_1.id FROM t2")
+
+    def test_shapes(self):
+        self.assertEqual(slowlog.shapes({"name": "abc", "ids": [1, 2],
+                                         "n": 3, "at": None}),
+                         {"name": "str[3]", "ids": "list[2]", "n": "int",
+                          "at": "NoneType"})
+        self.assertEqual(slowlog.shapes([{"a": 1}, {"a": 2}], True),
+                         {"rows": 2, "each": {"a": "int"}})
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test logging, explaining and reporting slow statements."""
+
+    def setUp(self):
+        state = app.extensions['slowlog']
+        if state.logger is not None:
+            for handler in state.logger.handlers:
+                handler.close()
+        # a new log, opened on the first slow query
+        state.logger_pid = None
+        shutil.rmtree(log_dir, ignore_errors=True)
+        state.explained.clear()
+        state.analyze = False
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def entries(self):
+        return sorted(slowlog.read_entries(log_dir),
+                      key=lambda entry: entry["time"])
+
+    def test_slow_statement_logged(self):
+        db.session.execute("SELECT 1")
+        db.session.execute(SLOW, {"seconds": 0.06, "label": "first"})
+
+        [entry] = self.entries()
+        self.assertGreaterEqual(entry["ms"], 50)
+        self.assertEqual(entry["statement"], "SELECT pg_sleep(?), ? AS label")
+        self.assertEqual(entry["parameters"],
+                         {"seconds": "float", "label": "str[5]"})
+        self.assertIsNone(entry["endpoint"])
+        self.assertEqual(entry["database"], "warbler-test")
+        self.assertIn("Result", entry["plan"])
+        self.assertFalse(entry["analyzed"])
+
+    def test_transaction_unharmed(self):
+        db.session.add(User(username="slow", email="slow@test.com",
+                            password="unused"))
+        db.session.flush()
+        db.session.execute(SLOW, {"seconds": 0.06, "label": "x"})
+        # the EXPLAIN ran in a savepoint of the same transaction
+        self.assertEqual(User.query.filter_by(username="slow").count(), 1)
+        db.session.rollback()
+        self.assertEqual(User.query.filter_by(username="slow").count(), 0)
+
+    def test_explained_once_per_interval(self):
+        for label in ("a", "b"):
+            db.session.execute(SLOW, {"seconds": 0.06, "label": label})
+        first, second = self.entries()
+        self.assertEqual(first["fingerprint"], second["fingerprint"])
+        self.assertIsNotNone(first["plan"])
+        self.assertIsNone(second["plan"])
+
+    def test_analyze(self):
+        app.extensions['slowlog'].analyze = True
+        db.session.execute(SLOW, {"seconds": 0.06, "label": "x"})
+        db.session.execute("SELECT nextval('users_id_seq'), pg_sleep(0.06)")
+        analyzed, skipped = self.entries()
+        self.assertTrue(analyzed["analyzed"])
+        self.assertIn("actual time", analyzed["plan"])
+        # running it again would use up another id
+        self.assertFalse(skipped["analyzed"])
+        self.assertNotIn("actual time", skipped["plan"])
+
+    def test_endpoint_recorded(self):
+        # everything the page runs
+        app.extensions['slowlog'].threshold = 0
+        try:
+            app.test_client().get("/users?q=nobody", buffered=True)
+        finally:
+            app.extensions['slowlog'].threshold = 0.05
+        [search] = [entry for entry in self.entries()
+                    if "users.username LIKE ?" in entry["statement"]]
+        self.assertEqual(search["endpoint"], "warbler.list_users")
+        self.assertEqual(search["parameters"]["username_1"], "str[8]")
+
+    def test_report(self):
+        for label in ("a", "b", "c"):
+            db.session.execute(SLOW, {"seconds": 0.06, "label": label})
+        db.session.execute("SELECT pg_sleep(0.1)")
+
+        sleeps, slowest = slowlog.report(log_dir)
+        self.assertEqual(sleeps["count"], 3)
+        self.assertEqual(sleeps["statement"],
+                         "SELECT pg_sleep(?), ? AS label")
+        self.assertGreaterEqual(sleeps["total_ms"], 180)
+        self.assertIsNotNone(sleeps["plan"])
+        self.assertEqual(sleeps["endpoints"], {None: 3})
+        self.assertEqual(slowest["count"], 1)
+
+        self.assertEqual(len(slowlog.report(log_dir, top=1)), 1)
+        result = app.test_cli_runner().invoke(
+            args=["slow-queries", "report", "--plans"])
+        self.assertIn("3 run(s)", result.output)
+        self.assertIn("Result", result.output)
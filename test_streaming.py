@@ -0,0 +1,119 @@
+"""Streamed listing page tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_streaming.py
+
+
+import gzip
+import os
+import zlib
+from unittest import TestCase
+
+from models import db, Follows, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+import streaming
+
+app = create_app({'STREAM_CHUNK_SIZE': 256})
+
+db.create_all()
+
+
+class ChunkingTestCase(TestCase):
+    """Test chunking and compressing a stream on their own."""
+
+    def test_chunked(self):
+        chunks = list(streaming.chunked(["ab", "cd", "é", "f"], 4))
+        self.assertEqual(chunks, [b"abcd", "éf".encode()])
+        self.assertEqual(list(streaming.chunked([], 4)), [])
+
+    def test_gzipped_flushes_each_chunk(self):
+        stream = streaming.gzipped(iter([b"first " * 50, b"second"]), 6)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # the first chunk decodes before the rest is even produced
+        self.assertEqual(decompressor.decompress(next(stream)),
+                         b"first " * 50)
+        rest = b"".join(stream)
+        self.assertEqual(decompressor.decompress(rest), b"second")
+        self.assertTrue(decompressor.eof)
+
+
+class StreamedPagesTestCase(TestCase):
+    """Test the listing pages rendered with stream_template."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        # no one logs in with a password here, so skip hashing them
+        users = [User(username=f"user{i:02}", email=f"u{i}@test.com",
+                      password="unused")
+                 for i in range(30)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = [user.id for user in users]
+        # everyone else follows user00
+        db.session.add_all([Follows(user_following_id=user_id,
+                                    user_being_followed_id=self.ids[0])
+                            for user_id in self.ids[1:]])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[1]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_list_users_streamed(self):
+        resp = self.client.get("/users")
+        self.assertTrue(resp.is_streamed)
+        chunks = list(resp.response)
+        resp.close()
+        # sent in pieces as the page renders, not as one string
+        self.assertGreater(len(chunks), 10)
+
+        html = b"".join(chunks).decode()
+        for i in range(30):
+            self.assertIn(f"@user{i:02}", html)
+        self.assertTrue(html.rstrip().endswith("</html>"))
+
+    def test_no_users_found(self):
+        html = self.client.get("/users?q=nobody").get_data(as_text=True)
+        self.assertIn("Sorry, no users found", html)
+
+    def test_gzip(self):
+        plain = self.client.get("/users").get_data()
+        resp = self.client.get("/users",
+                               headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertIn("Accept-Encoding", resp.vary)
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+
+        resp = self.client.get("/users",
+                               headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertIsNone(resp.content_encoding)
+        resp.close()
+
+    def test_followers_and_following(self):
+        html = (self.client.get(f"/users/{self.ids[0]}/followers")
+                .get_data(as_text=True))
+        self.assertEqual(html.count('class="card user-card"'), 29)
+        self.assertIn(f'/users/{self.ids[0]}/followers">29</a>', html)
+
+        html = (self.client.get(f"/users/{self.ids[2]}/following")
+                .get_data(as_text=True))
+        self.assertEqual(html.count('class="card user-card"'), 1)
+        self.assertIn("@user00", html)
+        self.assertIn(f'/users/{self.ids[2]}/following">1</a>', html)
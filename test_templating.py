@@ -0,0 +1,90 @@
+"""Template bytecode cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_templating.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import templating
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app
+
+
+class TemplateCacheTestCase(TestCase):
+    """Test the shared bytecode cache and warm-up."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.app = create_app({'TEMPLATE_CACHE_DIR': self.cache_dir})
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def cache_files(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.endswith('.cache')]
+
+    def test_warm_up_compiles_every_template(self):
+        names = templating.warm_up(self.app)
+
+        self.assertIn('base.html', names)
+        self.assertIn('users/detail.html', names)
+        self.assertEqual(len(self.cache_files()), len(names))
+
+    def test_new_worker_loads_bytecode(self):
+        templating.warm_up(self.app)
+
+        # a fresh app stands in for another worker
+        other = create_app({'TEMPLATE_CACHE_DIR': self.cache_dir})
+        env = other.jinja_env
+        source, filename, _ = env.loader.get_source(env, 'base.html')
+        bucket = env.bytecode_cache.get_bucket(env, 'base.html', filename,
+                                               source)
+        self.assertIsNotNone(bucket.code)
+
+    def test_changed_template_is_recompiled(self):
+        templating.warm_up(self.app)
+
+        env = self.app.jinja_env
+        source, filename, _ = env.loader.get_source(env, 'base.html')
+        bucket = env.bytecode_cache.get_bucket(env, 'base.html', filename,
+                                               source + "<!-- edited -->")
+        self.assertIsNone(bucket.code)
+
+    def test_shared_directory_refused(self):
+        os.chmod(self.cache_dir, 0o777)
+        with mock.patch('logging.Logger.warning') as warning:
+            app = create_app({'TEMPLATE_CACHE_DIR': self.cache_dir})
+        self.assertIsNone(app.jinja_env.bytecode_cache)
+        warning.assert_called_once()
+
+        os.chmod(self.cache_dir, 0o700)
+        os.rmdir(self.cache_dir)
+        os.symlink(tempfile.gettempdir(), self.cache_dir)
+        try:
+            with mock.patch('logging.Logger.warning'):
+                app = create_app({'TEMPLATE_CACHE_DIR': self.cache_dir})
+            self.assertIsNone(app.jinja_env.bytecode_cache)
+        finally:
+            os.remove(self.cache_dir)
+            os.mkdir(self.cache_dir)
+
+    def test_new_directory_private(self):
+        directory = os.path.join(self.cache_dir, 'templates')
+        create_app({'TEMPLATE_CACHE_DIR': directory})
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
@@ -0,0 +1,196 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_thumbnails.py
+
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
+
+from PIL import Image
+
+from models import db
+import thumbnails as thumbnails_module
+from thumbnails import SIZES, thumbnails
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import create_app
+
+app = create_app({'THUMBNAIL_ALLOW_PRIVATE': True})
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    """Serves files from a directory and counts the requests it gets."""
+
+    requests = 0
+
+    def do_GET(self):
+        CountingHandler.requests += 1
+        if self.path.startswith('/redirect?to='):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect?to='):])
+            self.end_headers()
+        elif self.path == '/garbage':
+            self.wfile.write(b"nonsense\r\n\r\n")
+        else:
+            super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThumbnailTestCase(TestCase):
+    """Test the image proxy against a local file server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.source_dir = tempfile.mkdtemp()
+        Image.new('RGB', (800, 600), 'red').save(
+            os.path.join(cls.source_dir, 'photo.png'))
+        with open(os.path.join(cls.source_dir, 'broken.png'), 'w') as f:
+            f.write("not an image")
+
+        cls.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            partial(CountingHandler, directory=cls.source_dir))
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.source_dir)
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.state = app.extensions['thumbnails']
+        self.state.directory = self.cache_dir
+        self.state.allow_private = True
+        self.state.max_bytes = app.config['THUMBNAIL_CACHE_MAX_BYTES']
+        # counted afresh for the new directory
+        self.state.cached_bytes = None
+        CountingHandler.requests = 0
+        self.client = app.test_client()
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        shutil.rmtree(self.cache_dir)
+        db.session.rollback()
+
+    def test_local_images_untouched(self):
+        self.assertEqual(thumbnails.url_for("/static/images/default-pic.png",
+                                            "avatar"),
+                         "/static/images/default-pic.png")
+
+    def test_resize_and_cache(self):
+        url = thumbnails.url_for(f"{self.base_url}/photo.png", "avatar")
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+        image = Image.open(io.BytesIO(resp.data))
+        self.assertEqual(image.size, SIZES["avatar"])
+
+        # every size was rendered from the single fetch
+        hero = self.client.get(thumbnails.url_for(f"{self.base_url}/photo.png",
+                                                  "hero"))
+        self.assertEqual(Image.open(io.BytesIO(hero.data)).size, SIZES["hero"])
+        self.assertEqual(CountingHandler.requests, 1)
+
+        # revalidation by etag
+        resp = self.client.get(url, headers={"If-None-Match": resp.get_etag()[0]})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_forged_token(self):
+        resp = self.client.get("/images/avatar/not-a-signed-token")
+        self.assertEqual(resp.status_code, 404)
+
+        url = thumbnails.url_for(f"{self.base_url}/photo.png", "huge")
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_broken_source_falls_back(self):
+        source = f"{self.base_url}/broken.png"
+        resp = self.client.get(thumbnails.url_for(source, "avatar"))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, source)
+
+    def test_private_hosts_refused(self):
+        self.state.allow_private = False
+        source = f"{self.base_url}/photo.png"
+
+        resp = self.client.get(thumbnails.url_for(source, "avatar"))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(CountingHandler.requests, 0)
+
+    def test_redirect_to_private_host_refused(self):
+        self.state.allow_private = False
+        port = self.server.server_port
+        source = (f"{self.base_url}/redirect?to="
+                  f"http://127.0.0.2:{port}/photo.png")
+
+        # only the test server's own address counts as public
+        with mock.patch.object(thumbnails_module, '_is_private',
+                               lambda address: address != '127.0.0.1'):
+            resp = self.client.get(thumbnails.url_for(source, "avatar"))
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(CountingHandler.requests, 1)
+
+            # while a redirect to a public host is followed
+            source = f"{self.base_url}/redirect?to=/photo.png"
+            resp = self.client.get(thumbnails.url_for(source, "avatar"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(CountingHandler.requests, 3)
+
+    def test_bad_response_falls_back(self):
+        source = f"{self.base_url}/garbage"
+        resp = self.client.get(thumbnails.url_for(source, "avatar"))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, source)
+
+    def test_eviction_bounds_cache(self):
+        self.state.max_bytes = 1
+        thumbnails.get(f"{self.base_url}/photo.png", "avatar")
+
+        blobs = [name for _, _, files in os.walk(self.cache_dir)
+                 for name in files if name.endswith(".jpg")]
+        self.assertEqual(blobs, [])
+
+    def test_size_tracked_between_sweeps(self):
+        thumbnails.get(f"{self.base_url}/photo.png", "avatar")
+        counted = self.state.cached_bytes
+        self.assertGreater(counted, 0)
+
+        # blobs written elsewhere aren't walked for until a sweep
+        with open(os.path.join(self.cache_dir, 'blobs', 'extra.jpg'),
+                  'wb') as f:
+            f.write(b"x" * 100)
+        Image.new('RGB', (10, 10), 'blue').save(
+            os.path.join(self.source_dir, 'small.png'))
+        thumbnails.get(f"{self.base_url}/small.png", "avatar")
+        tracked = self.state.cached_bytes
+        self.assertGreater(tracked, counted)
+
+        thumbnails.evict()
+        self.assertEqual(self.state.cached_bytes, tracked + 100)
@@ -17,7 +17,9 @@ from sqlalchemy.exc import IntegrityError
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
-from app import app
+from app import create_app
+
+app = create_app()
 from models import Follows, User, db, Message
 
 # Create our tables (we do this here, so we only create the tables
@@ -95,6 +97,22 @@ class UserModelTestCase(TestCase):
         self.assertFalse(self.user1.is_following(self.user2))
         self.assertTrue(self.user2.is_following(self.user1))
 
+    def test_relationships(self):
+        db.session.add_all([self.user1, self.user2])
+        db.session.commit()
+        f1 = Follows(user_being_followed_id=self.user1.id,
+                     user_following_id=self.user2.id)
+        db.session.add(f1)
+        db.session.commit()
+        missing_id = self.user1.id + self.user2.id
+
+        self.assertEqual(
+            User.relationships(self.user1.id, [self.user2.id, missing_id]),
+            {self.user2.id: (False, True), missing_id: (False, False)})
+        self.assertEqual(User.relationships(self.user2.id, [self.user1.id]),
+                         {self.user1.id: (True, False)})
+        self.assertEqual(User.relationships(self.user1.id, []), {})
+
     def test_sign_up(self):
         user = User.signup(
             self.user1.username, self.user1.email, self.user1.password, None
@@ -24,7 +24,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+import app as app_module
+from app import create_app, CURR_USER_KEY
+
+app = create_app()
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -153,6 +156,36 @@ class UserViewTestCase(TestCase):
             self.assertIn(self.testuser1.username, html)
             self.assertIn(self.testuser2.username, html)
 
+    def test_show_likes_paging(self):
+        messages = [Message(text=f"Message {i}", user_id=self.testuser1.id)
+                    for i in range(app_module.TIMELINE_PAGE_SIZE + 1)]
+        db.session.add_all(messages)
+        db.session.commit()
+        db.session.add_all([Likes(user_id=self.testuser2.id, message_id=msg.id)
+                            for msg in messages])
+        db.session.commit()
+        oldest_like_id = (Likes.query.filter_by(user_id=self.testuser2.id)
+                          .order_by(Likes.id).first().id)
+        liker_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = c.get(f"/users/{liker_id}/likes")
+            html = resp.get_data(as_text=True)
+
+            # newest likes first; the oldest spills onto the next page
+            self.assertIn(f"Message {len(messages) - 1}<", html)
+            self.assertNotIn("Message 0<", html)
+            self.assertIn(f"before={oldest_like_id + 1}", html)
+
+            resp = c.get(f"/users/{liker_id}/likes",
+                         query_string={"before": oldest_like_id + 1})
+            html = resp.get_data(as_text=True)
+            self.assertIn("Message 0<", html)
+            self.assertNotIn("Older", html)
+
     def test_show_following(self):
         follow = Follows(user_being_followed_id=self.testuser2.id,
                          user_following_id=self.testuser1.id)
@@ -197,6 +230,36 @@ class UserViewTestCase(TestCase):
             self.assertIn(self.testuser1.username, html)
             self.assertIn(self.testuser2.username, html)
 
+    def test_relationships(self):
+        follow = Follows(user_being_followed_id=self.testuser2.id,
+                         user_following_id=self.testuser1.id)
+        db.session.add(follow)
+        db.session.commit()
+        invalid_id = self.testuser1.id + self.testuser2.id
+
+        with self.client as c:
+            # log in
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            resp = c.get(f"/api/relationships?ids={self.testuser1.id},"
+                         f"{invalid_id},{self.testuser1.id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"relationships": [
+                {"id": self.testuser1.id, "following": False,
+                 "followed_by": True},
+                {"id": invalid_id, "following": False,
+                 "followed_by": False},
+            ]})
+
+            self.assertEqual(c.get("/api/relationships").status_code, 400)
+            self.assertEqual(
+                c.get("/api/relationships?ids=1,x").status_code, 400)
+            too_many = ",".join(
+                str(i) for i in range(app_module.RELATIONSHIPS_MAX_IDS + 1))
+            self.assertEqual(
+                c.get(f"/api/relationships?ids={too_many}").status_code, 400)
+
     def test_add_follow(self):
         invalid_id = self.testuser1.id + self.testuser2.id
         with self.client as c:
@@ -0,0 +1,358 @@
+"""Resized, locally cached copies of user avatar and header images.
+
+`User.image_url` and `User.header_image_url` point anywhere on the web.
+Templates pass them through the `thumbnail` filter, which turns them into
+signed /images/<size>/<token> URLs. The first request for a source fetches
+it once, renders every size, and stores the results in a content-addressed
+disk cache:
+
+    <cache>/refs/<sha256 of url>           -> sha256 of the fetched bytes
+    <cache>/blobs/<ab>/<sha256>-<size>.jpg -> the rendered image
+
+Identical images behind different URLs share blobs. Each worker keeps a
+running total of the blob bytes, counted once from disk and then grown
+by what it renders; when the total passes THUMBNAIL_CACHE_MAX_BYTES the
+cache is swept and the least recently served blobs are deleted. Blobs
+rendered by other workers are only counted at the next sweep, so the
+cache may overshoot by up to a tenth of the bound per worker.
+
+Sources are fetched by hand, one hop at a time: every host, the first
+and each redirect's, must resolve to public addresses only, and the
+connection goes to the address that was checked, so neither a redirect
+nor DNS rebinding can point the fetch at an internal service.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+import threading
+from urllib.parse import urljoin, urlparse
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+
+# (width, height) rendered for each named size, at 2x for high-dpi screens
+SIZES = {
+    "avatar": (200, 200),
+    "card": (600, 200),
+    "hero": (1600, 480),
+}
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+FETCH_TIMEOUT = 5
+MAX_REDIRECTS = 5
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+class ThumbnailError(Exception):
+    """The source image could not be fetched or decoded."""
+
+
+class _Thumbnails:
+    """Per-app cache settings, URL signer and locks."""
+
+    def __init__(self, app):
+        self.directory = app.config['THUMBNAIL_CACHE_DIR']
+        self.max_bytes = app.config['THUMBNAIL_CACHE_MAX_BYTES']
+        self.allow_private = app.config['THUMBNAIL_ALLOW_PRIVATE']
+        self.serializer = URLSafeSerializer(app.config['SECRET_KEY'],
+                                            salt='thumbnail')
+        # blob bytes on disk as far as this worker knows; None until counted
+        self.cached_bytes = None
+        self.size_lock = threading.Lock()
+        # striped so the lock table stays small however many URLs we see
+        self.locks = [threading.Lock() for _ in range(64)]
+
+
+class ThumbnailService:
+    """Fetches, resizes and caches images; bind to an app with `init_app`."""
+
+    def init_app(self, app):
+        app.config.setdefault(
+            'THUMBNAIL_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'warbler-thumbnails'))
+        app.config.setdefault('THUMBNAIL_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        # only tests serving images from localhost should turn this on
+        app.config.setdefault('THUMBNAIL_ALLOW_PRIVATE', False)
+
+        app.extensions['thumbnails'] = _Thumbnails(app)
+        app.add_template_filter(self.url_for, 'thumbnail')
+
+    def _state(self):
+        return current_app.extensions['thumbnails']
+
+    ##########################################################################
+    # URLs
+
+    def url_for(self, source, size):
+        """URL serving `source` at `size`; local images are left alone."""
+
+        if not source or not source.startswith(('http://', 'https://')):
+            return source
+        return f"/images/{size}/{self._state().serializer.dumps(source)}"
+
+    def source_for(self, token):
+        """Return the source URL signed into `token`, or None if forged."""
+
+        try:
+            return self._state().serializer.loads(token)
+        except BadSignature:
+            return None
+
+    ##########################################################################
+    # Cache
+
+    def _ref_path(self, source):
+        digest = hashlib.sha256(source.encode()).hexdigest()
+        return os.path.join(self._state().directory, 'refs', digest)
+
+    def _blob_path(self, digest, size):
+        return os.path.join(self._state().directory, 'blobs', digest[:2],
+                            f"{digest}-{size}.jpg")
+
+    def cached(self, source, size):
+        """Path of the cached `size` rendering of `source`, or None."""
+
+        try:
+            with open(self._ref_path(source)) as ref:
+                digest = ref.read().strip()
+        except FileNotFoundError:
+            return None
+
+        path = self._blob_path(digest, size)
+        try:
+            # mtime doubles as last-served time for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, source, size):
+        """Return the path of `source` rendered at `size`.
+
+        Fetches and renders on a miss; concurrent misses for the same
+        source in this process wait for a single fetch.
+        """
+
+        path = self.cached(source, size)
+        if path:
+            return path
+
+        with self._lock_for(source):
+            path = self.cached(source, size)
+            if path:
+                return path
+
+            data = self.fetch(source)
+            digest = hashlib.sha256(data).hexdigest()
+            written = 0
+            for name, dimensions in SIZES.items():
+                rendered = render(data, dimensions)
+                _write_atomic(self._blob_path(digest, name), rendered)
+                written += len(rendered)
+            _write_atomic(self._ref_path(source), digest.encode())
+
+        self._grow(written)
+        return self._blob_path(digest, size)
+
+    def _lock_for(self, source):
+        locks = self._state().locks
+        return locks[hash(source) % len(locks)]
+
+    def _grow(self, written):
+        """Count `written` new blob bytes; sweep once over the bound."""
+
+        state = self._state()
+        with state.size_lock:
+            if state.cached_bytes is None:
+                # the blobs just written are on disk already
+                state.cached_bytes = self._blob_bytes(state)
+            else:
+                state.cached_bytes += written
+            over = state.cached_bytes > state.max_bytes
+        if over:
+            self.evict()
+
+    def _blob_bytes(self, state):
+        return sum(os.stat(os.path.join(root, name)).st_size
+                   for root, _, files
+                   in os.walk(os.path.join(state.directory, 'blobs'))
+                   for name in files)
+
+    def evict(self):
+        """Delete least recently served blobs until under the size bound,
+        and recount the cache."""
+
+        state = self._state()
+        blobs = []
+        total = 0
+        for root, _, files in os.walk(os.path.join(state.directory, 'blobs')):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                blobs.append((stat.st_mtime, stat.st_size,
+                              os.path.join(root, name)))
+                total += stat.st_size
+
+        if total > state.max_bytes:
+            # leave some headroom so every new source doesn't trigger a sweep
+            target = state.max_bytes * 0.9
+            for _, size, path in sorted(blobs):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+        with state.size_lock:
+            state.cached_bytes = total
+
+    ##########################################################################
+    # Fetching
+
+    def fetch(self, source):
+        """Download `source`, refusing private hosts and oversized bodies.
+
+        Redirects are followed by hand, up to MAX_REDIRECTS, each hop
+        checked like the first.
+        """
+
+        url = source
+        for _ in range(MAX_REDIRECTS + 1):
+            try:
+                status, location, data = self._fetch_once(url)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                raise ThumbnailError(f"Failed to fetch {source!r}: {e}") from e
+            if location is None:
+                break
+            url = urljoin(url, location)
+        else:
+            raise ThumbnailError(f"Too many redirects: {source!r}")
+
+        if status != 200:
+            raise ThumbnailError(f"Failed to fetch {source!r}: HTTP {status}")
+        if len(data) > MAX_SOURCE_BYTES:
+            raise ThumbnailError(f"Image too large: {source!r}")
+        return data
+
+    def _fetch_once(self, url):
+        """GET `url` without following redirects.
+
+        Returns (status, redirect location or None, body).
+        """
+
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ThumbnailError(f"Unsupported image URL {url!r}")
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+
+        address = _resolve(parsed.hostname, port)
+        if address is None:
+            raise ThumbnailError(f"Can't resolve {url!r}")
+        if not self._state().allow_private and _is_private(address):
+            raise ThumbnailError(f"Refusing to fetch private host {url!r}")
+
+        if parsed.scheme == 'https':
+            conn = _PinnedHTTPSConnection(parsed.hostname, address, port)
+        else:
+            conn = _PinnedHTTPConnection(parsed.hostname, address, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        try:
+            conn.request('GET', path,
+                         headers={'User-Agent': 'warbler-thumbnailer'})
+            resp = conn.getresponse()
+            location = resp.getheader('Location')
+            if resp.status in REDIRECT_STATUSES and location:
+                return resp.status, location, b""
+            return resp.status, None, resp.read(MAX_SOURCE_BYTES + 1)
+        finally:
+            conn.close()
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """Connects to an address resolved and checked beforehand; the
+    hostname is only used for the Host header."""
+
+    def __init__(self, host, address, port):
+        super().__init__(host, port, timeout=FETCH_TIMEOUT)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port),
+                                             self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """As _PinnedHTTPConnection, with TLS verified against the hostname."""
+
+    def __init__(self, host, address, port):
+        super().__init__(host, port, timeout=FETCH_TIMEOUT,
+                         context=ssl.create_default_context())
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port),
+                                        self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def render(data, dimensions):
+    """Crop and scale image bytes to exactly `dimensions`; return JPEG bytes."""
+
+    # Pillow is only needed on a cache miss; keep it out of worker startup
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.fit(image.convert('RGB'), dimensions, Image.LANCZOS)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ThumbnailError(f"Could not decode image: {e}") from e
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def _write_atomic(path, data):
+    """Write a file so readers never see it half written."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(data)
+    os.replace(tmp_path, path)
+
+
+def _resolve(hostname, port):
+    """One address `hostname` resolves to, or None; None too if any of
+    its addresses is private, so a host can't mix public and private
+    ones and hope for the public one to be checked."""
+
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(
+            hostname, port, type=socket.SOCK_STREAM)]
+    except socket.gaierror:
+        return None
+    if not addresses:
+        return None
+    private = [address for address in addresses if _is_private(address)]
+    return private[0] if private else addresses[0]
+
+
+def _is_private(address):
+    """Is `address` a loopback, private, link-local or otherwise
+    non-global IP address?"""
+
+    return not ipaddress.ip_address(address.split('%')[0]).is_global
+
+
+thumbnails = ThumbnailService()